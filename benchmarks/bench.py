@@ -0,0 +1,469 @@
+#
+# bench.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+"""
+Benchmarks for the hashing, bencode and metadata load paths.
+
+The synthetic data is generated once in a work directory from a fixed seed,
+so two runs at the same scale measure the same data.  Every benchmark runs in
+a fresh interpreter so its peak RSS is its own, the allocations are measured
+with tracemalloc in a separate run so they do not slow the timed ones.  The
+data is read from the page cache after the first run, so the hashing numbers
+are CPU bound.
+
+** Usage **
+
+    $ python benchmarks/bench.py run --work /tmp/bench --scale 0.01 -o old.json
+    $ python benchmarks/bench.py run --work /tmp/bench --scale 0.01 -o new.json
+    $ python benchmarks/bench.py compare old.json new.json --threshold 0.1
+
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+# Benchmark the checkout this script belongs to
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from torrentutils.lib.bencode import bdecode, bencode
+from torrentutils.lib.metadata import TorrentMetadata
+
+RESULTS_VERSION = 1
+
+# The data generated at scale 1, see make_datasets()
+HUGE_FILES = 3
+HUGE_FILE_SIZE = 1024 * 1024 * 1024
+TINY_FILES = 1000000
+TINY_FILE_SIZE = 4096
+MIXED_FILES = 1000
+SPARSE_FILES = 8
+SPARSE_FILE_SIZE = 256 * 1024 * 1024
+LARGE_TORRENT_ENTRIES = 1000000
+
+# The files per directory of the tiny and large torrent layouts
+FANOUT = 1000
+
+BLOCK_SIZE = 1024 * 1024
+SEED = 20091017
+
+# The metrics where a larger value is a regression
+COMPARED_METRICS = ["seconds", "peak_rss", "alloc_peak"]
+
+def random_block(rng):
+    """
+    A block of random data, the data files are made of copies of it with a
+    counter in front so no two blocks are the same.
+    """
+    return bytearray(rng.getrandbits(8) for i in range(BLOCK_SIZE))
+
+def write_data(path, size, block, counter):
+    """
+    Write a file of `size` bytes made of numbered copies of `block`.
+
+    :returns: the next counter
+    :rtype: int
+
+    """
+    with open(path, "wb") as fd:
+        while size > 0:
+            block[:8] = struct.pack(">Q", counter)
+            counter += 1
+            chunk = min(size, len(block))
+            fd.write(block[:chunk])
+            size -= chunk
+    return counter
+
+def fanout_path(root, index):
+    """
+    The path of the file `index` of a layout of many files, spread over
+    directories of FANOUT files.
+    """
+    return os.path.join(root, "%04d" % (index // FANOUT), "%07d" % index)
+
+def make_datasets(work, scale):
+    """
+    Generate the data in `work`, unless it was already generated at the same
+    scale.
+
+    - huge: a few large files
+    - tiny: many tiny files, some of them empty
+    - mixed: files of log-uniform sizes from 1 KiB to 16 MiB, hashed with and
+      without padding
+    - sparse: files holding a few MiB of data, the rest being holes
+    - large.torrent: a torrent of many entries, without data
+
+    """
+    manifest_path = os.path.join(work, "manifest.json")
+    manifest = {"scale": scale, "seed": SEED}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as fd:
+            if json.load(fd) == manifest:
+                return
+        os.remove(manifest_path)
+    for name in ("huge", "tiny", "mixed", "sparse"):
+        if os.path.isdir(os.path.join(work, name)):
+            shutil.rmtree(os.path.join(work, name))
+    if not os.path.isdir(work):
+        os.makedirs(work)
+
+    rng = random.Random(SEED)
+    block = random_block(rng)
+    counter = 0
+
+    def count(n):
+        return max(1, int(n * scale))
+
+    log("Generating huge files")
+    os.makedirs(os.path.join(work, "huge"))
+    for i in range(HUGE_FILES):
+        counter = write_data(os.path.join(work, "huge", "file%d" % i),
+                             count(HUGE_FILE_SIZE), block, counter)
+
+    log("Generating tiny files")
+    data = bytes(block)
+    for i in range(count(TINY_FILES)):
+        path = fanout_path(os.path.join(work, "tiny"), i)
+        if i % FANOUT == 0:
+            os.makedirs(os.path.dirname(path))
+        size = rng.randint(0, TINY_FILE_SIZE)
+        start = rng.randint(0, len(data) - size)
+        with open(path, "wb") as fd:
+            fd.write(data[start:start + size])
+
+    log("Generating mixed files")
+    os.makedirs(os.path.join(work, "mixed"))
+    for i in range(count(MIXED_FILES)):
+        size = int(2 ** rng.uniform(10, 24))
+        counter = write_data(os.path.join(work, "mixed", "file%d" % i), size,
+                             block, counter)
+
+    log("Generating sparse files")
+    os.makedirs(os.path.join(work, "sparse"))
+    size = max(8 * BLOCK_SIZE, count(SPARSE_FILE_SIZE))
+    for i in range(SPARSE_FILES):
+        with open(os.path.join(work, "sparse", "file%d" % i), "wb") as fd:
+            fd.truncate(size)
+            for j in range(4):
+                block[:8] = struct.pack(">Q", counter)
+                counter += 1
+                fd.seek(rng.randrange(0, size - BLOCK_SIZE))
+                fd.write(block)
+
+    log("Generating large.torrent")
+    files = []
+    total = 0
+    for i in range(count(LARGE_TORRENT_ENTRIES)):
+        length = rng.randint(0, 64 * 1024)
+        components = fanout_path("", i).split(os.sep)
+        files.append({b"length": length,
+                      b"path": [c.encode("utf-8") for c in components if c]})
+        total += length
+    piece_length = 4 * 1024 * 1024
+    num_pieces = (total + piece_length - 1) // piece_length
+    pieces = bytes(bytearray(rng.getrandbits(8) for i in range(num_pieces * 20)))
+    torrent = {
+        b"announce": b"http://tracker.example.com/announce",
+        b"info": {
+            b"name": b"large",
+            b"piece length": piece_length,
+            b"pieces": pieces,
+            b"files": files,
+        },
+    }
+    with open(os.path.join(work, "large.torrent"), "wb") as fd:
+        fd.write(bencode(torrent))
+
+    with open(manifest_path, "w") as fd:
+        json.dump(manifest, fd)
+
+def log(message):
+    sys.stderr.write(message + "\n")
+
+def tree_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            total += os.path.getsize(os.path.join(dirpath, name))
+    return total
+
+def save_benchmark(dataset, pad_files=False, hybrid=False):
+    """
+    Make a benchmark of hashing a dataset into a torrent, the directory scan
+    included.
+    """
+    def bench(work, jobs):
+        data_path = os.path.join(work, dataset)
+        fd, target = tempfile.mkstemp(suffix=".torrent", dir=work)
+        os.close(fd)
+        try:
+            start = time.time()
+            md = TorrentMetadata()
+            md.data_path = data_path
+            md.pad_files = pad_files
+            if hybrid:
+                md.meta_version = 2
+                md.hybrid = True
+            md.save(target, jobs=jobs)
+            seconds = time.time() - start
+            md = TorrentMetadata()
+            md.load(target)
+            pieces = len(md.pieces) // 20
+        finally:
+            os.remove(target)
+        return {"seconds": seconds, "bytes": tree_size(data_path),
+                "pieces": pieces}
+    return bench
+
+def load_benchmark(lazy):
+    """
+    Make a benchmark of loading large.torrent, every field is accessed unless
+    `lazy`.
+    """
+    def bench(work, jobs):
+        path = os.path.join(work, "large.torrent")
+        start = time.time()
+        md = TorrentMetadata()
+        md.load(path, lazy=lazy)
+        if lazy:
+            md.name
+        else:
+            md.files
+            md.pieces
+        return {"seconds": time.time() - start,
+                "bytes": os.path.getsize(path)}
+    return bench
+
+def bench_bdecode(work, jobs):
+    with open(os.path.join(work, "large.torrent"), "rb") as fd:
+        raw = fd.read()
+    start = time.time()
+    bdecode(raw)
+    return {"seconds": time.time() - start, "bytes": len(raw)}
+
+def bench_bencode(work, jobs):
+    with open(os.path.join(work, "large.torrent"), "rb") as fd:
+        raw = fd.read()
+    torrent = bdecode(raw)
+    start = time.time()
+    bencode(torrent)
+    return {"seconds": time.time() - start, "bytes": len(raw)}
+
+BENCHMARKS = [
+    ("save_huge", save_benchmark("huge")),
+    ("save_tiny", save_benchmark("tiny")),
+    ("save_mixed", save_benchmark("mixed")),
+    ("save_mixed_padded", save_benchmark("mixed", pad_files=True)),
+    ("save_mixed_hybrid", save_benchmark("mixed", hybrid=True)),
+    ("save_sparse", save_benchmark("sparse")),
+    ("load_large", load_benchmark(False)),
+    ("load_large_lazy", load_benchmark(True)),
+    ("bdecode_large", bench_bdecode),
+    ("bencode_large", bench_bencode),
+]
+
+def peak_rss():
+    """
+    The peak resident set size of this process in bytes.
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def run_child(name, work, jobs, repeat, trace):
+    """
+    Run a benchmark in this process and print its metrics as JSON.  The best
+    of `repeat` runs is kept.
+    """
+    bench = dict(BENCHMARKS)[name]
+    if trace:
+        import tracemalloc
+        tracemalloc.start()
+        bench(work, jobs)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(json.dumps({"alloc_peak": peak}))
+        return
+
+    best = None
+    for i in range(repeat):
+        metrics = bench(work, jobs)
+        if best is None or metrics["seconds"] < best["seconds"]:
+            best = metrics
+    best["peak_rss"] = peak_rss()
+    print(json.dumps(best))
+
+def spawn(name, work, jobs, repeat, trace):
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), "child", name, work,
+         str(jobs), str(repeat), "1" if trace else "0"])
+    return json.loads(output.decode("utf-8"))
+
+def run(options, names):
+    work = os.path.abspath(options.work)
+    make_datasets(work, options.scale)
+
+    results = {}
+    for name, bench in BENCHMARKS:
+        if names and name not in names:
+            continue
+        log("Running %s" % name)
+        metrics = spawn(name, work, options.jobs, options.repeat, False)
+        if options.tracemalloc:
+            metrics.update(spawn(name, work, options.jobs, 1, True))
+        seconds = max(metrics["seconds"], 1e-9)
+        metrics["mb_per_s"] = metrics["bytes"] / seconds / (1024 * 1024)
+        if "pieces" in metrics:
+            metrics["pieces_per_s"] = metrics["pieces"] / seconds
+        results[name] = metrics
+        log("  %.3fs %.1f MiB/s peak RSS %.1f MiB" % (metrics["seconds"],
+            metrics["mb_per_s"], metrics["peak_rss"] / (1024.0 * 1024)))
+
+    return {
+        "version": RESULTS_VERSION,
+        "created": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": options.scale,
+        "jobs": options.jobs,
+        "repeat": options.repeat,
+        "results": results,
+    }
+
+def compare(old, new, threshold):
+    """
+    Print the change of every metric between two result files.
+
+    :returns: the (benchmark, metric) pairs that got worse by more than
+    `threshold`, a fraction of the old value
+    :rtype: list of 2-tuples
+
+    """
+    if old["scale"] != new["scale"] or old["jobs"] != new["jobs"]:
+        log("Warning: the runs were made with different scales or jobs")
+
+    regressions = []
+    print("%-20s %-12s %14s %14s %9s" % ("benchmark", "metric", "old", "new",
+                                         "change"))
+    for name in sorted(new["results"]):
+        if name not in old["results"]:
+            continue
+        for metric in COMPARED_METRICS:
+            before = old["results"][name].get(metric)
+            after = new["results"][name].get(metric)
+            if before is None or after is None:
+                continue
+            change = (after - before) / float(before) if before else 0.0
+            flag = ""
+            if change > threshold:
+                regressions.append((name, metric))
+                flag = "  REGRESSION"
+            print("%-20s %-12s %14.6g %14.6g %+8.1f%%%s" % (name, metric,
+                  before, after, change * 100, flag))
+    return regressions
+
+def main():
+    usage = "%prog run [options] [benchmark ...]\n" \
+        "       %prog compare [options] old.json new.json"
+    parser = OptionParser(usage=usage)
+    parser.add_option(
+        "--work", dest="work", action="store", type="string",
+        default=os.path.join(tempfile.gettempdir(), "torrentutils-bench"),
+        help="Where to generate the data, it is reused by later runs at the "
+        "same scale."
+    )
+    parser.add_option(
+        "--scale", dest="scale", action="store", type="float", default=1.0,
+        help="Scale the size of the data, 1.0 generates about 5 GiB and a "
+        "million tiny files."
+    )
+    parser.add_option(
+        "-j", "--jobs", dest="jobs", action="store", type="int", default=1,
+        help="The number of workers hashing pieces in parallel."
+    )
+    parser.add_option(
+        "--repeat", dest="repeat", action="store", type="int", default=3,
+        help="Run each benchmark this many times and keep the best."
+    )
+    parser.add_option(
+        "--no-tracemalloc", dest="tracemalloc", action="store_false",
+        default=True, help="Do not measure the allocations."
+    )
+    parser.add_option(
+        "-o", "--output", dest="output", action="store", type="string",
+        help="Write the results to this JSON file."
+    )
+    parser.add_option(
+        "--threshold", dest="threshold", action="store", type="float",
+        default=0.1,
+        help="The fraction by which a metric may grow before compare reports "
+        "a regression."
+    )
+
+    if len(sys.argv) > 1 and sys.argv[1] == "child":
+        name, work, jobs, repeat, trace = sys.argv[2:7]
+        run_child(name, work, int(jobs), int(repeat), trace == "1")
+        return
+
+    (options, args) = parser.parse_args()
+    if not args or args[0] not in ("run", "compare"):
+        parser.print_help()
+        sys.exit(2)
+
+    if args[0] == "run":
+        unknown = set(args[1:]) - set(dict(BENCHMARKS))
+        if unknown:
+            parser.error("unknown benchmarks: %s" % ", ".join(sorted(unknown)))
+        results = run(options, args[1:])
+        data = json.dumps(results, indent=2, sort_keys=True)
+        if options.output:
+            with open(options.output, "w") as fd:
+                fd.write(data + "\n")
+        else:
+            print(data)
+        return
+
+    if len(args) != 3:
+        parser.error("compare needs two result files")
+    with open(args[1]) as fd:
+        old = json.load(fd)
+    with open(args[2]) as fd:
+        new = json.load(fd)
+    regressions = compare(old, new, options.threshold)
+    if regressions:
+        print("%s regressions above %.0f%%" % (len(regressions),
+                                              options.threshold * 100))
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
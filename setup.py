@@ -34,6 +34,7 @@ setup(
             torrentview = torrentutils.main:torrent_view
             torrentedit = torrentutils.main:torrent_edit
             torrentverify = torrentutils.main:torrent_verify
+            torrentindex = torrentutils.main:torrent_index
     """,
     license="GPLv3",
     name="torrentutils",
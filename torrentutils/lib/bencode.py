@@ -26,6 +26,9 @@ INT_DELIM = b'i'
 LIST_DELIM = b'l'
 BYTE_SEP = b':'
 
+# Byte values dispatched on by the decoder
+_D, _E, _I, _L, _COLON, _ZERO, _NINE = bytearray(b'deil:09')
+
 
 def decode_int(x, f):
     f += 1
@@ -79,9 +82,212 @@ decode_func[b'8'] = decode_string
 decode_func[b'9'] = decode_string
 
 
-def bdecode(x):
+def _find(x, c, f):
+    """
+    Find the byte value `c` in a buffer without a find() method.
+    """
+    while x[f] != c:
+        f += 1
+    return f
+
+
+def _decode(x, view_threshold=None):
+    if PY2 and isinstance(x, str):
+        x = bytearray(x)
+    mv = memoryview(x)
+    # Slices of bytes can be used directly, anything else is copied out of the
+    # memoryview so strings always come back as bytes
+    is_bytes = type(x) is bytes
+    is_view = isinstance(x, memoryview)
+    find = None if is_view else x.find
+    end = len(x)
+    if view_threshold is None:
+        view_threshold = end + 1
+
+    # The containers being decoded and the key each one will be stored under
+    # in its parent
+    stack = []
+    top = None
+    in_dict = False
+    key = None
+    f = 0
+    while True:
+        c = x[f]
+        if _ZERO <= c <= _NINE:
+            # Most tokens are strings with short lengths, so parse the length
+            # inline rather than searching for the colon
+            n = c - _ZERO
+            f += 1
+            c = x[f]
+            while c != _COLON:
+                if not n or not _ZERO <= c <= _NINE:
+                    raise ValueError
+                n = n * 10 + c - _ZERO
+                f += 1
+                c = x[f]
+            f += 1
+            e = f + n
+            if e > end:
+                raise ValueError
+            if in_dict and key is None:
+                key = x[f:e] if is_bytes else mv[f:e].tobytes()
+                f = e
+                continue
+            if n >= view_threshold:
+                v = mv[f:e]
+            elif is_bytes:
+                v = x[f:e]
+            else:
+                v = mv[f:e].tobytes()
+            f = e
+        elif in_dict and key is None:
+            if c != _E:
+                # Dictionary keys must be strings
+                raise ValueError
+            v = top
+            top, key = stack.pop()
+            in_dict = type(top) is dict
+            f += 1
+        elif c == _I:
+            f += 1
+            e = _find(x, _E, f) if is_view else find(END_DELIM, f)
+            if e < 0:
+                raise ValueError
+            digits = mv[f:e].tobytes() if is_view else x[f:e]
+            _check_int(digits)
+            v = int(digits)
+            f = e + 1
+        elif c == _L or c == _D:
+            stack.append((top, key))
+            top = [] if c == _L else {}
+            in_dict = c == _D
+            key = None
+            f += 1
+            continue
+        elif c == _E and top is not None and not in_dict:
+            v = top
+            top, key = stack.pop()
+            in_dict = type(top) is dict
+            f += 1
+        else:
+            raise ValueError
+
+        if top is None:
+            return v
+        if in_dict:
+            top[key] = v
+            key = None
+        else:
+            top.append(v)
+
+
+def bdecode(x, view_threshold=None):
+    """
+    Decode bencoded data.  The decoder does not recurse, so arbitrarily deeply
+    nested data can be decoded, and accepts bytes, bytearray, memoryview and
+    mmap objects.
+
+    :param x: the bencoded data
+    :param view_threshold: if set, strings of at least this many bytes are
+    returned as memoryviews of `x` instead of being copied
+    :returns: the decoded value
+
+    :raises BTFailure: if `x` is not valid bencoded data
+    """
+    try:
+        return _decode(x, view_threshold)
+    except (IndexError, KeyError, ValueError, TypeError):
+        raise BTFailure('Not a valid bencoded string')
+
+
+def _check_int(digits):
+    """
+    Check the digits of an integer token, int() alone also accepts spaces,
+    underscores and a plus sign.
+    """
+    negative = digits[:1] == b'-'
+    body = digits[1:] if negative else digits
+    if not body.isdigit() or (body[:1] == b'0' and (negative or len(body) > 1)):
+        raise ValueError
+
+
+def _skip_string(x, f, find):
+    colon = find(BYTE_SEP, f)
+    digits = x[f:colon]
+    if colon < 0 or not digits.isdigit() or \
+            (digits[:1] == b'0' and len(digits) > 1):
+        raise ValueError
+    f = colon + 1 + int(digits)
+    if f > len(x):
+        raise ValueError
+    return f
+
+
+# The containers skip_value() is in, and what a dictionary expects next
+_SKIP_LIST, _SKIP_KEY, _SKIP_VALUE = 0, 1, 2
+
+
+def skip_value(x, f):
+    """
+    Find the end of the bencoded value starting at `f` without decoding it.
+    The value is checked as strictly as bdecode() would check it, so
+    dictionary keys must be strings followed by a value.
+
+    :raises ValueError: if the value is not valid bencoded data
+    """
+    if PY2 and isinstance(x, str):
+        x = bytearray(x)
+    find = x.find
+    stack = []
+    while True:
+        c = x[f]
+        state = stack[-1] if stack else None
+        if c == _E and stack and state != _SKIP_VALUE:
+            stack.pop()
+            f += 1
+        elif state == _SKIP_KEY:
+            # Dictionary keys must be strings
+            if not _ZERO <= c <= _NINE:
+                raise ValueError
+            f = _skip_string(x, f, find)
+            stack[-1] = _SKIP_VALUE
+            continue
+        elif _ZERO <= c <= _NINE:
+            f = _skip_string(x, f, find)
+        elif c == _L or c == _D:
+            stack.append(_SKIP_LIST if c == _L else _SKIP_KEY)
+            f += 1
+            continue
+        elif c == _I:
+            e = find(END_DELIM, f)
+            if e < 0:
+                raise ValueError
+            _check_int(x[f + 1:e])
+            f = e + 1
+        else:
+            raise ValueError
+        if not stack:
+            return f
+        if stack[-1] == _SKIP_VALUE:
+            stack[-1] = _SKIP_KEY
+
+
+def bdecode_spans(x, f=0):
+    """
+    Scan the bencoded dictionary starting at `f` and record where each of its
+    values lies without decoding them.
+
+    :returns: a dict of {key: (start, end)} offsets into `x`
+    """
     try:
-        r, __ = decode_func[x[0:1]](x, 0)
+        if x[f:f+1] != DICT_DELIM:
+            raise ValueError
+        r, f = {}, f + 1
+        while x[f:f+1] != END_DELIM:
+            k, f = decode_string(x, f)
+            end = skip_value(x, f)
+            r[k] = (f, end)
+            f = end
     except (IndexError, KeyError, ValueError):
         raise BTFailure('Not a valid bencoded string')
     else:
@@ -109,7 +315,7 @@ def encode_bool(x, r):
 
 
 def encode_string(x, r):
-    encode_string(x.encode('utf8'), r)
+    encode_bytes(x.encode('utf8'), r)
 
 
 def encode_bytes(x, r):
@@ -150,3 +356,100 @@ def bencode(x):
     r = []
     encode_func[type(x)](x, r)
     return b''.join(r)
+
+
+class StreamedBytes(object):
+    """
+    A string of known `length` whose contents are produced by iterating over
+    `chunks` while it is being written by a `BencodeWriter`.
+    """
+
+    __slots__ = ['length', 'chunks']
+
+    def __init__(self, length, chunks):
+        self.length = length
+        self.chunks = chunks
+
+
+class StreamedList(object):
+    """
+    A list whose items are produced by iterating over `items` while it is being
+    written by a `BencodeWriter`.
+    """
+
+    __slots__ = ['items']
+
+    def __init__(self, items):
+        self.items = items
+
+
+class Hashed(object):
+    """
+    A value whose encoded bytes are also fed to `hash` while it is being
+    written by a `BencodeWriter`, eg, to compute an info-hash.
+    """
+
+    __slots__ = ['value', 'hash']
+
+    def __init__(self, value, hash):
+        self.value = value
+        self.hash = hash
+
+
+class BencodeWriter(object):
+    """
+    Writes bencoded data to a file object as it is encoded instead of building
+    it in memory.  Dictionaries are written with their keys sorted and the
+    `StreamedBytes`, `StreamedList` and `Hashed` wrappers let large values be
+    produced while they are written.
+
+    ** Usage **
+
+    >>> w = BencodeWriter(open("/tmp/test.torrent", "wb"))
+    >>> w.write({b"info": {b"pieces": StreamedBytes(40, digests)}})
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.__hashes = []
+
+    def __out(self, data):
+        self.fd.write(data)
+        for h in self.__hashes:
+            h.update(data)
+
+    def write(self, x):
+        """
+        Encode `x` and write it out.
+
+        :raises ValueError: if a `StreamedBytes` produces the wrong length
+        """
+        t = type(x)
+        if t is dict:
+            self.__out(DICT_DELIM)
+            for k, v in sorted(x.items()):
+                self.__out(str(len(k)).encode('utf8') + BYTE_SEP + k)
+                self.write(v)
+            self.__out(END_DELIM)
+        elif t is list or t is tuple or t is StreamedList:
+            self.__out(LIST_DELIM)
+            for i in (x.items if t is StreamedList else x):
+                self.write(i)
+            self.__out(END_DELIM)
+        elif t is StreamedBytes:
+            self.__out(str(x.length).encode('utf8') + BYTE_SEP)
+            written = 0
+            for chunk in x.chunks:
+                self.__out(chunk)
+                written += len(chunk)
+            if written != x.length:
+                raise ValueError('Streamed %d bytes instead of %d' %
+                                 (written, x.length))
+        elif t is Hashed:
+            self.__hashes.append(x.hash)
+            try:
+                self.write(x.value)
+            finally:
+                self.__hashes.remove(x.hash)
+        else:
+            self.__out(bencode(x))
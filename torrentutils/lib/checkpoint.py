@@ -0,0 +1,193 @@
+#
+# checkpoint.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import json
+import os
+import struct
+import time
+
+# Every batch of digests is stored as a record header followed by the digests
+RECORD = struct.Struct(">QI")
+
+class CheckpointMismatch(Exception):
+    """
+    Raised when resuming from a checkpoint that was written for different data.
+    """
+    pass
+
+class Checkpoint(object):
+    """
+    Records the piece hashes completed while creating a torrent so an
+    interrupted run can be resumed.
+
+    The file starts with a JSON line describing the storage (paths, lengths,
+    modification times and piece size) followed by records of raw digests
+    appended as batches complete.  A record cut short by a crash is ignored.
+
+    ** Usage **
+
+    >>> cp = Checkpoint("/tmp/test.torrent.checkpoint", storage, mtimes)
+    >>> known = cp.load()
+    >>> cp.open(known)
+    >>> pieces = hasher.hash_pieces(known=known, callback=cp.add)
+    >>> cp.remove()
+
+    """
+    def __init__(self, path, storage, mtimes, interval=30):
+        """
+        :param path: the checkpoint file
+        :type path: string
+        :param storage: the storage being hashed
+        :type storage: FileStorage
+        :param mtimes: the modification time of every file in the storage, None
+        for padding files
+        :type mtimes: list of float
+        :param interval: the number of seconds between writes to disk
+        :type interval: int
+
+        """
+        self.path = path
+        self.storage = storage
+        self.mtimes = mtimes
+        self.interval = interval
+        self.__fd = None
+        self.__pending = []
+        self.__last_flush = 0
+
+    def header(self):
+        """
+        The description of the storage the checkpoint is valid for.
+
+        :rtype: dict
+
+        """
+        return {
+            "piece_size": self.storage.piece_size,
+            "files": [[path, length, mtime] for (path, length), mtime in
+                      zip(self.storage.files, self.mtimes)],
+        }
+
+    def load(self):
+        """
+        Read the completed pieces from an existing checkpoint.
+
+        :returns: the completed piece digests, empty if there is no checkpoint
+        :rtype: dict of {index: digest}
+
+        :raises CheckpointMismatch: if the checkpoint was written for data that
+        differs from the storage
+
+        """
+        if not os.path.exists(self.path):
+            return {}
+
+        known = {}
+        with open(self.path, "rb") as fd:
+            try:
+                header = json.loads(fd.readline().decode("UTF-8"))
+            except ValueError:
+                raise CheckpointMismatch("%s is not a checkpoint file" % self.path)
+            if header != json.loads(json.dumps(self.header())):
+                raise CheckpointMismatch("The data has changed since %s was "
+                                         "written" % self.path)
+            while True:
+                record = fd.read(RECORD.size)
+                if len(record) < RECORD.size:
+                    break
+                start, count = RECORD.unpack(record)
+                digests = fd.read(count * 20)
+                if len(digests) < count * 20:
+                    break
+                for i in range(count):
+                    known[start + i] = digests[i * 20:i * 20 + 20]
+        return known
+
+    def open(self, known=None):
+        """
+        Start writing the checkpoint.  The file is rewritten with the `known`
+        digests so it never holds a partial record.
+
+        :param known: the digests already completed
+        :type known: dict of {index: digest}
+
+        """
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as fd:
+            fd.write(json.dumps(self.header()).encode("UTF-8") + b"\n")
+            run = []
+            for index in sorted(known or {}):
+                if run and index != run[0] + len(run) - 1:
+                    fd.write(RECORD.pack(run[0], len(run) - 1) + b"".join(run[1:]))
+                    run = []
+                if not run:
+                    run = [index]
+                run.append(known[index])
+            if run:
+                fd.write(RECORD.pack(run[0], len(run) - 1) + b"".join(run[1:]))
+        os.rename(tmp, self.path)
+        self.__fd = open(self.path, "ab")
+        self.__last_flush = time.time()
+
+    def add(self, start, digests):
+        """
+        Record a batch of completed digests.  The batch is written out once
+        `interval` seconds have passed since the last write.
+
+        :param start: the index of the first piece in the batch
+        :type start: int
+        :param digests: the digests of the batch
+        :type digests: list of bytes
+
+        """
+        self.__pending.append(RECORD.pack(start, len(digests)))
+        self.__pending.extend(digests)
+        if time.time() - self.__last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write any pending digests to disk.
+        """
+        if self.__fd is None:
+            return
+        self.__fd.write(b"".join(self.__pending))
+        self.__fd.flush()
+        os.fsync(self.__fd.fileno())
+        self.__pending = []
+        self.__last_flush = time.time()
+
+    def close(self):
+        """
+        Flush and close the checkpoint file.
+        """
+        if self.__fd is not None:
+            self.flush()
+            self.__fd.close()
+            self.__fd = None
+
+    def remove(self):
+        """
+        Close and delete the checkpoint, typically once the torrent is written.
+        """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
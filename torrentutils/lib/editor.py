@@ -0,0 +1,269 @@
+#
+# editor.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import os
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from .bencode import Bencached, bencode, bdecode_spans, BTFailure
+from .metadata import InvalidBencoding, InvalidPath, utf8_encode
+from .scanner import DirectoryScanner
+
+def find_torrents(root, jobs=1):
+    """
+    Find the .torrent files under `root`.
+
+    :returns: the paths of the torrent files sorted by path
+    :rtype: list of strings
+
+    """
+    scanner = DirectoryScanner(root, include=["*.torrent"], jobs=jobs)
+    return [os.path.join(root, *components)
+            for components, size, mtime in scanner.scan()]
+
+class TorrentEdit(object):
+    """
+    Changes to the fields of a .torrent file outside of its info dictionary.
+
+    Only the keys of the top level dictionary are decoded.  The unchanged
+    values, the info dictionary included, are copied through byte for byte,
+    so the info-hash is always preserved, even for torrents that were not
+    encoded canonically.  This is much faster than a load and save through
+    `TorrentMetadata`, which decodes and encodes the whole info dictionary.
+
+    A field left as None is not changed, an empty value removes it.
+
+    ** Usage **
+
+    >>> edit = TorrentEdit(trackers=[["http://tracker.example.com/announce"]])
+    >>> edit.apply_file("/tmp/test.torrent")
+    True
+
+    """
+    def __init__(self, trackers=None, comment=None, webseeds=None):
+        """
+        :param trackers: a list of lists of trackers, each list is a tier
+        :type trackers: list of list of strings
+        :param comment: an informational string
+        :type comment: string
+        :param webseeds: the webseeds, see `TorrentMetadata.webseeds`
+        :type webseeds: list of urls
+
+        """
+        self.trackers = trackers
+        self.comment = comment
+        self.webseeds = webseeds
+
+    def changes(self):
+        """
+        The new values of the top level keys, None for the keys to remove.
+
+        :rtype: dict
+
+        """
+        changes = {}
+        if self.trackers is not None:
+            trackers = [[utf8_encode(t) for t in tier] for tier in self.trackers]
+            trackers = [tier for tier in trackers if tier]
+            changes[b"announce"] = trackers[0][0] if trackers else None
+            changes[b"announce-list"] = trackers or None
+        if self.comment is not None:
+            changes[b"comment"] = utf8_encode(self.comment) or None
+        if self.webseeds is not None:
+            httpseeds = [utf8_encode(w) for w in self.webseeds if w.endswith(".php")]
+            webseeds = [utf8_encode(w) for w in self.webseeds if not w.endswith(".php")]
+            changes[b"httpseeds"] = httpseeds or None
+            changes[b"url-list"] = webseeds or None
+        return changes
+
+    def apply(self, raw):
+        """
+        Apply the changes to the contents of a .torrent file.
+
+        :param raw: the bencoded torrent
+        :type raw: bytes
+        :returns: the edited torrent
+        :rtype: bytes
+
+        :raises BTFailure: if `raw` is not a bencoded dictionary
+
+        """
+        spans = bdecode_spans(raw)
+        if b"info" not in spans:
+            raise BTFailure("Not a torrent file")
+        torrent = dict((key, Bencached(raw[start:end]))
+                       for key, (start, end) in spans.items())
+        for key, value in self.changes().items():
+            if value is None:
+                torrent.pop(key, None)
+            else:
+                torrent[key] = value
+        return bencode(torrent)
+
+    def apply_file(self, path, target=None):
+        """
+        Edit a .torrent file.  The file is written through a temporary file
+        and only if its contents change.
+
+        :param path: the torrent file to edit
+        :type path: string
+        :param target: where to save the edited torrent, `path` by default
+        :type target: string
+        :returns: True if the torrent was changed
+        :rtype: bool
+
+        :raises InvalidPath: if `path` does not exist
+        :raises InvalidBencoding: if `path` is not a valid torrent file
+
+        """
+        try:
+            with open(path, "rb") as fd:
+                raw = fd.read()
+        except (IOError, OSError):
+            raise InvalidPath("The file %s does not exist!" % path)
+        try:
+            data = self.apply(raw)
+        except BTFailure:
+            raise InvalidBencoding("The file %s contains invalid data." % path)
+
+        target = target or path
+        if data == raw and os.path.abspath(target) == os.path.abspath(path):
+            return False
+        tmp_path = target + ".part"
+        try:
+            with open(tmp_path, "wb") as fd:
+                fd.write(data)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if os.path.exists(target):
+            os.remove(target)
+        os.rename(tmp_path, target)
+        return data != raw
+
+# The edit applied by process workers, set once by the pool initializer
+_worker_editor = None
+
+def _init_worker(editor):
+    global _worker_editor
+    _worker_editor = editor
+
+def _edit_worker(paths):
+    return _worker_editor.edit(paths)
+
+class BatchEditor(object):
+    """
+    Applies a `TorrentEdit` to many torrent files with a pool of worker
+    threads or processes.  Splicing a torrent is mostly scanning its bytes, so
+    worker processes are the faster choice on several cores.
+
+    ** Usage **
+
+    >>> editor = BatchEditor(TorrentEdit(comment="Mirrored"), jobs=4)
+    >>> for path, changed, error in editor.iter_edit(find_torrents("/srv")):
+    ...     print(path, changed)
+
+    """
+    def __init__(self, edit, jobs=1, processes=False):
+        """
+        :param edit: the changes to apply
+        :type edit: TorrentEdit
+        :param jobs: the number of files edited in parallel
+        :type jobs: int
+        :param processes: use worker processes instead of threads
+        :type processes: bool
+
+        """
+        self.torrent_edit = edit
+        self.jobs = max(1, jobs or 1)
+        self.processes = processes
+
+    def __getstate__(self):
+        return self.torrent_edit
+
+    def __setstate__(self, state):
+        self.torrent_edit = state
+        self.jobs = 1
+        self.processes = False
+
+    def edit(self, paths):
+        """
+        Edit a single torrent.
+
+        :param paths: the torrent file and where to save it
+        :type paths: 2-tuple (path, target)
+        :returns: a 3-tuple (path, changed, error), the error being a message
+        or None
+        :rtype: tuple
+
+        """
+        path, target = paths
+        try:
+            return (path, self.torrent_edit.apply_file(path, target), None)
+        except (InvalidPath, InvalidBencoding, IOError, OSError) as e:
+            return (path, False, str(e))
+
+    def iter_edit(self, paths, target_dir=None, root=None):
+        """
+        Edit the torrents, yielding the results as they complete.
+
+        :param paths: the torrent files
+        :type paths: list of strings
+        :param target_dir: save the edited torrents here instead of in place,
+        at their path relative to `root`
+        :type target_dir: string
+        :param root: the directory `paths` are relative to
+        :type root: string
+        :returns: an iterator of 3-tuples (path, changed, error) in no
+        particular order
+
+        """
+        tasks = []
+        for path in paths:
+            target = None
+            if target_dir:
+                relpath = os.path.relpath(path, root) if root else os.path.basename(path)
+                target = os.path.join(target_dir, relpath)
+                parent = os.path.dirname(target)
+                if not os.path.isdir(parent):
+                    os.makedirs(parent)
+            tasks.append((path, target))
+
+        if self.jobs == 1:
+            for task in tasks:
+                yield self.edit(task)
+            return
+
+        if self.processes:
+            pool = Pool(self.jobs, _init_worker, (self,))
+            func = _edit_worker
+        else:
+            pool = ThreadPool(self.jobs)
+            func = self.edit
+
+        try:
+            for result in pool.imap_unordered(func, tasks, 16):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
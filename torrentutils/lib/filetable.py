@@ -0,0 +1,332 @@
+#
+# filetable.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import os
+from array import array
+
+from .bencode import PY2
+
+def encode_name(name):
+    """
+    Encode a path component for storage in a `FileTable`.
+    """
+    if PY2:
+        return name
+    return name.encode("UTF-8", "surrogateescape")
+
+def decode_name(name):
+    """
+    Decode a path component stored in a `FileTable`.
+    """
+    if PY2:
+        return str(name)
+    return name.decode("UTF-8", "surrogateescape")
+
+class PathTree(object):
+    """
+    The directories of a `FileTable` as a prefix tree of interned path
+    components, so every directory name is stored only once no matter how many
+    files it contains.  Node 0 is the root.
+    """
+    def __init__(self):
+        self.names = []
+        self.parents = array("l", [-1])
+        self.node_names = array("l", [-1])
+        self.__name_index = {}
+        self.__children = {}
+
+    def add(self, components):
+        """
+        Add a directory to the tree.
+
+        :param components: the path components of the directory
+        :type components: sequence of strings
+        :returns: the node of the directory
+        :rtype: int
+
+        """
+        node = 0
+        for name in components:
+            name_index = self.__name_index.get(name)
+            if name_index is None:
+                name_index = self.__name_index[name] = len(self.names)
+                self.names.append(name)
+            child = self.__children.get((node, name_index))
+            if child is None:
+                child = self.__children[(node, name_index)] = len(self.parents)
+                self.parents.append(node)
+                self.node_names.append(name_index)
+            node = child
+        return node
+
+    def components(self, node):
+        """
+        The path components of the directory at `node`.
+
+        :rtype: list of strings
+
+        """
+        components = []
+        while node > 0:
+            components.append(self.names[self.node_names[node]])
+            node = self.parents[node]
+        components.reverse()
+        return components
+
+class FileTable(object):
+    """
+    A compact table of the files in a torrent, including padding files.
+
+    Directories are interned in a `PathTree` and file names are packed into a
+    single buffer, while sizes, offsets and modification times are held in
+    arrays.  This takes a fraction of the memory of a list of tuples for
+    torrents with millions of files.
+
+    ** Usage **
+
+    >>> t = FileTable()
+    >>> t.append(["dir", "file"], 10)
+    >>> t.append(["dir", "_____padding_file_0"], 6, pad=True)
+    >>> t.path(0), t.sizes[0], t.offsets[1]
+    (('dir', 'file'), 10, 10)
+
+    """
+    def __init__(self):
+        self.tree = PathTree()
+        self.dirs = array("l")
+        self.name_ends = array("Q")
+        self.names = bytearray()
+        self.sizes = array("Q")
+        self.offsets = array("Q")
+        self.pads = bytearray()
+        self.mtimes = array("d")
+        self.total_size = 0
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def append(self, components, size, pad=False, mtime=0.0):
+        """
+        Add a file to the end of the table.
+
+        :param components: the path components of the file
+        :type components: sequence of strings
+        :param size: the length of the file
+        :type size: int
+        :param pad: True if this is a padding file
+        :type pad: bool
+        :param mtime: the modification time of the file
+        :type mtime: float
+
+        """
+        components = tuple(components)
+        self.dirs.append(self.tree.add(components[:-1]))
+        if components:
+            self.names.extend(encode_name(components[-1]))
+        self.name_ends.append(len(self.names))
+        self.sizes.append(size)
+        self.offsets.append(self.total_size)
+        self.pads.append(1 if pad else 0)
+        self.mtimes.append(mtime or 0.0)
+        self.total_size += size
+
+    def path(self, index):
+        """
+        The path components of the file at `index`.
+
+        :rtype: tuple of strings
+
+        """
+        start = self.name_ends[index - 1] if index else 0
+        end = self.name_ends[index]
+        components = self.tree.components(self.dirs[index])
+        if end > start or components:
+            components.append(decode_name(self.names[start:end]))
+        return tuple(components)
+
+    def iter_paths(self, prefix=None):
+        """
+        Iterate over the paths of every file, much faster than calling path()
+        for each one since the directory paths are only built once.
+
+        :param prefix: joined in front of every path with os.path.join, if None
+        the path components are joined with "/"
+        :type prefix: string
+        :returns: an iterator of joined paths
+
+        """
+        dirs = {}
+        start = 0
+        for index, end in enumerate(self.name_ends):
+            node = self.dirs[index]
+            head = dirs.get(node)
+            if head is None:
+                components = self.tree.components(node)
+                if prefix is None:
+                    head = "".join(c + "/" for c in components)
+                else:
+                    head = os.path.join(prefix, *(components + [""]))
+                dirs[node] = head
+            if end > start:
+                yield head + decode_name(self.names[start:end])
+            elif prefix is None:
+                yield head.rstrip("/")
+            else:
+                yield prefix
+            start = end
+
+    def remove(self, index):
+        """
+        Remove the file at `index`, the following files move down.
+        """
+        start = self.name_ends[index - 1] if index else 0
+        length = self.name_ends[index] - start
+        del self.names[start:self.name_ends[index]]
+        for i in range(index + 1, len(self)):
+            self.name_ends[i] -= length
+            self.offsets[i] -= self.sizes[index]
+        self.total_size -= self.sizes[index]
+        for a in (self.dirs, self.name_ends, self.sizes, self.offsets,
+                  self.pads, self.mtimes):
+            del a[index]
+
+    def file_list(self, prefix=None):
+        """
+        A read only view of the non-padding files as (path, size) tuples.
+
+        :param prefix: joined in front of every path with os.path.join, if None
+        the path components are joined with "/"
+        :type prefix: string
+        :rtype: FileList
+
+        """
+        return FileList(self, prefix)
+
+    def storage_entries(self, root):
+        """
+        A view of the files as (path, size) tuples for a `FileStorage`, the
+        paths being under `root` and padding files having a path of None.
+
+        :rtype: StorageEntries
+
+        """
+        return StorageEntries(self, root)
+
+class FileList(object):
+    """
+    A sequence of (path, size) tuples for the non-padding files in a
+    `FileTable`, compatible with the list TorrentMetadata.files used to be.
+    """
+    def __init__(self, table, prefix=None):
+        self.table = table
+        self.prefix = prefix
+        if any(table.pads):
+            self.indexes = array("L", (i for i, p in enumerate(table.pads) if not p))
+        else:
+            self.indexes = None
+
+    def __len__(self):
+        if self.indexes is None:
+            return len(self.table)
+        return len(self.indexes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("file index out of range")
+        if self.indexes is not None:
+            index = self.indexes[index]
+        path = self.table.path(index)
+        if self.prefix is None:
+            path = "/".join(path)
+        else:
+            path = os.path.join(self.prefix, *path)
+        return (path, self.table.sizes[index])
+
+    def __iter__(self):
+        pads = self.table.pads
+        sizes = self.table.sizes
+        for index, path in enumerate(self.table.iter_paths(self.prefix)):
+            if not pads[index]:
+                yield (path, sizes[index])
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+class StorageEntries(object):
+    """
+    A sequence of (path, size) tuples for every file in a `FileTable` as
+    expected by `FileStorage`.
+    """
+    def __init__(self, table, root):
+        self.table = table
+        self.root = root
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("file index out of range")
+        if self.table.pads[index]:
+            return (None, self.table.sizes[index])
+        return (os.path.join(self.root, *self.table.path(index)),
+                self.table.sizes[index])
+
+    def __iter__(self):
+        pads = self.table.pads
+        sizes = self.table.sizes
+        for index, path in enumerate(self.table.iter_paths(self.root)):
+            yield (None if pads[index] else path, sizes[index])
+
+class PieceList(object):
+    """
+    A read only view of a string of concatenated SHA1 piece hashes as a
+    sequence of 20 byte digests.
+    """
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def __len__(self):
+        return len(self.pieces) // 20
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("piece index out of range")
+        return self.pieces[index * 20:index * 20 + 20]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
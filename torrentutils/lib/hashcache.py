@@ -0,0 +1,226 @@
+#
+# hashcache.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pieces (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    piece_size INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    digests BLOB NOT NULL,
+    tail BLOB,
+    tail_length INTEGER,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime, piece_size, offset)
+);
+CREATE INDEX IF NOT EXISTS pieces_last_used ON pieces (last_used);
+"""
+
+def file_pieces(storage, index):
+    """
+    Work out which pieces of `storage` are fully determined by the file at
+    `index`.  These are the pieces lying entirely within the file, plus the
+    last piece if the rest of it is only padding.
+
+    :returns: a 3-tuple (first, stop, tail) where first and stop bound the
+    pieces inside the file and tail is the index of the padded last piece or
+    None
+    :rtype: tuple
+
+    """
+    piece_size = storage.piece_size
+    start = storage.offsets[index]
+    end = start + storage.files[index][1]
+
+    first = (start + piece_size - 1) // piece_size
+    stop = max(first, end // piece_size)
+
+    tail = None
+    last = (end - 1) // piece_size
+    if end % piece_size and last * piece_size >= start:
+        # The last piece is file data followed by padding or the end of the
+        # torrent, make sure nothing else shares it
+        piece_end = last * piece_size + storage.piece_length(last)
+        tail = last
+        i = index + 1
+        while i < len(storage.files) and storage.offsets[i] < piece_end:
+            if storage.files[i][0] is not None and storage.files[i][1]:
+                tail = None
+                break
+            i += 1
+    return (first, stop, tail)
+
+class PieceHashCache(object):
+    """
+    A persistent cache of piece hashes keyed by the identity of the files they
+    were read from, so torrents for unchanged data can be created again without
+    reading it.
+
+    Entries are keyed by (device, inode, size, mtime, piece size, alignment
+    offset), the alignment offset being where the file starts within a piece.
+    The cache is kept below `max_size` bytes by evicting the least recently
+    used entries.
+
+    ** Usage **
+
+    >>> cache = PieceHashCache("/tmp/pieces.db")
+    >>> t.save("/tmp/test.torrent", cache=cache)
+    >>> cache.stats()
+    {'hits': 10, 'misses': 0, 'pieces': 5120, 'evictions': 0}
+
+    """
+    def __init__(self, path, max_size=256 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.pieces = 0
+        self.evictions = 0
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __key(self, storage, index):
+        path, length = storage.files[index]
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size != length:
+            return None
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime,
+                storage.piece_size, storage.offsets[index] % storage.piece_size)
+
+    def lookup(self, storage):
+        """
+        Find the cached piece hashes for the files of `storage`.
+
+        :param storage: the storage about to be hashed
+        :type storage: FileStorage
+        :returns: the known piece digests
+        :rtype: dict of {index: digest}
+
+        """
+        known = {}
+        now = time.time()
+        for index, (path, length) in enumerate(storage.files):
+            if path is None or not length:
+                continue
+            first, stop, tail = file_pieces(storage, index)
+            if first == stop and tail is None:
+                continue
+            key = self.__key(storage, index)
+            row = key and self.db.execute(
+                "SELECT digests, tail, tail_length FROM pieces WHERE dev = ? "
+                "AND ino = ? AND size = ? AND mtime = ? AND piece_size = ? "
+                "AND offset = ?", key).fetchone()
+            if not row:
+                self.misses += 1
+                continue
+
+            digests = bytes(row[0])
+            for i in range(first, stop):
+                pos = (i - first) * 20
+                known[i] = digests[pos:pos + 20]
+            if tail is not None and row[1] is not None and \
+                    row[2] == storage.piece_length(tail):
+                known[tail] = bytes(row[1])
+            self.db.execute(
+                "UPDATE pieces SET last_used = ? WHERE dev = ? AND ino = ? AND "
+                "size = ? AND mtime = ? AND piece_size = ? AND offset = ?",
+                (now,) + key)
+            self.hits += 1
+        self.db.commit()
+        self.pieces += len(known)
+        return known
+
+    def store(self, storage, pieces):
+        """
+        Add the piece hashes of every file in `storage` to the cache.
+
+        :param storage: the storage that was hashed
+        :type storage: FileStorage
+        :param pieces: the concatenated digests of every piece in `storage`
+        :type pieces: bytes
+
+        """
+        now = time.time()
+        for index, (path, length) in enumerate(storage.files):
+            if path is None or not length:
+                continue
+            first, stop, tail = file_pieces(storage, index)
+            if first == stop and tail is None:
+                continue
+            key = self.__key(storage, index)
+            if not key:
+                continue
+            self.db.execute(
+                "INSERT OR REPLACE INTO pieces VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                key + (sqlite3.Binary(pieces[first * 20:stop * 20]),
+                       None if tail is None else
+                       sqlite3.Binary(pieces[tail * 20:tail * 20 + 20]),
+                       None if tail is None else storage.piece_length(tail),
+                       now))
+        self.db.commit()
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in
+        `max_size` bytes.
+        """
+        size = self.db.execute(
+            "SELECT COALESCE(SUM(LENGTH(digests) + 80), 0) FROM pieces").fetchone()[0]
+        while size > self.max_size:
+            row = self.db.execute(
+                "SELECT rowid, LENGTH(digests) + 80 FROM pieces "
+                "ORDER BY last_used LIMIT 1").fetchone()
+            if not row:
+                break
+            self.db.execute("DELETE FROM pieces WHERE rowid = ?", (row[0],))
+            size -= row[1]
+            self.evictions += 1
+        self.db.commit()
+
+    def stats(self):
+        """
+        The hit and miss counts since the cache was opened.
+
+        :returns: files found and not found, pieces served from the cache and
+        entries evicted
+        :rtype: dict
+
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "pieces": self.pieces,
+            "evictions": self.evictions,
+        }
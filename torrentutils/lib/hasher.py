@@ -0,0 +1,228 @@
+#
+# hasher.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+from multiprocessing import Pool
+
+from .pipeline import HashPipeline, QUEUE_DEPTH, BUFFER_MEMORY
+from .storage import PieceReader
+from .zeros import hash_piece
+
+# The amount of data each worker hashes per task.  Workers read their ranges
+# sequentially, so larger batches mean longer sequential runs on disk.
+BATCH_SIZE = 32 * 1024 * 1024
+
+def hash_range(storage, start, stop, use_mmap=False, ignore_errors=False,
+               io_policy=None):
+    """
+    Hash the pieces `start` to `stop` (exclusive) of `storage` in order.
+
+    :param storage: the storage to read from
+    :type storage: FileStorage
+    :param start: the first piece to hash
+    :type start: int
+    :param stop: the piece to stop at
+    :type stop: int
+    :param use_mmap: map the files instead of reading them
+    :type use_mmap: bool
+    :param ignore_errors: if True, a piece that cannot be read gets a digest
+    of None instead of raising
+    :type ignore_errors: bool
+    :param io_policy: how to read the files
+    :type io_policy: IOPolicy
+    :returns: the list of piece digests
+    :rtype: list of bytes
+
+    """
+    digests = []
+    view = memoryview(bytearray(storage.piece_size))
+    with PieceReader(storage, use_mmap, io_policy) as reader:
+        for index in range(start, stop):
+            piece = view[:storage.piece_length(index)]
+            try:
+                zero_runs = reader.read_into(index * storage.piece_size, piece,
+                                             skip_zeros=True)
+                digests.append(hash_piece(piece, zero_runs))
+            except (IOError, OSError):
+                if not ignore_errors:
+                    raise
+                digests.append(None)
+    return digests
+
+# The hasher used by process workers, set once by the pool initializer so it
+# is not pickled with every task.
+_worker_hasher = None
+
+def _init_worker(hasher):
+    global _worker_hasher
+    _worker_hasher = hasher
+
+def _hash_range_worker(bounds):
+    return _worker_hasher.hash_range(bounds)
+
+class PieceHasher(object):
+    """
+    Hashes the pieces of a `FileStorage` with worker threads or processes.
+    The piece space is split into contiguous batches and the digests are
+    gathered back in piece order so the result is identical to hashing
+    serially.
+
+    Threads go through a `HashPipeline`, where a reader prefetches the data
+    into a bounded pool of buffers while `jobs` threads hash it, so the disk
+    and the CPU are busy at the same time.  This is usually enough since
+    hashlib releases the GIL while hashing, processes can be used when the
+    interpreter does not, each of them reading and hashing whole batches.
+
+    ** Usage **
+
+    >>> hasher = PieceHasher(storage, jobs=8)
+    >>> pieces = b"".join(hasher.hash_pieces())
+
+    """
+    def __init__(self, storage, jobs=1, processes=False, use_mmap=False,
+                 ignore_errors=False, queue_depth=QUEUE_DEPTH,
+                 buffer_memory=BUFFER_MEMORY, io_policy=None):
+        self.storage = storage
+        self.jobs = max(1, jobs or 1)
+        self.processes = processes
+        self.use_mmap = use_mmap
+        self.ignore_errors = ignore_errors
+        self.queue_depth = queue_depth
+        self.buffer_memory = buffer_memory
+        self.io_policy = io_policy
+
+    def hash_range(self, bounds):
+        """
+        Hash a batch of pieces, see `hash_range`.
+        """
+        return hash_range(self.storage, bounds[0], bounds[1], self.use_mmap,
+                          self.ignore_errors, self.io_policy)
+
+    def batches(self, start=0, stop=None):
+        """
+        Split the pieces between `start` and `stop` into batches.
+
+        :returns: a list of 2-tuples (start, stop)
+
+        """
+        if stop is None:
+            stop = self.storage.num_pieces
+        count = stop - start
+        size = max(1, BATCH_SIZE // self.storage.piece_size)
+        if self.jobs > 1:
+            # Keep every worker busy even for small torrents
+            size = max(1, min(size, count // (self.jobs * 4)))
+        return [(i, min(i + size, stop)) for i in range(start, stop, size)]
+
+    def iter_batches(self, batches=None):
+        """
+        Hash `batches` of pieces, yielding the results in batch order as soon
+        as they are available.
+
+        :param batches: the batches to hash, defaults to all the pieces
+        :type batches: list of 2-tuples (start, stop)
+        :returns: an iterator of 2-tuples (start, digests)
+
+        """
+        if batches is None:
+            batches = self.batches()
+
+        if not self.processes:
+            pipeline = HashPipeline(self.storage, 1, self.jobs, self.queue_depth,
+                                    self.buffer_memory, self.use_mmap,
+                                    self.ignore_errors, self.io_policy)
+            for result in pipeline.iter_batches(batches):
+                yield result
+            return
+
+        if self.jobs == 1:
+            results = (self.hash_range(b) for b in batches)
+            pool = None
+        else:
+            pool = Pool(self.jobs, _init_worker, (self,))
+            results = pool.imap(_hash_range_worker, batches)
+
+        try:
+            for start, stop in batches:
+                yield (start, next(results))
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+    def iter_pieces(self, progress=None, known=None, callback=None):
+        """
+        Hash every piece in the storage, yielding the digests in piece order.
+
+        :param progress: a function to be called as pieces are hashed
+        :type progress: function(num_completed, num_pieces)
+        :param known: digests that are already known and need not be hashed
+        :type known: dict of {index: digest}
+        :param callback: a function to be called with every batch of newly
+        hashed pieces, in piece order
+        :type callback: function(start, digests)
+        :returns: an iterator of piece digests
+
+        """
+        num_pieces = self.storage.num_pieces
+        known = known or {}
+
+        # Only hash the runs of pieces that are not known
+        batches = []
+        start = None
+        for index in range(num_pieces + 1):
+            if index < num_pieces and index not in known:
+                if start is None:
+                    start = index
+            elif start is not None:
+                batches.extend(self.batches(start, index))
+                start = None
+
+        completed = len(known)
+        if progress:
+            progress(completed, num_pieces)
+
+        results = self.iter_batches(batches)
+        index = 0
+        while index < num_pieces:
+            if index in known:
+                yield known[index]
+                index += 1
+                continue
+            start, digests = next(results)
+            if callback:
+                callback(start, digests)
+            for digest in digests:
+                yield digest
+            index += len(digests)
+            completed += len(digests)
+            if progress:
+                progress(completed, num_pieces)
+
+    def hash_pieces(self, progress=None, known=None, callback=None):
+        """
+        Hash every piece in the storage, see `iter_pieces`.
+
+        :returns: the piece digests in piece order
+        :rtype: list of bytes
+
+        """
+        return list(self.iter_pieces(progress, known, callback))
@@ -0,0 +1,438 @@
+#
+# index.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import os
+import sqlite3
+import struct
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from .metadata import InvalidBencoding, InvalidPath, TorrentMetadata
+from .scanner import DirectoryScanner
+from .zeros import zero_digest
+
+# Bumped when the schema changes, older indexes are emptied and filled again
+# by the next refresh
+SCHEMA_VERSION = 2
+
+# The number of torrents loaded between commits, this bounds the memory used
+# by results waiting to be stored
+REFRESH_BATCH = 256
+
+# The number of digests looked up per query
+LOOKUP_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS torrents (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    info_hash TEXT NOT NULL,
+    info_hash_v2 TEXT NOT NULL,
+    total_size INTEGER NOT NULL,
+    num_files INTEGER NOT NULL,
+    private INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS torrents_name ON torrents (name);
+CREATE INDEX IF NOT EXISTS torrents_info_hash ON torrents (info_hash);
+CREATE INDEX IF NOT EXISTS torrents_info_hash_v2 ON torrents (info_hash_v2);
+CREATE TABLE IF NOT EXISTS files (
+    torrent INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_torrent ON files (torrent);
+CREATE INDEX IF NOT EXISTS files_path ON files (path);
+CREATE INDEX IF NOT EXISTS files_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_signature ON files (length, name);
+CREATE TABLE IF NOT EXISTS trackers (
+    torrent INTEGER NOT NULL,
+    tier INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    host TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trackers_torrent ON trackers (torrent);
+CREATE INDEX IF NOT EXISTS trackers_url ON trackers (url);
+CREATE INDEX IF NOT EXISTS trackers_host ON trackers (host);
+CREATE TABLE IF NOT EXISTS pieces (
+    piece_size INTEGER NOT NULL,
+    digest INTEGER NOT NULL,
+    torrent INTEGER NOT NULL,
+    PRIMARY KEY (piece_size, digest, torrent)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS pieces_torrent ON pieces (torrent);
+"""
+
+# The columns of a torrent returned by the queries
+COLUMNS = ("path", "name", "info_hash", "info_hash_v2", "total_size",
+           "num_files", "private")
+
+def _is_pattern(s):
+    return any(c in s for c in "*?[")
+
+def digest_key(digest):
+    """
+    The key of a piece digest in the index, its first 8 bytes as a signed
+    integer.  Keys of different pieces collide with a negligible probability
+    and take less than half the space of the digests.
+    """
+    return struct.unpack(">q", digest[:8])[0]
+
+def piece_keys(pieces, piece_size):
+    """
+    The distinct keys of the `pieces` of a torrent, skipping the pieces
+    of zeros that padding and empty regions produce in unrelated torrents.
+
+    :param pieces: the concatenated piece digests
+    :type pieces: bytes
+    :param piece_size: the piece size in bytes
+    :type piece_size: int
+    :rtype: set of ints
+
+    """
+    zeros = zero_digest(piece_size)
+    return set(digest_key(pieces[i:i + 20]) for i in range(0, len(pieces), 20)
+               if pieces[i:i + 20] != zeros)
+
+def read_torrent(task):
+    """
+    Load a torrent for the index.
+
+    :param task: the torrent file with the mtime and size it was found with
+    :type task: 3-tuple (path, mtime, size)
+    :returns: the task and the torrent's row, files and trackers, or the task
+    and an error message
+    :rtype: 2-tuple
+
+    """
+    path, mtime, size = task
+    md = TorrentMetadata()
+    try:
+        md.load(path)
+        files = list(md.files)
+        trackers = md.trackers
+        pieces = piece_keys(md.pieces, md.piece_size * 1024)
+    except (InvalidPath, InvalidBencoding) as e:
+        return (task, str(e))
+    row = (md.name, md.info_hash, md.info_hash_v2,
+           sum(length for f, length in files), len(files), int(md.private))
+    return (task, (row, files, trackers, md.piece_size * 1024, pieces))
+
+class TorrentIndex(object):
+    """
+    A SQLite index of the metadata of a collection of .torrent files, so
+    lookups do not need to load every torrent again.
+
+    The index is refreshed from folders of torrents, only the torrents that
+    are new or whose mtime or size changed are loaded again, and torrents that
+    are gone are dropped.  Exact file names, paths, tracker URLs, tracker
+    hosts and info-hashes are looked up through indexes, shell patterns scan
+    the table.
+
+    The v1 piece digests of every torrent are indexed by piece size and digest
+    so the torrents sharing data with a torrent are found without loading
+    them, see `:meth:shared`.  The index lives on disk, so memory use does not
+    grow with the number of digests.
+
+    ** Usage **
+
+    >>> index = TorrentIndex("/tmp/torrents.db")
+    >>> index.refresh("/srv/torrents", jobs=4)
+    {'added': 10, 'updated': 0, 'removed': 0, 'unchanged': 0, 'failed': 0}
+    >>> index.query(tracker="tracker.example.com")
+    [{'path': '/srv/torrents/a.torrent', 'name': 'a', ...}]
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            self.db.executescript(SCHEMA)
+            for table in ("torrents", "files", "trackers", "pieces"):
+                self.db.execute("DELETE FROM %s" % table)
+            self.db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def refresh(self, root, jobs=1, processes=False, progress=None):
+        """
+        Bring the index up to date with the .torrent files under `root`.
+
+        :param root: the folder to index
+        :type root: string
+        :param jobs: the number of torrents loaded in parallel
+        :type jobs: int
+        :param processes: load with worker processes instead of threads
+        :type processes: bool
+        :param progress: a function to be called as torrents are loaded
+        :type progress: function(num_completed, num_torrents)
+        :returns: the number of torrents added, updated, removed, unchanged
+        and failed to load
+        :rtype: dict
+
+        :raises InvalidPath: if `root` is not a folder
+
+        """
+        if not os.path.isdir(root):
+            raise InvalidPath("The path %s is not a folder!" % root)
+        root = os.path.abspath(root)
+        jobs = max(1, jobs or 1)
+        scanner = DirectoryScanner(root, include=["*.torrent"], jobs=jobs)
+
+        prefix = os.path.join(root, "")
+        indexed = {}
+        for id, path, mtime, size in self.db.execute(
+                "SELECT id, path, mtime, size FROM torrents"):
+            if path.startswith(prefix):
+                indexed[path] = (id, mtime, size)
+
+        stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0,
+                 "failed": 0}
+        tasks = []
+        for components, size, mtime in scanner.scan():
+            path = os.path.join(root, *components)
+            old = indexed.pop(path, None)
+            if old and old[1] == mtime and old[2] == size:
+                stats["unchanged"] += 1
+            else:
+                tasks.append((path, mtime, size))
+
+        for id, mtime, size in indexed.values():
+            self.__delete(id)
+            stats["removed"] += 1
+
+        pool = None
+        if jobs > 1 and len(tasks) > 1:
+            pool = Pool(jobs) if processes else ThreadPool(jobs)
+
+        try:
+            if progress:
+                progress(0, len(tasks))
+            completed = 0
+            for start in range(0, len(tasks), REFRESH_BATCH):
+                batch = tasks[start:start + REFRESH_BATCH]
+                if pool:
+                    results = pool.imap_unordered(read_torrent, batch, 16)
+                else:
+                    results = (read_torrent(task) for task in batch)
+                for (path, mtime, size), result in results:
+                    old = self.db.execute("SELECT id FROM torrents WHERE path = ?",
+                                          (path,)).fetchone()
+                    if old:
+                        self.__delete(old[0])
+                    if isinstance(result, str):
+                        stats["failed"] += 1
+                    else:
+                        self.__insert(path, mtime, size, *result)
+                        stats["updated" if old else "added"] += 1
+                    completed += 1
+                    if progress:
+                        progress(completed, len(tasks))
+                self.db.commit()
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+            self.db.commit()
+        return stats
+
+    def __delete(self, id):
+        self.db.execute("DELETE FROM files WHERE torrent = ?", (id,))
+        self.db.execute("DELETE FROM trackers WHERE torrent = ?", (id,))
+        self.db.execute("DELETE FROM pieces WHERE torrent = ?", (id,))
+        self.db.execute("DELETE FROM torrents WHERE id = ?", (id,))
+
+    def __insert(self, path, mtime, size, row, files, trackers, piece_size,
+                 pieces):
+        cursor = self.db.execute(
+            "INSERT INTO torrents (path, mtime, size, name, info_hash, "
+            "info_hash_v2, total_size, num_files, private) VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?)", (path, mtime, size) + row)
+        id = cursor.lastrowid
+        self.db.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?)",
+            ((id, f, f.rsplit("/", 1)[-1], length) for f, length in files))
+        self.db.executemany(
+            "INSERT INTO trackers VALUES (?, ?, ?, ?)",
+            ((id, tier, url, urlparse(url).hostname or "")
+             for tier, urls in enumerate(trackers) for url in urls))
+        self.db.executemany(
+            "INSERT INTO pieces VALUES (?, ?, ?)",
+            ((piece_size, key, id) for key in pieces))
+
+    def query(self, file=None, tracker=None, info_hash=None, name=None,
+              private=None):
+        """
+        Find the torrents matching all of the given criteria.
+
+        :param file: a file name or path within the torrent, or a shell pattern
+        matched against the path
+        :type file: string
+        :param tracker: a tracker URL or host name, or a shell pattern matched
+        against the URL
+        :type tracker: string
+        :param info_hash: a v1 or v2 info-hash in hex
+        :type info_hash: string
+        :param name: the torrent name or a shell pattern
+        :type name: string
+        :param private: only private or only public torrents
+        :type private: bool
+        :returns: the matching torrents sorted by path, see `COLUMNS`
+        :rtype: list of dicts
+
+        """
+        where = []
+        args = []
+        if file is not None:
+            if _is_pattern(file):
+                where.append("id IN (SELECT torrent FROM files WHERE path GLOB ?)")
+                args.append(file)
+            else:
+                where.append("id IN (SELECT torrent FROM files WHERE name = ? "
+                             "UNION SELECT torrent FROM files WHERE path = ?)")
+                args += [file, file]
+        if tracker is not None:
+            if _is_pattern(tracker):
+                where.append("id IN (SELECT torrent FROM trackers WHERE url GLOB ?)")
+                args.append(tracker)
+            else:
+                where.append("id IN (SELECT torrent FROM trackers WHERE url = ? "
+                             "UNION SELECT torrent FROM trackers WHERE host = ?)")
+                args += [tracker, tracker.lower()]
+        if info_hash is not None:
+            where.append("(info_hash = ? OR info_hash_v2 = ?)")
+            args += [info_hash.lower()] * 2
+        if name is not None:
+            where.append("name GLOB ?" if _is_pattern(name) else "name = ?")
+            args.append(name)
+        if private is not None:
+            where.append("private = ?")
+            args.append(int(private))
+
+        sql = "SELECT %s FROM torrents" % ", ".join(COLUMNS)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY path"
+        return [dict(zip(COLUMNS, row)) for row in self.db.execute(sql, args)]
+
+    def shared(self, path, min_file_size=1):
+        """
+        Find the indexed torrents sharing data with a torrent, by their piece
+        digests and by the size and name of their files.  Torrents sharing
+        pieces have the same data at the same alignment and can be cross
+        seeded, torrents only sharing files likely hold copies of the same
+        files under a different layout.
+
+        :param path: the torrent file, it does not need to be indexed
+        :type path: string
+        :param min_file_size: files smaller than this are not matched
+        :type min_file_size: int
+        :returns: the matching torrents, see `COLUMNS`, with the number of
+        pieces, files and bytes they share, most shared bytes first.  The
+        torrent itself, and copies of it with the same info-hash, are left
+        out.
+        :rtype: list of dicts
+
+        :raises InvalidPath: if `path` does not exist
+        :raises InvalidBencoding: if `path` is not a valid torrent file
+
+        """
+        md = TorrentMetadata()
+        md.load(path)
+        piece_size = md.piece_size * 1024
+        keys = list(piece_keys(md.pieces, piece_size))
+
+        shared = {}
+        def match(id):
+            if id not in shared:
+                shared[id] = {"shared_pieces": 0, "shared_files": 0,
+                              "shared_bytes": 0}
+            return shared[id]
+
+        for i in range(0, len(keys), LOOKUP_BATCH):
+            batch = keys[i:i + LOOKUP_BATCH]
+            for id, count in self.db.execute(
+                    "SELECT torrent, COUNT(*) FROM pieces WHERE piece_size = ? "
+                    "AND digest IN (%s) GROUP BY torrent" %
+                    ", ".join("?" * len(batch)), [piece_size] + batch):
+                match(id)["shared_pieces"] += count
+
+        signatures = set((length, f.rsplit("/", 1)[-1]) for f, length in md.files
+                         if length >= max(1, min_file_size))
+        for length, name in signatures:
+            for id, in self.db.execute(
+                    "SELECT DISTINCT torrent FROM files WHERE length = ? AND "
+                    "name = ?", (length, name)):
+                m = match(id)
+                m["shared_files"] += 1
+                m["shared_bytes"] += length
+
+        total_size = sum(length for f, length in md.files)
+        results = []
+        for id, counts in shared.items():
+            row = self.db.execute("SELECT %s FROM torrents WHERE id = ?" %
+                                  ", ".join(COLUMNS), (id,)).fetchone()
+            if row is None:
+                continue
+            torrent = dict(zip(COLUMNS, row))
+            if (md.info_hash and torrent["info_hash"] == md.info_hash) or \
+                    (md.info_hash_v2 and
+                     torrent["info_hash_v2"] == md.info_hash_v2):
+                continue
+            # Pieces count towards the shared bytes when no file matched, the
+            # last piece may be short so neither torrent's size is exceeded
+            piece_bytes = min(counts["shared_pieces"] * piece_size, total_size,
+                              torrent["total_size"])
+            counts["shared_bytes"] = max(counts["shared_bytes"], piece_bytes)
+            torrent.update(counts)
+            results.append(torrent)
+        results.sort(key=lambda t: (-t["shared_bytes"], t["path"]))
+        return results
+
+    def stats(self):
+        """
+        The size of the index.
+
+        :returns: the number of torrents, files, tracker entries and piece
+        digests
+        :rtype: dict
+
+        """
+        count = lambda table: self.db.execute(
+            "SELECT COUNT(*) FROM %s" % table).fetchone()[0]
+        return {
+            "torrents": count("torrents"),
+            "files": count("files"),
+            "trackers": count("trackers"),
+            "pieces": count("pieces"),
+        }
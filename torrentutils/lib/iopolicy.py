@@ -0,0 +1,275 @@
+#
+# iopolicy.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import mmap
+import os
+import threading
+
+# The I/O modes
+BUFFERED = "buffered"
+FADVISE = "fadvise"
+DIRECT = "direct"
+MODES = (BUFFERED, FADVISE, DIRECT)
+
+# O_DIRECT reads must be aligned to the logical block size of the device, a
+# page covers every common device
+ALIGNMENT = mmap.PAGESIZE
+
+# The default read window of direct I/O
+DIRECT_WINDOW = 1024 * 1024
+
+def page_cache_size():
+    """
+    The size of the page cache of the host.
+
+    :returns: the size in bytes or None if it is not known on this platform
+    :rtype: int
+
+    """
+    try:
+        with open("/proc/meminfo") as fd:
+            for line in fd:
+                if line.startswith("Cached:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+class IOStats(object):
+    """
+    Counts the reads done under an `IOPolicy`, shared by all the readers
+    using it.
+    """
+    def __init__(self):
+        self.bytes_read = 0
+        self.reads = 0
+        self.bytes_dropped = 0
+        self.cache_start = page_cache_size()
+        self.__lock = threading.Lock()
+
+    def add(self, bytes_read, dropped=0):
+        with self.__lock:
+            self.bytes_read += bytes_read
+            self.reads += 1
+            self.bytes_dropped += dropped
+
+    def summary(self):
+        """
+        The counters so far.  The page cache growth is measured over the whole
+        host since the stats were created, so it also includes the activity of
+        other processes.
+
+        :returns: bytes read from the files, read calls, bytes dropped from the
+        page cache with fadvise and the page cache growth in bytes (None if
+        unknown)
+        :rtype: dict
+
+        """
+        cache = page_cache_size()
+        growth = None
+        if cache is not None and self.cache_start is not None:
+            growth = cache - self.cache_start
+        return {
+            "bytes_read": self.bytes_read,
+            "reads": self.reads,
+            "bytes_dropped": self.bytes_dropped,
+            "page_cache_growth": growth,
+        }
+
+class _BufferedFile(object):
+    """
+    A file read through the page cache as usual.
+    """
+    def __init__(self, path, policy):
+        self.path = path
+        self.policy = policy
+        self.fd = open(path, "rb", 0)
+
+    def fileno(self):
+        return self.fd.fileno()
+
+    def close(self):
+        self.fd.close()
+
+    def readinto_at(self, view, offset):
+        """
+        Fill `view` with the data at `offset`.
+
+        :raises IOError: if the file is shorter than expected
+        """
+        self.fd.seek(offset)
+        pos = 0
+        while pos < len(view):
+            read = self.fd.readinto(view[pos:])
+            if not read:
+                raise IOError("%s is shorter than expected" % self.path)
+            pos += read
+        self.policy.stats.add(pos)
+
+class _FadviseFile(_BufferedFile):
+    """
+    A file read sequentially with posix_fadvise hints.  The kernel is asked to
+    read ahead `readahead` bytes and to drop the pages once they are read, so
+    hashing does not push other data out of the page cache.
+    """
+    def __init__(self, path, policy):
+        _BufferedFile.__init__(self, path, policy)
+        self.advised = 0
+        os.posix_fadvise(self.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def readinto_at(self, view, offset):
+        end = offset + len(view)
+        if self.policy.readahead and end > self.advised:
+            start = max(offset, self.advised)
+            self.advised = start + self.policy.readahead
+            os.posix_fadvise(self.fileno(), start, self.advised - start,
+                             os.POSIX_FADV_WILLNEED)
+        self.fd.seek(offset)
+        pos = 0
+        while pos < len(view):
+            read = self.fd.readinto(view[pos:])
+            if not read:
+                raise IOError("%s is shorter than expected" % self.path)
+            pos += read
+        os.posix_fadvise(self.fileno(), offset, pos, os.POSIX_FADV_DONTNEED)
+        self.policy.stats.add(pos, pos)
+
+class _DirectFile(object):
+    """
+    A file read with O_DIRECT, bypassing the page cache.  Reads are aligned
+    windows into a page aligned buffer, the requested data is copied out of
+    the window, so consecutive small reads are served by a single large one.
+    """
+    def __init__(self, path, policy):
+        self.path = path
+        self.policy = policy
+        self.fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+        size = max(policy.readahead, DIRECT_WINDOW)
+        size = (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        # Anonymous maps are page aligned, as O_DIRECT requires
+        self.window = mmap.mmap(-1, size)
+        self.view = memoryview(self.window)
+        self.window_offset = 0
+        self.window_length = 0
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        self.view.release()
+        self.window.close()
+        os.close(self.fd)
+
+    def __load(self, offset):
+        """
+        Read the aligned window containing `offset`.
+        """
+        start = offset - offset % ALIGNMENT
+        if hasattr(os, "preadv"):
+            read = os.preadv(self.fd, [self.view], start)
+        else:
+            os.lseek(self.fd, start, os.SEEK_SET)
+            read = os.readv(self.fd, [self.view])
+        self.window_offset = start
+        self.window_length = read
+        self.policy.stats.add(read)
+
+    def readinto_at(self, view, offset):
+        pos = 0
+        while pos < len(view):
+            skip = offset + pos - self.window_offset
+            if not 0 <= skip < self.window_length:
+                self.__load(offset + pos)
+                skip = offset + pos - self.window_offset
+                if skip >= self.window_length:
+                    raise IOError("%s is shorter than expected" % self.path)
+            size = min(len(view) - pos, self.window_length - skip)
+            view[pos:pos + size] = self.view[skip:skip + size]
+            pos += size
+
+class IOPolicy(object):
+    """
+    How the hashing and verify readers read the data files.
+
+    ``buffered``
+        Plain reads through the page cache.
+    ``fadvise``
+        Sequential reads that tell the kernel to read `readahead` bytes ahead
+        and to drop every page once it is read, so hashing does not evict the
+        pages other processes are using.  Note pages that were already cached
+        are dropped as well.
+    ``direct``
+        O_DIRECT reads of `readahead` sized aligned windows that never go
+        through the page cache.  Not every filesystem supports this, tmpfs for
+        one does not.
+
+    Every read is counted in `stats`.  Worker processes count their reads in
+    their own copy, so the stats only cover thread workers.
+
+    ** Usage **
+
+    >>> policy = IOPolicy(FADVISE, readahead=8 * 1024 * 1024)
+    >>> t.save("/tmp/test.torrent", io_policy=policy)
+    >>> policy.stats.summary()
+    {'bytes_read': 104857600, 'reads': 25, 'bytes_dropped': 104857600,
+     'page_cache_growth': 4096}
+
+    """
+    def __init__(self, mode=BUFFERED, readahead=0):
+        """
+        :param mode: one of `MODES`
+        :type mode: string
+        :param readahead: the read ahead window in bytes, 0 for the default
+        :type readahead: int
+
+        :raises ValueError: if the mode is unknown or not supported on this
+        platform
+
+        """
+        if mode not in MODES:
+            raise ValueError("Unknown I/O mode %s" % mode)
+        if mode == FADVISE and not hasattr(os, "posix_fadvise"):
+            raise ValueError("posix_fadvise is not supported on this platform")
+        if mode == DIRECT and not hasattr(os, "O_DIRECT"):
+            raise ValueError("O_DIRECT is not supported on this platform")
+        self.mode = mode
+        self.readahead = readahead or 0
+        self.stats = IOStats()
+
+    def __getstate__(self):
+        return (self.mode, self.readahead)
+
+    def __setstate__(self, state):
+        self.mode, self.readahead = state
+        self.stats = IOStats()
+
+    def open(self, path):
+        """
+        Open a file for reading under the policy.
+
+        :returns: a file with a readinto_at(view, offset) method
+        """
+        if self.mode == FADVISE:
+            return _FadviseFile(path, self)
+        elif self.mode == DIRECT:
+            return _DirectFile(path, self)
+        return _BufferedFile(path, self)
@@ -0,0 +1,330 @@
+#
+# locate.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import os
+from multiprocessing.pool import ThreadPool
+
+from .filetable import PieceList
+from .hashcache import file_pieces
+from .iopolicy import IOPolicy
+from .scanner import DirectoryScanner
+from .zeros import add_run, hash_piece
+
+# File states reported by the locator
+FOUND = "found"
+UNCONFIRMED = "unconfirmed"
+NOT_FOUND = "not found"
+
+class LocateResult(object):
+    """
+    Where a single file of a torrent was found.  A file is `UNCONFIRMED` when
+    a file of the right size was found but no piece could prove it right.
+    Empty files are always found, without a source.
+    """
+    def __init__(self, index, path, length):
+        self.index = index
+        self.path = path
+        self.length = length
+        self.status = NOT_FOUND
+        self.source = None
+        self.candidates = 0
+        # The candidates still to try for an unconfirmed file
+        self.untried = []
+
+    def to_dict(self):
+        return {
+            "path": self.path,
+            "length": self.length,
+            "status": self.status,
+            "source": self.source,
+            "candidates": self.candidates,
+        }
+
+class DataLocator(object):
+    """
+    Finds the files of a torrent in a storage tree where they may have been
+    renamed or moved around.
+
+    The tree is listed once and its files are indexed by size, only the files
+    with the size of a file of the torrent are kept.  The candidates for a
+    file are then confirmed by hashing the pieces that lie entirely within the
+    file, stopping at the first piece that does not match, so wrong
+    candidates are usually rejected after a single piece.  Candidates with
+    the same name as the file are tried first.
+
+    Files too small to hold a piece of their own can only be confirmed by
+    pieces shared with other files, these are checked once all the other
+    files have been placed.
+
+    ** Usage **
+
+    >>> t = TorrentMetadata()
+    >>> t.load("/tmp/test.torrent")
+    >>> locator = DataLocator(t.get_storage("/tmp/links"), t.pieces, "/srv")
+    >>> for f in locator.locate():
+    ...     print(f.status, f.path, f.source)
+    found /tmp/links/test/a /srv/old/a
+
+    """
+    def __init__(self, storage, pieces, root, jobs=1, max_pieces=0,
+                 io_policy=None):
+        """
+        :param storage: the storage of the torrent, the paths of its files are
+        only used to report them
+        :type storage: FileStorage
+        :param pieces: the piece hashes of the torrent
+        :type pieces: bytes
+        :param root: the storage tree to search
+        :type root: string
+        :param jobs: the number of files listed and located in parallel
+        :type jobs: int
+        :param max_pieces: the number of pieces hashed to confirm a
+        candidate, spread over the file, 0 to hash all its pieces
+        :type max_pieces: int
+        :param io_policy: how to read the candidates
+        :type io_policy: IOPolicy
+
+        """
+        self.storage = storage
+        self.pieces = PieceList(pieces)
+        self.root = root
+        self.jobs = max(1, jobs or 1)
+        self.max_pieces = max_pieces
+        self.io_policy = io_policy or IOPolicy()
+
+    def scan(self):
+        """
+        List the files of the tree with the size of a file of the torrent.
+
+        :returns: the paths of the files by size
+        :rtype: dict of {size: list of strings}
+
+        """
+        wanted = set(length for path, length in self.storage.files
+                     if path is not None and length)
+        by_size = {}
+        scanner = DirectoryScanner(self.root, jobs=self.jobs)
+        for components, size, mtime in scanner.scan():
+            if size in wanted:
+                by_size.setdefault(size, []).append(
+                    os.path.join(self.root, *components))
+        return by_size
+
+    def hash_piece(self, index, sources):
+        """
+        Hash a piece reading its files from `sources`.
+
+        :param index: the piece
+        :type index: int
+        :param sources: the path to read each file of the piece from
+        :type sources: dict of {file index: path}
+        :returns: True if the piece matches its hash
+
+        """
+        piece_size = self.storage.piece_size
+        length = self.storage.piece_length(index)
+        view = memoryview(bytearray(length))
+        zero_runs = []
+        pos = 0
+        try:
+            for file_index, file_offset, size in \
+                    self.storage.segments(index * piece_size, length):
+                if self.storage.files[file_index][0] is None:
+                    add_run(zero_runs, pos, pos + size)
+                else:
+                    fd = self.io_policy.open(sources[file_index])
+                    try:
+                        fd.readinto_at(view[pos:pos + size], file_offset)
+                    finally:
+                        fd.close()
+                pos += size
+        except (IOError, OSError):
+            return False
+        return hash_piece(view, zero_runs) == self.pieces[index]
+
+    def file_pieces(self, index):
+        """
+        The pieces that lie entirely within the file at `index`, or within
+        the file and padding, that are hashed to confirm a candidate.
+
+        :rtype: list of ints
+
+        """
+        first, stop, tail = file_pieces(self.storage, index)
+        pieces = list(range(first, stop))
+        if tail is not None:
+            pieces.append(tail)
+        if self.max_pieces and len(pieces) > self.max_pieces:
+            # Spread the pieces over the file, keeping the first and last
+            step = (len(pieces) - 1) / float(max(1, self.max_pieces - 1))
+            pieces = sorted(set(pieces[int(round(i * step))]
+                                for i in range(self.max_pieces)))
+        return pieces
+
+    def locate_file(self, args):
+        """
+        Try the candidates of a single file.
+
+        :param args: the result to fill in and the candidate paths
+        :type args: 2-tuple (LocateResult, list of strings)
+        :returns: the result
+
+        """
+        result, candidates = args
+        result.candidates = len(candidates)
+        if not result.length:
+            result.status = FOUND
+            return result
+        if not candidates:
+            return result
+
+        name = os.path.basename(result.path)
+        candidates = sorted(candidates,
+                            key=lambda c: (os.path.basename(c) != name, c))
+        pieces = self.file_pieces(result.index)
+        if not pieces:
+            result.status = UNCONFIRMED
+            result.source = candidates[0]
+            result.untried = candidates[1:]
+            return result
+
+        for candidate in candidates:
+            sources = {result.index: candidate}
+            if all(self.hash_piece(i, sources) for i in pieces):
+                result.status = FOUND
+                result.source = candidate
+                break
+        return result
+
+    def locate(self, progress=None):
+        """
+        Find the files of the torrent.
+
+        :param progress: a function to be called as files are located
+        :type progress: function(num_completed, num_files)
+        :returns: the result for every non-padding file
+        :rtype: list of LocateResult
+
+        """
+        by_size = self.scan()
+        tasks = []
+        for index, (path, length) in enumerate(self.storage.files):
+            if path is None:
+                continue
+            result = LocateResult(index, path, length)
+            candidates = by_size.get(length, []) if length else []
+            tasks.append((result, candidates))
+
+        if progress:
+            progress(0, len(tasks))
+        pool = ThreadPool(self.jobs) if self.jobs > 1 else None
+        try:
+            if pool:
+                results = pool.imap_unordered(self.locate_file, tasks)
+            else:
+                results = (self.locate_file(task) for task in tasks)
+            for completed, result in enumerate(results):
+                if progress:
+                    progress(completed + 1, len(tasks))
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        results = [result for result, candidates in tasks]
+        self.confirm_shared(results)
+        return results
+
+    def confirm_shared(self, results):
+        """
+        Confirm the unconfirmed files with the pieces they share with other
+        files, once every file of such a piece has been placed.  The other
+        candidates of a file are tried if the first does not fit, a file is
+        left at its first candidate if none does.
+        """
+        by_index = dict((r.index, r) for r in results)
+        piece_size = self.storage.piece_size
+
+        def check(result):
+            first, stop = self.storage.piece_range(result.index)
+            for piece in range(first, stop):
+                sources = {}
+                for file_index, file_offset, size in self.storage.segments(
+                        piece * piece_size, self.storage.piece_length(piece)):
+                    r = by_index.get(file_index)
+                    if r is None:
+                        continue
+                    if r.source is None:
+                        return False
+                    sources[file_index] = r.source
+                if not self.hash_piece(piece, sources):
+                    return False
+            return True
+
+        for result in results:
+            if result.status != UNCONFIRMED:
+                continue
+            candidates = [result.source] + result.untried
+            for candidate in candidates:
+                result.source = candidate
+                if check(result):
+                    result.status = FOUND
+                    break
+            else:
+                result.source = candidates[0]
+            result.untried = []
+
+    def link(self, results):
+        """
+        Create a symlink at the path of every file that was found pointing to
+        where it was found, so the torrent can be verified or seeded from the
+        links.  Empty files are created as such.  Unconfirmed files are not
+        linked.
+
+        A file found at its own path, or through a link already there, is left
+        alone.  Other existing symlinks are replaced, but nothing else is ever
+        removed, a path holding a file or directory is skipped.
+
+        :returns: the files that were skipped with the reason
+        :rtype: list of 2-tuples (LocateResult, string)
+
+        """
+        skipped = []
+        for result in results:
+            if result.status != FOUND:
+                continue
+            if result.source is not None and os.path.realpath(result.source) == \
+                    os.path.realpath(result.path):
+                continue
+            if os.path.lexists(result.path):
+                if not os.path.islink(result.path):
+                    skipped.append((result, "the path already exists"))
+                    continue
+                os.remove(result.path)
+            parent = os.path.dirname(result.path)
+            if parent and not os.path.isdir(parent):
+                os.makedirs(parent)
+            if result.source is None:
+                open(result.path, "wb").close()
+            else:
+                os.symlink(os.path.abspath(result.source), result.path)
+        return skipped
@@ -0,0 +1,331 @@
+#
+# merkle.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import os
+from hashlib import sha1, sha256
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from .iopolicy import IOPolicy
+from .zeros import data_extents, in_hole, is_sparse, update_zeros, zero_digest
+
+# The size of the leaf blocks of the v2 merkle trees
+BLOCK_SIZE = 16384
+
+# The hash of a leaf beyond the end of a file
+ZERO_HASH = b"\0" * 32
+
+_pad_hashes = {1: ZERO_HASH}
+_zero_leaves = {}
+
+def next_power_of_two(n):
+    """
+    The smallest power of two greater than or equal to `n`.
+    """
+    p = 1
+    while p < n:
+        p *= 2
+    return p
+
+def pad_hash(leaves):
+    """
+    The root of a tree of `leaves` zero leaves, `leaves` being a power of two.
+    """
+    if leaves not in _pad_hashes:
+        h = pad_hash(leaves // 2)
+        _pad_hashes[leaves] = sha256(h + h).digest()
+    return _pad_hashes[leaves]
+
+def merkle_root(hashes, width, pad=ZERO_HASH):
+    """
+    Compute the root of a merkle tree.
+
+    :param hashes: the nodes of the bottom layer of the tree
+    :type hashes: list of bytes
+    :param width: the width of the bottom layer, a power of two at least as
+    large as the number of `hashes`
+    :type width: int
+    :param pad: the hash of the nodes past the end of `hashes`
+    :type pad: bytes
+    :returns: the root hash
+    :rtype: bytes
+
+    """
+    layer = list(hashes)
+    while width > 1:
+        if len(layer) % 2:
+            layer.append(pad)
+        layer = [sha256(layer[i] + layer[i + 1]).digest()
+                 for i in range(0, len(layer), 2)]
+        pad = sha256(pad + pad).digest()
+        width //= 2
+    return layer[0] if layer else pad
+
+def zero_leaves(size):
+    """
+    The leaf hashes of `size` zero bytes, computed once per size.
+    """
+    if size not in _zero_leaves:
+        full, rest = divmod(size, BLOCK_SIZE)
+        leaves = [zero_digest(BLOCK_SIZE, sha256)] * full
+        if rest:
+            leaves.append(zero_digest(rest, sha256))
+        _zero_leaves[size] = leaves
+    return _zero_leaves[size]
+
+def hash_file(path, length, piece_length, v1=False, pad=False, io_policy=None):
+    """
+    Hash a file for a v2 torrent, see BEP 52.
+
+    The leaves of the tree are the SHA-256 hashes of 16 KiB blocks.  A file
+    longer than a piece also gets a piece layer, the hashes of the subtrees
+    covering each piece.
+
+    For hybrid torrents the v1 SHA1 piece hashes are computed from the same
+    reads.  The file must start on a piece boundary in the v1 layout, which
+    padding files make sure of.
+
+    Pieces lying in the holes of a sparse file are not read, their hashes are
+    the cached hashes of zeros.
+
+    :param path: the file to hash
+    :type path: string
+    :param length: the length of the file
+    :type length: int
+    :param piece_length: the piece length of the torrent, a power of two of at
+    least 16 KiB
+    :type piece_length: int
+    :param v1: also compute the v1 piece hashes
+    :type v1: bool
+    :param pad: if True the file is followed by padding up to the next piece
+    boundary, which is part of its last v1 piece
+    :type pad: bool
+    :param io_policy: how to read the file
+    :type io_policy: IOPolicy
+    :returns: a 3-tuple (pieces root, piece layer, v1 pieces), the root being
+    None for an empty file, the layer being empty for files of a single piece
+    and the v1 pieces being empty unless `v1` is True
+    :rtype: tuple
+
+    :raises IOError: if the file is shorter than `length`
+
+    """
+    if not length:
+        return (None, b"", b"")
+
+    blocks_per_piece = piece_length // BLOCK_SIZE
+    buf = bytearray(piece_length)
+    view = memoryview(buf)
+    leaves = []
+    pieces = []
+    v1_pieces = []
+    fd = (io_policy or IOPolicy()).open(path)
+    try:
+        extents = None
+        st = os.fstat(fd.fileno())
+        if is_sparse(st) and st.st_size >= length:
+            extents = data_extents(fd.fileno(), length)
+        zero_root = None
+        remaining = length
+        while remaining:
+            size = min(piece_length, remaining)
+            offset = length - remaining
+            remaining -= size
+            if extents is not None and in_hole(extents, offset, offset + size):
+                leaves = zero_leaves(size)
+                if length > piece_length and size < piece_length:
+                    pieces.append(merkle_root(leaves, blocks_per_piece))
+                elif length > piece_length:
+                    if zero_root is None:
+                        zero_root = merkle_root(leaves, blocks_per_piece)
+                    pieces.append(zero_root)
+                if v1:
+                    v1_pieces.append(zero_digest(piece_length if pad else size))
+                continue
+
+            fd.readinto_at(view[:size], offset)
+            leaves = [sha256(view[i:min(i + BLOCK_SIZE, size)]).digest()
+                      for i in range(0, size, BLOCK_SIZE)]
+            if length > piece_length:
+                pieces.append(merkle_root(leaves, blocks_per_piece))
+            if v1:
+                h = sha1(view[:size])
+                if pad and size < piece_length:
+                    update_zeros(h, piece_length - size)
+                v1_pieces.append(h.digest())
+    finally:
+        fd.close()
+
+    if length <= piece_length:
+        root = merkle_root(leaves, next_power_of_two(len(leaves)))
+        return (root, b"", b"".join(v1_pieces))
+
+    root = merkle_root(pieces, next_power_of_two(len(pieces)),
+                       pad_hash(blocks_per_piece))
+    return (root, b"".join(pieces), b"".join(v1_pieces))
+
+# The arguments used by process workers, set once by the pool initializer
+_worker_args = None
+
+def _init_worker(args):
+    global _worker_args
+    _worker_args = args
+
+def _hash_file_worker(index):
+    return _worker_args.hash_file(index)
+
+class MerkleHasher(object):
+    """
+    Hashes the files of a v2 torrent with a pool of worker threads or
+    processes.  Every file has its own merkle tree so files are hashed
+    independently and in any order, which keeps all the workers busy on
+    torrents made of many small files.
+
+    With `v1` the SHA1 piece hashes of a hybrid torrent are computed from the
+    same reads, every file but the last being padded to a piece boundary.
+
+    ** Usage **
+
+    >>> hasher = MerkleHasher([("/tmp/a", 1024), ("/tmp/b", 0)], 16384, jobs=4)
+    >>> roots, layers, pieces = hasher.hash_files()
+
+    """
+    def __init__(self, files, piece_length, jobs=1, processes=False, v1=False,
+                 io_policy=None):
+        """
+        :param files: the (path, length) of every file
+        :type files: sequence of 2-tuples
+        :param piece_length: the piece length in bytes
+        :type piece_length: int
+        :param jobs: the number of files hashed in parallel
+        :type jobs: int
+        :param processes: use worker processes instead of threads
+        :type processes: bool
+        :param v1: also compute the v1 piece hashes for a hybrid torrent
+        :type v1: bool
+        :param io_policy: how to read the files
+        :type io_policy: IOPolicy
+
+        """
+        self.files = files
+        self.piece_length = piece_length
+        self.jobs = max(1, jobs or 1)
+        self.processes = processes
+        self.v1 = v1
+        self.io_policy = io_policy
+
+    def __getstate__(self):
+        return (list(self.files), self.piece_length, self.v1, self.io_policy)
+
+    def __setstate__(self, state):
+        self.files, self.piece_length, self.v1, self.io_policy = state
+        self.jobs = 1
+        self.processes = False
+
+    def num_pieces(self, index):
+        """
+        The number of pieces of the file at `index`.
+        """
+        return (self.files[index][1] + self.piece_length - 1) // self.piece_length
+
+    def hash_file(self, index):
+        """
+        Hash the file at `index`, see `hash_file`.
+
+        :returns: a 4-tuple (index, pieces root, piece layer, v1 pieces)
+
+        """
+        path, length = self.files[index]
+        pad = index + 1 < len(self.files)
+        return (index,) + hash_file(path, length, self.piece_length, self.v1,
+                                    pad, self.io_policy)
+
+    def iter_files(self, skip=()):
+        """
+        Hash every file, yielding the results as they complete.
+
+        :param skip: the indexes of files not to hash
+        :type skip: container of ints
+        :returns: an iterator of 4-tuples (index, pieces root, piece layer, v1
+        pieces) in no particular order
+
+        """
+        indexes = [i for i in range(len(self.files))
+                   if self.files[i][1] and i not in skip]
+        if self.jobs == 1:
+            for index in indexes:
+                yield self.hash_file(index)
+            return
+
+        if self.processes:
+            pool = Pool(self.jobs, _init_worker, (self,))
+            func = _hash_file_worker
+        else:
+            pool = ThreadPool(self.jobs)
+            func = self.hash_file
+
+        # Hand out the large files first so they do not end up last
+        indexes.sort(key=lambda i: -self.files[i][1])
+        try:
+            for result in pool.imap_unordered(func, indexes):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def hash_files(self, progress=None, known=None):
+        """
+        Hash every file.
+
+        :param progress: a function to be called as files are hashed, counting
+        the pieces of the hashed files
+        :type progress: function(num_completed, num_pieces)
+        :param known: the hashes of files that are already known and need not
+        be hashed
+        :type known: dict of {index: (pieces root, piece layer, v1 pieces)}
+        :returns: a 3-tuple (roots, layers, pieces) with the pieces root of
+        every file (None for empty files), the piece layer of every file and
+        the concatenated v1 piece hashes if `v1` is set
+        :rtype: tuple
+
+        """
+        num_pieces = sum(self.num_pieces(i) for i in range(len(self.files)))
+        roots = [None] * len(self.files)
+        layers = [b""] * len(self.files)
+        v1_pieces = [b""] * len(self.files)
+        known = known or {}
+        completed = 0
+        for index, (root, layer, pieces) in known.items():
+            roots[index] = root
+            layers[index] = layer
+            v1_pieces[index] = pieces
+            completed += self.num_pieces(index)
+        if progress:
+            progress(completed, num_pieces)
+        for index, root, layer, pieces in self.iter_files(known):
+            roots[index] = root
+            layers[index] = layer
+            v1_pieces[index] = pieces
+            completed += self.num_pieces(index)
+            if progress:
+                progress(completed, num_pieces)
+        return (roots, layers, b"".join(v1_pieces))
@@ -22,9 +22,48 @@
 
 import sys
 import os
+import stat
 from hashlib import sha1 as sha
+from hashlib import sha256
+
+from .bencode import bencode, bdecode, bdecode_spans, PY2
+from .bencode import BencodeWriter, Hashed, StreamedBytes, StreamedList
+from .checkpoint import Checkpoint, CheckpointMismatch
+from .filetable import FileTable, PieceList
+from .hasher import PieceHasher
+from .merkle import MerkleHasher
+from .pipeline import QUEUE_DEPTH, BUFFER_MEMORY
+from .scanner import DirectoryScanner
+from .storage import FileStorage
+
+def utf8_encode(s):
+    """
+    Encodes a path component or other string for storing in the metadata.
+
+    :param s: a string in the filesystem encoding or a unicode string
+    :type s: string
+    :returns: the UTF-8 encoded string
+    :rtype: bytes
 
-from .bencode import bencode, bdecode
+    """
+    if isinstance(s, bytes):
+        s = s.decode(sys.getfilesystemencoding())
+    return s.encode("UTF-8")
+
+def utf8_decode(s):
+    """
+    Decodes a string read from the metadata.  On Python 2 the string is left
+    encoded to match the rest of the API.
+
+    :param s: the UTF-8 encoded string
+    :type s: bytes
+    :returns: the decoded string
+    :rtype: string
+
+    """
+    if PY2:
+        return s
+    return s.decode("UTF-8", "replace")
 
 def get_path_size(path):
     """
@@ -38,18 +77,33 @@ def get_path_size(path):
     :raises InvalidPath: if the path does not exist
 
     """
-    if not os.path.exists(path):
+    try:
+        st = os.stat(path)
+    except OSError:
         raise InvalidPath("%s is an invalid path" % path)
 
-    if os.path.isfile(path):
-        return os.path.getsize(path)
+    if not stat.S_ISDIR(st.st_mode):
+        return st.st_size
 
-    dir_size = 0
-    for (p, dirs, files) in os.walk(path):
-        for file in files:
-            filename = os.path.join(p, file)
-            dir_size += os.path.getsize(filename)
-    return dir_size
+    return sum(size for _, size, _ in DirectoryScanner(path).scan())
+
+def file_tree_entries(tree, path=()):
+    """
+    Walk the file tree of a v2 torrent, see BEP 52.
+
+    :param tree: the decoded file tree
+    :type tree: dict
+    :returns: an iterator of 2-tuples (path, file dict) in tree order, the path
+    being a tuple of encoded components
+
+    """
+    for name in sorted(tree):
+        node = tree[name]
+        if b"" in node:
+            yield (path + (name,), node[b""])
+        else:
+            for entry in file_tree_entries(node, path + (name,)):
+                yield entry
 
 class InvalidPath(Exception):
     """
@@ -92,21 +146,56 @@ class TorrentMetadata(object):
         self.__pad_files = False
         self.__data_path = None
         self.__name = ""
-        # [(path, size), ...]
-        self.__files = []
+        # The files including any padding files
+        self.__files = FileTable()
+        # The paths of the files property are joined onto this prefix, see
+        # FileTable.file_list()
+        self.__files_prefix = None
+        # The stats of the last directory scan, see set_data_path()
+        self.__scan_stats = None
         # The pieces hash string, this will only be set after a load() or save()
         self.__pieces_hash = ""
         # Only set after a load() or save()
         self.__info_hash = ""
-
-    def load(self, filename):
+        self.__info_hash_v2 = ""
+        # The metadata version, 2 for BEP 52 torrents, and whether the torrent
+        # also has v1 metadata
+        self.__meta_version = 1
+        self.__hybrid = False
+        # The v2 pieces root of every file in the file table, None for empty
+        # and padding files, and the piece layers keyed by pieces root
+        self.__piece_roots = []
+        self.__piece_layers = {}
+        # The piece length in bytes, only set after a load()
+        self.__piece_length = 0
+        # The groups of properties of a lazily loaded torrent that have not
+        # been decoded yet, see load()
+        self.__pending = set()
+        self.__filename = None
+        self.__raw = None
+        self.__spans = {}
+        self.__info_spans = {}
+        # The hashes of a loaded torrent kept for the next save() after an
+        # update_data(), see __reused_pieces()
+        self.__previous = None
+
+    def load(self, filename, lazy=False):
         """
         Load metadata from a .torrent file.  This is useful if you want to view
         or modify existing metadata.
 
+        The info-hash is computed from the bytes of the info dictionary as they
+        appear in the file, so it is correct even if the file was not encoded
+        canonically.
+
         :param filename: the .torrent file to load
         :type filename: string
 
+        :param lazy: if True, the trackers, comment, webseeds, files and pieces
+        are only decoded when first accessed.  This makes loading large
+        torrents much cheaper when only a few properties are needed.
+        :type lazy: bool
+
         :raises InvalidPath: if the `filename` does not exist
         :raises InvalidBencoding: if the `filename` does not contain valid
         bencoded data.
@@ -116,53 +205,325 @@ class TorrentMetadata(object):
             raise InvalidPath("The file %s does not exist!" % filename)
 
         try:
-            md = bdecode(open(filename, "rb").read())
+            raw = open(filename, "rb").read()
+            spans = bdecode_spans(raw)
+            info_spans = bdecode_spans(raw, spans[b"info"][0])
         except Exception as e:
             raise InvalidBencoding("The file %s contains invalid data." % filename)
 
-        # Set the properties
-        if "comment" in md:
-            self.comment = md["comment"]
+        self.__filename = filename
+        self.__raw = raw
+        self.__spans = spans
+        self.__info_spans = info_spans
+        self.__pending = set(["outer", "files", "pieces"])
 
-        if "private" in md["info"] and md["info"]["private"]:
+        self.__meta_version = self.__decode(b"meta version", True, 1)
+        self.__hybrid = self.__meta_version == 2 and b"pieces" in info_spans
+
+        start, end = spans[b"info"]
+        if self.__meta_version == 2:
+            self.__info_hash_v2 = sha256(memoryview(raw)[start:end]).hexdigest()
+        else:
+            self.__info_hash_v2 = ""
+        if b"pieces" in info_spans:
+            self.__info_hash = sha(memoryview(raw)[start:end]).hexdigest()
+        else:
+            # A v2 only torrent has no v1 info-hash
+            self.__info_hash = ""
+
+        # The piece length is stored in bytes, older torrents may use piece
+        # sizes that are not multiples of 16 KiB so bypass the check
+        self.__piece_length = self.__decode(b"piece length", True)
+        self.__piece_size = self.__piece_length // 1024
+
+        if self.__decode(b"private", True):
             self.private = True
 
-        if "announce-list" in md:
-            self.trackers = md["announce-list"]
-        elif "announce" in md:
-            self.trackers = [[md["announce"]]]
+        if b"name" in info_spans:
+            self.name = utf8_decode(self.__decode(b"name", True))
+
+        if not lazy:
+            for group in ("outer", "files", "pieces"):
+                self.__materialize(group)
+
+    def __decode(self, key, info=False, default=None):
+        """
+        Decode a single value of a loaded torrent.
+        """
+        spans = self.__info_spans if info else self.__spans
+        if key not in spans:
+            return default
+        start, end = spans[key]
+        try:
+            return bdecode(self.__raw[start:end])
+        except Exception as e:
+            raise InvalidBencoding("The file %s contains invalid data." % self.__filename)
 
-        webseeds = []
-        if "httpseeds" in md:
-            webseeds = md["httpseeds"]
-        if "url-list" in md:
-            webseeds += md["url-list"]
-        if webseeds:
-            self.webseeds = webseeds
+    def __materialize(self, group):
+        """
+        Decode a group of properties of a loaded torrent if it has not been
+        done yet.
+        """
+        if group not in self.__pending:
+            return
+        self.__pending.discard(group)
 
-        self.piece_size = md["info"]["piece length"]
+        if group == "outer":
+            comment = self.__decode(b"comment")
+            if comment is not None:
+                self.__comment = utf8_decode(comment)
 
-        if "name" in md["info"]:
-            self.name = md["info"]["name"]
+            if b"announce-list" in self.__spans:
+                self.__trackers = [[utf8_decode(t) for t in tier]
+                                   for tier in self.__decode(b"announce-list")]
+            elif self.__decode(b"announce"):
+                self.__trackers = [[utf8_decode(self.__decode(b"announce"))]]
 
-        if "length" in md["info"]:
-            # We're dealing with a single file
-            self.__files = [(md["info"]["name"], md["info"]["length"])]
-        else:
-            # Multi-file torrent
-            self.__files = []
-            for fd in md["info"]["files"]:
-                if "/".join(fd["path"]).startswith("_____padding_file_") or ("attr" in fd and "p" in fd["attr"]):
-                    # This is a padding file, so lets not display it but set the
-                    # pad_files property True
-                    self.pad_files = True
+            webseeds = []
+            for key in (b"httpseeds", b"url-list"):
+                urls = self.__decode(key, default=[])
+                if isinstance(urls, bytes):
+                    urls = [urls]
+                webseeds += [utf8_decode(u) for u in urls]
+            if webseeds:
+                self.__webseeds = webseeds
+
+        elif group == "files":
+            self.__files = FileTable()
+            tree = {}
+            if self.__meta_version == 2:
+                tree = dict(file_tree_entries(self.__decode(b"file tree", True)))
+
+            if b"length" not in self.__info_spans and b"files" not in self.__info_spans:
+                # A v2 only torrent, a single file torrent has a tree of just
+                # the file named after the torrent
+                paths = list(tree)
+                if len(paths) == 1 and paths[0] == (utf8_encode(self.name),):
+                    self.__files.append((), tree[paths[0]][b"length"])
+                    self.__files_prefix = self.name
                 else:
-                    # Regular file, so add it to the list
-                    self.__files.append(("/".join(fd["path"]), fd["length"]))
+                    self.__files_prefix = None
+                    for path in paths:
+                        self.__files.append(tuple(utf8_decode(p) for p in path),
+                                            tree[path][b"length"])
+            elif b"length" in self.__info_spans:
+                # We're dealing with a single file
+                self.__files.append((), self.__decode(b"length", True))
+                self.__files_prefix = self.name
+            else:
+                # Multi-file torrent
+                self.__files_prefix = None
+                for fd in self.__decode(b"files", True):
+                    path = tuple(utf8_decode(p) for p in fd[b"path"])
+                    if "/".join(path).startswith("_____padding_file_") or (b"attr" in fd and b"p" in fd[b"attr"]):
+                        # This is a padding file, so lets not display it but set the
+                        # pad_files property True
+                        self.__pad_files = True
+                        self.__files.append(path, fd[b"length"], pad=True)
+                    else:
+                        # Regular file, so add it to the list
+                        self.__files.append(path, fd[b"length"])
+
+            # Match the files up with their pieces roots
+            self.__piece_roots = []
+            for index in range(len(self.__files)):
+                if self.__files.pads[index]:
+                    self.__piece_roots.append(None)
+                    continue
+                path = tuple(utf8_encode(p) for p in self.__files.path(index))
+                entry = tree.get(path or (utf8_encode(self.name),), {})
+                self.__piece_roots.append(entry.get(b"pieces root"))
+
+        elif group == "pieces":
+            self.__pieces_hash = self.__decode(b"pieces", True, b"")
+            self.__piece_layers = self.__decode(b"piece layers", default={})
+
+        if not self.__pending:
+            # Everything is decoded, the raw data is no longer needed
+            self.__raw = None
+
+    def get_storage(self, data_dir):
+        """
+        Get the storage layout of a loaded torrent for the data found in
+        `data_dir`, including any padding files.
+
+        :param data_dir: the directory containing the torrent's data, ie, the
+        directory a client would have saved it in.
+        :type data_dir: string
+        :returns: the storage mapping pieces to files
+        :rtype: FileStorage
+
+        :raises InvalidPath: if no torrent has been loaded
+
+        """
+        self.__materialize("files")
+        if not self.__piece_length or not len(self.__files):
+            raise InvalidPath("Need to load a torrent first!")
+
+        root = os.path.join(data_dir, self.name)
+        return FileStorage(self.__files.storage_entries(root), self.__piece_length)
+
+    def update_data(self, data_dir, since=None, include=None, exclude=None,
+                    jobs=1):
+        """
+        Point a loaded torrent at the current contents of its data so it can be
+        saved again without hashing all of it.
+
+        The files are compared with the torrent by path, size and modification
+        time.  A file has changed if its size differs or it was modified after
+        `since`, by default the time the torrent file was written.  The next
+        save() only hashes the pieces holding changed, added or moved data and
+        reuses the hashes of the loaded torrent for the others.  When files
+        are padded to piece boundaries, and in v2 torrents, these are just the
+        pieces of the changed files.
+
+        :param data_dir: the directory containing the torrent's data, ie, the
+        directory a client would have saved it in.
+        :type data_dir: string
+        :param since: files modified after this time are rehashed
+        :type since: float
+        :param include: see `set_data_path`
+        :param exclude: see `set_data_path`
+        :param jobs: see `set_data_path`
+        :returns: the number of files unchanged, changed, added and removed
+        :rtype: dict
+
+        :raises InvalidPath: if no torrent has been loaded or its data does not
+        exist
+
+        """
+        data_dir = os.path.abspath(data_dir)
+        storage = self.get_storage(data_dir)
+        pieces = self.pieces
+        roots = list(self.__piece_roots)
+        layers = self.piece_layers
+        if since is None:
+            since = os.stat(self.__filename).st_mtime
+
+        self.set_data_path(os.path.join(data_dir, self.name), include, exclude,
+                           jobs)
+
+        old = dict((path, index) for index, (path, length)
+                   in enumerate(storage.files) if path is not None)
+        entries = self.__files.storage_entries(self.data_path)
+        unchanged = {}
+        stats = {"unchanged": 0, "changed": 0, "added": 0, "removed": 0}
+        for index, (path, length) in enumerate(entries):
+            old_index = old.pop(path, None)
+            if old_index is None:
+                stats["added"] += 1
+            elif storage.files[old_index][1] != length or \
+                    self.__files.mtimes[index] > since:
+                stats["changed"] += 1
+            else:
+                stats["unchanged"] += 1
+                unchanged[path] = old_index
+        stats["removed"] = len(old)
+
+        self.__previous = (storage, pieces, unchanged, roots, layers)
+        return stats
+
+    def __reused_pieces(self, storage):
+        """
+        Find the v1 piece hashes kept by `update_data` that are still
+        valid for `storage`.  A piece is reused if it holds the same parts of
+        the same unchanged files, and padding, as a piece of the loaded torrent.
+
+        :returns: the known piece digests
+        :rtype: dict of {index: digest}
+
+        """
+        old_storage, old_pieces, unchanged, roots, layers = self.__previous
+        piece_size = storage.piece_size
+        known = {}
+        if old_storage.piece_size != piece_size or not old_pieces:
+            return known
+
+        def layout(segments, files, old=False):
+            # The segments with padding and file indexes made comparable
+            result = []
+            for file_index, file_offset, length in segments:
+                path = files[file_index][0]
+                if path is None:
+                    result.append((None, 0, length))
+                elif old:
+                    result.append((file_index, file_offset, length))
+                elif path in unchanged:
+                    result.append((unchanged[path], file_offset, length))
+                else:
+                    return None
+            return result
+
+        for index in range(storage.num_pieces):
+            length = storage.piece_length(index)
+            new = layout(storage.segments(index * piece_size, length),
+                         storage.files)
+            if new is None:
+                continue
+            # Where the piece would start in the loaded torrent
+            pos = 0
+            for old_index, file_offset, size in new:
+                if old_index is not None:
+                    start = old_storage.offsets[old_index] + file_offset - pos
+                    break
+                pos += size
+            else:
+                continue
+            old_index = start // piece_size
+            if start % piece_size or old_index >= old_storage.num_pieces or \
+                    old_storage.piece_length(old_index) != length:
+                continue
+            if layout(old_storage.segments(start, length), old_storage.files,
+                      True) == new:
+                known[index] = old_pieces[old_index * 20:old_index * 20 + 20]
+        return known
+
+    def __reused_files(self, entries, piece_size):
+        """
+        Find the v2 hashes kept by `update_data` that are still valid,
+        those of the unchanged files.  For hybrid torrents the v1 pieces of the
+        file are reused as well.
 
-        self.__info_hash = sha(bencode(md["info"])).hexdigest()
+        :returns: the known hashes, see `MerkleHasher.hash_files`
+        :rtype: dict of {index: (pieces root, piece layer, v1 pieces)}
 
-    def save(self, torrent_path, progress=None):
+        """
+        old_storage, old_pieces, unchanged, roots, layers = self.__previous
+        known = {}
+        if old_storage.piece_size != piece_size:
+            return known
+
+        for index, (path, length) in enumerate(entries):
+            old_index = unchanged.get(path)
+            if old_index is None or not length or roots[old_index] is None:
+                continue
+            root = roots[old_index]
+            layer = b""
+            if length > piece_size:
+                layer = layers.get(root)
+                if layer is None:
+                    continue
+
+            v1 = b""
+            if self.hybrid:
+                start = old_storage.offsets[old_index]
+                first = start // piece_size
+                num = (length + piece_size - 1) // piece_size
+                last = first + num - 1
+                # The last piece is only the same if it is padded the same
+                pad = index + 1 < len(entries)
+                if start % piece_size or len(old_pieces) < (last + 1) * 20 or \
+                        (length % piece_size and
+                         (old_storage.piece_length(last) == piece_size) != pad):
+                    continue
+                v1 = old_pieces[first * 20:(last + 1) * 20]
+            known[index] = (root, layer, v1)
+        return known
+
+    def save(self, torrent_path, progress=None, jobs=1, processes=False,
+             use_mmap=False, checkpoint=None, resume=False, cache=None,
+             queue_depth=QUEUE_DEPTH, buffer_memory=BUFFER_MEMORY,
+             io_policy=None):
         """
         Creates and saves the torrent file to `torrent_path`.
 
@@ -172,27 +533,65 @@ class TorrentMetadata(object):
         :param progress: a function to be called when a piece is hashed
         :type progress: function(num_completed, num_pieces)
 
+        :param jobs: the number of workers hashing pieces in parallel
+        :type jobs: int
+
+        :param processes: use worker processes instead of threads
+        :type processes: bool
+
+        :param use_mmap: map the data files instead of reading them
+        :type use_mmap: bool
+
+        :param checkpoint: a file to periodically record the completed piece
+        hashes in, it is removed once the torrent is saved
+        :type checkpoint: string
+
+        :param resume: continue from the pieces recorded in `checkpoint`
+        :type resume: bool
+
+        :param cache: a cache to look up piece hashes of unchanged files in, and
+        to store the new ones in
+        :type cache: PieceHashCache
+
+        :param queue_depth: the number of chunks read ahead of the hashing
+        threads, see `HashPipeline`
+        :type queue_depth: int
+
+        :param buffer_memory: the memory in bytes used for read buffers
+        :type buffer_memory: int
+
+        :param io_policy: how the data files are read, see `IOPolicy`
+        :type io_policy: IOPolicy
+
+        The `use_mmap`, `checkpoint`, `resume`, `cache`, `queue_depth` and
+        `buffer_memory` options only apply to the v1 piece hashes and are
+        ignored when `meta_version` is 2.
+
         :raises InvalidPath: if the data path has not been set
+        :raises InvalidPieceSize: if the piece size is not a power of two for a
+        v2 torrent
+        :raises CheckpointMismatch: if resuming from a checkpoint written for
+        different data
 
         """
         if not self.data_path or len(self.__files) < 1:
             raise InvalidPath("Need to set a data path!")
 
         torrent = {
-            "info": {}
+            b"info": {}
             }
 
         if self.comment:
-            torrent["comment"] = self.comment.encode("UTF-8")
+            torrent[b"comment"] = self.comment.encode("UTF-8")
 
         if self.private:
-            torrent["info"]["private"] = True
+            torrent[b"info"][b"private"] = True
 
         if self.trackers:
-            torrent["announce"] = self.trackers[0][0]
-            torrent["announce-list"] = self.trackers
+            torrent[b"announce"] = self.trackers[0][0]
+            torrent[b"announce-list"] = self.trackers
         else:
-            torrent["announce"] = ""
+            torrent[b"announce"] = ""
 
         if self.webseeds:
             httpseeds = []
@@ -204,113 +603,190 @@ class TorrentMetadata(object):
                     webseeds.append(w)
 
             if httpseeds:
-                torrent["httpseeds"] = httpseeds
+                torrent[b"httpseeds"] = httpseeds
             if webseeds:
-                torrent["url-list"] = webseeds
+                torrent[b"url-list"] = webseeds
 
-        datasize = sum([x[1] for x in self.__files])
+        datasize = self.__files.total_size
 
         if self.piece_size:
             piece_size = self.piece_size * 1024
+            if self.meta_version == 2 and piece_size & (piece_size - 1):
+                raise InvalidPieceSize("Piece size must be a power of two for "
+                                       "a v2 torrent")
         else:
             # We need to calculate a piece size
             piece_size = 16384
             while (datasize / piece_size) > 1024 and piece_size < (8192 * 1024):
                 piece_size *= 2
 
-        # Calculate the number of pieces we will require for the data
-        num_pieces = datasize / piece_size
-        if datasize % piece_size:
-            num_pieces += 1
-
-        torrent["info"]["piece length"] = piece_size
-
-        # Create the info
-        if len(self.__files) > 1:
-            torrent["info"]["name"] = os.path.basename(self.data_path)
-            files = []
-            padding_count = 0
-            # Collect a list of file paths and add padding files if necessary
-            for index, (path, size) in enumerate(self.__files):
-                head, tail = os.path.split(self.data_path)
-                if tail:
-                    p = path.replace(tail, "", 1)
-                else:
-                    p = path.replace(head, "", 1)
-
-                p = p.lstrip("/")
-                p = p.split("/")
-                files.append((size, p))
-                # Add a padding file if necessary
-                if self.pad_files and (index + 1) < len(self.__files):
-                    left = size % piece_size
-                    if left:
-                        p = list(p)
-                        p[-1] = "_____padding_file_" + str(padding_count)
-                        files.append((piece_size - left, p))
-                        padding_count += 1
-
-            # Run the progress function with 0 completed pieces
-            if progress:
-                progress(0, num_pieces)
-
-            fs = []
-            pieces = []
-            # Create the piece hashes
-            buf = ""
-            for size, path in files:
-                path = [s.decode(sys.getfilesystemencoding()).encode("UTF-8") for s in path]
-                fs.append({"length": size, "path": path})
-                if path[-1].startswith("_____padding_file_"):
-                    buf += "\0" * size
-                    pieces.append(sha(buf).digest())
-                    buf = ""
-                    fs[-1]["attr"] = "p"
-                else:
-                    fd = open(os.path.join(self.data_path, *path), "rb")
-                    r = fd.read(piece_size - len(buf))
-                    while r:
-                        buf += r
-                        if len(buf) == piece_size:
-                            pieces.append(sha(buf).digest())
-                            # Run the progress function if necessary
-                            if progress:
-                                progress(len(pieces), num_pieces)
-                            buf = ""
-                        else:
-                            break
-                        r = fd.read(piece_size - len(buf))
-                    fd.close()
-
-            if buf:
-                pieces.append(sha(buf).digest())
-                if progress:
-                    progress(len(pieces), num_pieces)
-                buf = ""
-
-            torrent["info"]["pieces"] = "".join(pieces)
-            torrent["info"]["files"] = fs
-
-        elif len(self.__files) == 1:
-            torrent["info"]["name"] = self.__files[0][0]
-            abspath = os.path.join(os.path.dirname(self.data_path), self.__files[0][0])
-            torrent["info"]["length"] = get_path_size(abspath)
-            pieces = []
-
-            fd = open(abspath, "rb")
-            r = fd.read(piece_size)
-            while r:
-                pieces.append(sha(r).digest())
-                if progress:
-                    progress(len(pieces), num_pieces)
-
-                r = fd.read(piece_size)
-
-            torrent["info"]["pieces"] = "".join(pieces)
-
-        # Write out the torrent file
-        open(torrent_path, "wb").write(bencode(torrent))
+        torrent[b"info"][b"piece length"] = piece_size
+        torrent[b"info"][b"name"] = os.path.basename(self.data_path)
+
+        if self.hybrid or self.meta_version == 2:
+            self.__save_v2(torrent, torrent_path, piece_size, progress, jobs,
+                           processes, io_policy)
+            return
+
+        layout = self.__add_v1_files(torrent[b"info"], piece_size, self.pad_files)
+        storage = FileStorage(layout.storage_entries(self.data_path), piece_size)
+
+        known = {}
+        if cache:
+            known = cache.lookup(storage)
+        if self.__previous:
+            known.update(self.__reused_pieces(storage))
+
+        cp = None
+        if checkpoint:
+            cp = Checkpoint(checkpoint, storage, layout.mtimes)
+            if resume:
+                known.update(cp.load())
+            cp.open(known)
+
+        # The piece hashes are written out as they are produced, only a
+        # compact copy is kept for the pieces property
+        hasher = PieceHasher(storage, jobs, processes, use_mmap,
+                             queue_depth=queue_depth, buffer_memory=buffer_memory,
+                             io_policy=io_policy)
+        pieces = bytearray()
+
+        def digests():
+            for digest in hasher.iter_pieces(progress, known, cp.add if cp else None):
+                pieces.extend(digest)
+                yield digest
+
+        torrent[b"info"][b"pieces"] = StreamedBytes(storage.num_pieces * 20, digests())
+        info_hash = sha()
+        torrent[b"info"] = Hashed(torrent[b"info"], info_hash)
+
+        try:
+            self.__write(torrent, torrent_path)
+        finally:
+            if cp:
+                cp.close()
+
+        # Kept as is, a copy would double the memory held per piece
+        self.__pieces_hash = pieces
+        self.__info_hash = info_hash.hexdigest()
+        self.__info_hash_v2 = ""
+        self.__piece_roots = [None] * len(self.__files)
+        self.__piece_layers = {}
 
+        if cache:
+            cache.store(storage, self.__pieces_hash)
+
+        if cp:
+            cp.remove()
+
+    def __add_v1_files(self, info, piece_size, pad):
+        """
+        Add the v1 file list to the `info` dictionary, with padding files
+        after every file that does not end on a piece boundary if `pad` is
+        True.
+
+        :returns: the files including the padding files
+        :rtype: FileTable
+
+        """
+        if not os.path.isdir(self.data_path):
+            info[b"length"] = self.__files.sizes[0]
+            return self.__files
+
+        layout = FileTable()
+        padding_count = 0
+        # Collect the files and add padding files if necessary
+        for index in range(len(self.__files)):
+            path = self.__files.path(index)
+            size = self.__files.sizes[index]
+            layout.append(path, size, mtime=self.__files.mtimes[index])
+            # Add a padding file if necessary
+            if pad and (index + 1) < len(self.__files):
+                left = size % piece_size
+                if left:
+                    p = path[:-1] + ("_____padding_file_" + str(padding_count),)
+                    layout.append(p, piece_size - left, pad=True)
+                    padding_count += 1
+
+        def file_dicts():
+            for index in range(len(layout)):
+                path = [utf8_encode(s) for s in layout.path(index)]
+                fd = {b"length": layout.sizes[index], b"path": path}
+                if layout.pads[index]:
+                    fd[b"attr"] = b"p"
+                yield fd
+
+        # The file list is encoded as it is written
+        info[b"files"] = StreamedList(file_dicts())
+        return layout
+
+    def __save_v2(self, torrent, torrent_path, piece_size, progress, jobs,
+                  processes, io_policy):
+        """
+        Hash the data and write out a v2 or hybrid torrent, see BEP 52.  Every
+        file is hashed on its own so the files are spread over the workers.
+
+        A hybrid torrent also has the v1 piece hashes, with every file padded
+        to a piece boundary.  Both are computed from the same reads of the
+        data.
+        """
+        layout = self.__files
+        entries = layout.storage_entries(self.data_path)
+        hasher = MerkleHasher(entries, piece_size, jobs, processes, self.hybrid,
+                              io_policy)
+        known = None
+        if self.__previous:
+            known = self.__reused_files(entries, piece_size)
+        roots, layers, pieces = hasher.hash_files(progress, known)
+
+        if self.hybrid:
+            self.__add_v1_files(torrent[b"info"], piece_size, True)
+            torrent[b"info"][b"pieces"] = pieces
+
+        tree = {}
+        for index in range(len(layout)):
+            path = [utf8_encode(s) for s in layout.path(index)] or \
+                   [utf8_encode(torrent[b"info"][b"name"])]
+            node = tree
+            for name in path[:-1]:
+                node = node.setdefault(name, {})
+            fd = {b"length": layout.sizes[index]}
+            if roots[index] is not None:
+                fd[b"pieces root"] = roots[index]
+            node[path[-1]] = {b"": fd}
+
+        torrent[b"info"][b"file tree"] = tree
+        torrent[b"info"][b"meta version"] = 2
+        torrent[b"piece layers"] = dict((roots[i], layers[i])
+                                        for i in range(len(layout)) if layers[i])
+
+        info_hash = sha()
+        info_hash_v2 = sha256()
+        torrent[b"info"] = Hashed(Hashed(torrent[b"info"], info_hash_v2), info_hash)
+        self.__write(torrent, torrent_path)
+
+        self.__pieces_hash = pieces
+        self.__info_hash = info_hash.hexdigest() if self.hybrid else ""
+        self.__info_hash_v2 = info_hash_v2.hexdigest()
+        self.__piece_roots = roots
+        self.__piece_layers = torrent[b"piece layers"]
+
+    def __write(self, torrent, torrent_path):
+        """
+        Write out the torrent file, going through a temporary file so a failed
+        run does not leave a partial torrent behind.
+        """
+        tmp_path = torrent_path + ".part"
+        try:
+            with open(tmp_path, "wb") as fd:
+                BencodeWriter(fd).write(torrent)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if os.path.exists(torrent_path):
+            os.remove(torrent_path)
+        os.rename(tmp_path, torrent_path)
 
     def get_data_path(self):
         """
@@ -318,7 +794,7 @@ class TorrentMetadata(object):
         """
         return self.__data_path
 
-    def set_data_path(self, path):
+    def set_data_path(self, path, include=None, exclude=None, jobs=1):
         """
         Set a data path for the torrent.  When you `:meth:save` the metadata
         a set of piece hashes will be created for the data contained in the files.
@@ -326,25 +802,43 @@ class TorrentMetadata(object):
         :param path: the path to the data you wish to add, this can be a file or
         folder.  If the path is a folder, it will add all files recursively.
         :type path: string
+        :param include: only add the files matching one of these shell
+        patterns, see `DirectoryScanner`
+        :type include: list of strings
+        :param exclude: skip the files and folders matching one of these shell
+        patterns
+        :type exclude: list of strings
+        :param jobs: the number of folders scanned in parallel
+        :type jobs: int
 
         :raises InvalidPath: if the `path` does not exist or if it's not a file
         or folder.
 
         """
-        if not os.path.exists(path):
+        try:
+            st = os.stat(path)
+        except OSError:
             raise InvalidPath("The path %s does not exist!" % path)
 
-        if os.path.isdir(path):
-            self.__data_path = os.path.abspath(path)
-            self.__files = []
-            for (dirpath, dirnames, filenames) in os.walk(path):
-                for filename in filenames:
-                    abspath = os.path.join(os.path.dirname(os.path.abspath(path)), dirpath, filename)
-                    self.__files.append((os.path.join(dirpath, filename), get_path_size(abspath)))
+        # Any files or pieces still to be decoded from a loaded torrent are
+        # replaced by the new data
+        self.__pending.difference_update(("files", "pieces"))
 
-        elif os.path.isfile(path):
+        if stat.S_ISDIR(st.st_mode):
+            self.__data_path = os.path.abspath(path)
+            self.__files = FileTable()
+            self.__files_prefix = path
+            scanner = DirectoryScanner(path, include, exclude, jobs)
+            for components, size, mtime in scanner.scan():
+                self.__files.append(components, size, mtime=mtime)
+            self.__scan_stats = scanner.stats()
+
+        elif stat.S_ISREG(st.st_mode):
             self.__data_path = os.path.abspath(path)
-            self.__files = [(path, get_path_size(os.path.abspath(path)))]
+            self.__files = FileTable()
+            self.__files.append((), st.st_size, mtime=st.st_mtime)
+            self.__files_prefix = path
+            self.__scan_stats = None
         else:
             raise InvalidPath("The path %s is not a file or folder!" % path)
 
@@ -352,6 +846,11 @@ class TorrentMetadata(object):
         # valid
         self.__pieces_hash = ""
         self.__info_hash = ""
+        self.__info_hash_v2 = ""
+        self.__piece_roots = []
+        self.__piece_layers = {}
+        self.__piece_length = 0
+        self.__previous = None
 
     def remove_file(self, index):
         """
@@ -363,15 +862,21 @@ class TorrentMetadata(object):
         :raises KeyError: if the index is invalid
 
         """
-        if index < 0 or index > (len(self.__files) - 1):
+        files = self.files
+        if index < 0 or index > (len(files) - 1):
             raise KeyError("File index %s is invalid!" % index)
 
+        if files.indexes is not None:
+            index = files.indexes[index]
         self.__files.remove(index)
 
         # Reset the pieces hash and info hash if set since they are no longer
         # valid
         self.__pieces_hash = ""
         self.__info_hash = ""
+        self.__info_hash_v2 = ""
+        self.__piece_roots = []
+        self.__piece_layers = {}
 
     def get_piece_size(self):
         """
@@ -400,6 +905,7 @@ class TorrentMetadata(object):
         Comment is some extra info to be stored in the torrent.  This is
         typically an informational string.
         """
+        self.__materialize("outer")
         return self.__comment
 
     def set_comment(self, comment):
@@ -407,6 +913,7 @@ class TorrentMetadata(object):
         :param comment: an informational string
         :type comment: string
         """
+        self.__materialize("outer")
         self.__comment = comment
 
     def get_private(self):
@@ -433,6 +940,7 @@ class TorrentMetadata(object):
         See: http://bittorrent.org/beps/bep_0012.html
 
         """
+        self.__materialize("outer")
         return self.__trackers
 
     def set_trackers(self, trackers):
@@ -440,6 +948,7 @@ class TorrentMetadata(object):
         :param trackers: a list of lists of trackers, each list is a tier
         :type trackers: list of list of strings
         """
+        self.__materialize("outer")
         self.__trackers = trackers
 
     def get_webseeds(self):
@@ -452,6 +961,7 @@ class TorrentMetadata(object):
         If the url ends in '.php' then it will be considered Hoffman-style, if
         not it will be considered GetRight-style.
         """
+        self.__materialize("outer")
         return self.__webseeds
 
     def set_webseeds(self, webseeds):
@@ -459,6 +969,7 @@ class TorrentMetadata(object):
         :param webseeds: the webseeds which can be either Hoffman or GetRight style
         :type webseeds: list of urls
         """
+        self.__materialize("outer")
         self.__webseeds = webseeds
 
     def get_pad_files(self):
@@ -466,6 +977,7 @@ class TorrentMetadata(object):
         If this is True, padding files will be added to align files on piece
         boundaries.
         """
+        self.__materialize("files")
         return self.__pad_files
 
     def set_pad_files(self, pad):
@@ -473,6 +985,7 @@ class TorrentMetadata(object):
         :param pad: set True to align files on piece boundaries
         :type pad: bool
         """
+        self.__materialize("files")
         self.__pad_files = pad
 
     def get_name(self):
@@ -503,16 +1016,133 @@ class TorrentMetadata(object):
         """
         return self.__info_hash
 
+    def get_info_hash_v2(self):
+        """
+        The v2 info-hash of the torrent, a SHA-256 hash of the info dictionary.
+        This is only available for v2 torrents after a load() or save().
+
+        See: http://bittorrent.org/beps/bep_0052.html
+
+        :returns: the v2 info-hash
+        :rtype: string
+
+        """
+        return self.__info_hash_v2
+
+    def get_meta_version(self):
+        """
+        The metadata version of the torrent, 1 for torrents with SHA1 piece
+        hashes and 2 for BitTorrent v2 torrents with a SHA-256 merkle tree per
+        file.  The piece size of a v2 torrent must be a power of two.
+
+        See: http://bittorrent.org/beps/bep_0052.html
+
+        """
+        return self.__meta_version
+
+    def set_meta_version(self, version):
+        """
+        :param version: the metadata version, 1 or 2
+        :type version: int
+
+        :raises ValueError: if the version is not supported
+
+        """
+        if version not in (1, 2):
+            raise ValueError("Unsupported meta version %s" % version)
+        self.__meta_version = version
+        if version == 1:
+            self.__hybrid = False
+
+    def get_hybrid(self):
+        """
+        Hybrid torrents have both v1 and v2 metadata so they can be shared with
+        clients supporting either.  The v1 files are padded to piece
+        boundaries as required to share pieces between the two.
+
+        See: http://bittorrent.org/beps/bep_0052.html
+
+        """
+        return self.__hybrid
+
+    def set_hybrid(self, hybrid):
+        """
+        :param hybrid: True to create a hybrid v1 and v2 torrent
+        :type hybrid: bool
+        """
+        self.__hybrid = hybrid
+        if hybrid:
+            self.__meta_version = 2
+
+    def get_piece_roots(self):
+        """
+        The v2 pieces root of every file in `files`, the root hash of the
+        file's merkle tree.  Empty files have a root of None.  This will only be
+        available for v2 torrents after a load() or save().
+
+        :rtype: list of bytes
+
+        """
+        self.__materialize("files")
+        if not any(self.__piece_roots):
+            return []
+        return [root for root, pad in zip(self.__piece_roots, self.__files.pads)
+                if not pad]
+
+    def get_piece_layers(self):
+        """
+        The v2 piece layers, the concatenated SHA-256 hashes of the pieces of
+        every file larger than a piece, keyed by the file's pieces root.
+
+        :rtype: dict
+
+        """
+        self.__materialize("pieces")
+        return self.__piece_layers
+
+    def get_pieces(self):
+        """
+        The piece hashes of the torrent, a string of 20 byte SHA1 digests, one
+        per piece.  This will only be available after a load() or save().
+
+        :returns: the piece hashes
+        :rtype: bytes, or a bytearray after a save()
+
+        """
+        self.__materialize("pieces")
+        return self.__pieces_hash
+
+    def get_piece_list(self):
+        """
+        The piece hashes as a sequence of 20 byte digests, one per piece.
+
+        :rtype: PieceList
+
+        """
+        return PieceList(self.pieces)
+
     def get_files(self):
         """
         A list of files in the torrent.  This will only have a list of files after
         either a `:meth:set_data_path` operation or a `:meth:load`.
 
         :returns: a list of files and their lengths
-        :rtype: list of 2-tuple(file, length)
+        :rtype: FileList, a sequence of 2-tuple(file, length)
+
+        """
+        self.__materialize("files")
+        return self.__files.file_list(self.__files_prefix)
+
+    def get_scan_stats(self):
+        """
+        The file and folder counts and timing of the scan done by the last
+        `set_data_path` on a folder, see `DirectoryScanner.stats`.
+
+        :returns: the scan stats or None if no folder was scanned
+        :rtype: dict
 
         """
-        return self.__files
+        return self.__scan_stats
 
     piece_size = property(get_piece_size, set_piece_size)
     comment = property(get_comment, set_comment)
@@ -523,4 +1153,12 @@ class TorrentMetadata(object):
     data_path = property(get_data_path, set_data_path)
     name = property(get_name, set_name)
     info_hash = property(get_info_hash)
+    info_hash_v2 = property(get_info_hash_v2)
+    meta_version = property(get_meta_version, set_meta_version)
+    hybrid = property(get_hybrid, set_hybrid)
+    piece_roots = property(get_piece_roots)
+    piece_layers = property(get_piece_layers)
+    pieces = property(get_pieces)
+    piece_list = property(get_piece_list)
     files = property(get_files)
+    scan_stats = property(get_scan_stats)
@@ -0,0 +1,373 @@
+#
+# pipeline.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import sys
+import threading
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
+
+from .storage import PieceReader
+from .zeros import clip_runs, hash_piece
+
+# The default number of chunks waiting to be hashed
+QUEUE_DEPTH = 8
+
+# The default amount of memory used for buffers
+BUFFER_MEMORY = 64 * 1024 * 1024
+
+# The preferred amount of data read into a buffer at once
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# How often blocked threads check whether the pipeline was stopped
+POLL_INTERVAL = 0.1
+
+# Never equal to a device
+_NO_DEVICE = object()
+
+class PipelineStopped(Exception):
+    """
+    Raised in the pipeline threads when the pipeline is shut down early.
+    """
+    pass
+
+class HashPipeline(object):
+    """
+    Hashes the pieces of a `FileStorage` in three stages so reading and
+    hashing overlap: reader threads prefetch chunks of consecutive pieces into
+    a pool of reusable buffers, hasher threads digest the chunks and the
+    consumer gets the digests back in piece order.
+
+    Files on different devices are read in parallel, each device having its
+    own `readers` reader threads, so several disks are kept busy at once.  A
+    chunk spanning files on two devices is read by the readers of the device
+    its first file is on.
+
+    The buffer pool caps the memory in use, `buffer_memory` bytes, and the
+    queue between the readers and the hashers caps the read ahead.  Readers
+    block when either is exhausted, so a slow hasher throttles the disk rather
+    than filling memory.
+
+    hashlib releases the GIL while hashing, so the hasher threads run in
+    parallel with each other and with the readers.  Padding and the holes of
+    sparse files are not copied into the buffers, the hashers feed them from
+    a shared block of zeros instead.
+
+    ** Usage **
+
+    >>> pipeline = HashPipeline(storage, hashers=4)
+    >>> for start, digests in pipeline.iter_batches([(0, 64), (64, 100)]):
+    ...     print(start, len(digests))
+    0 64
+    64 36
+
+    """
+    def __init__(self, storage, readers=1, hashers=1, queue_depth=QUEUE_DEPTH,
+                 buffer_memory=BUFFER_MEMORY, use_mmap=False,
+                 ignore_errors=False, io_policy=None):
+        """
+        :param storage: the storage to hash
+        :type storage: FileStorage
+        :param readers: the number of reader threads per device
+        :type readers: int
+        :param hashers: the number of hasher threads
+        :type hashers: int
+        :param queue_depth: the number of read chunks that may wait for a
+        hasher
+        :type queue_depth: int
+        :param buffer_memory: the memory used by the buffers in bytes, at least
+        two pieces are always allocated
+        :type buffer_memory: int
+        :param use_mmap: map the data files instead of reading them
+        :type use_mmap: bool
+        :param ignore_errors: if True, a piece that cannot be read gets a digest
+        of None instead of raising
+        :type ignore_errors: bool
+        :param io_policy: how the readers read the files
+        :type io_policy: IOPolicy
+
+        """
+        self.storage = storage
+        self.readers = max(1, readers or 1)
+        self.hashers = max(1, hashers or 1)
+        self.queue_depth = max(1, queue_depth or QUEUE_DEPTH)
+        self.buffer_memory = buffer_memory or BUFFER_MEMORY
+        self.use_mmap = use_mmap
+        self.ignore_errors = ignore_errors
+        self.io_policy = io_policy
+
+        piece_size = storage.piece_size
+        # Keep enough buffers for every stage to have one in hand, readers
+        # may be started for several devices
+        min_buffers = 2 * self.readers + self.hashers + 1
+        self.chunk_pieces = max(1, min(CHUNK_SIZE,
+                                       self.buffer_memory // min_buffers) // piece_size)
+        self.chunk_size = self.chunk_pieces * piece_size
+        self.num_buffers = max(2, self.buffer_memory // self.chunk_size)
+
+    def chunks(self, batches):
+        """
+        Split `batches` into the chunks read into a single buffer.
+
+        :returns: a list of lists of 2-tuples (start, stop), one list per batch
+
+        """
+        return [[(i, min(i + self.chunk_pieces, stop))
+                 for i in range(start, stop, self.chunk_pieces)]
+                for start, stop in batches]
+
+    def iter_batches(self, batches):
+        """
+        Hash `batches` of pieces, yielding the results in batch order as soon
+        as they are available.
+
+        :param batches: the batches to hash
+        :type batches: list of 2-tuples (start, stop)
+        :returns: an iterator of 2-tuples (start, digests)
+
+        """
+        chunks = self.chunks(batches)
+        run = _PipelineRun(self, chunks)
+        run.start()
+        try:
+            seq = 0
+            for (start, stop), batch_chunks in zip(batches, chunks):
+                digests = []
+                for _ in batch_chunks:
+                    digests.extend(run.result(seq))
+                    seq += 1
+                yield (start, digests)
+        finally:
+            run.stop()
+
+class _PipelineRun(object):
+    """
+    The threads and queues of a single `HashPipeline.iter_batches` call.
+    """
+    def __init__(self, pipeline, chunks):
+        self.pipeline = pipeline
+        self.storage = pipeline.storage
+        # The chunks numbered in piece order and split into runs on the same
+        # device.  Readers take a whole run at a time so each reads
+        # sequentially.
+        devices = self.storage.devices()
+        self.batches = {}
+        seq = 0
+        for batch_chunks in chunks:
+            # Chunks of padding alone are on no device, None
+            last = _NO_DEVICE
+            for chunk in batch_chunks:
+                device = self.chunk_device(chunk, devices)
+                runs = self.batches.setdefault(device, [])
+                if device != last:
+                    runs.append([])
+                    last = device
+                runs[-1].append((seq, chunk))
+                seq += 1
+        self.next_batch = dict((device, 0) for device in self.batches)
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.free = Queue()
+        # Small runs do not need the whole allowance
+        for i in range(max(1, min(pipeline.num_buffers, seq))):
+            self.free.put(bytearray(pipeline.chunk_size))
+        self.work = Queue(pipeline.queue_depth)
+        self.results = {}
+        self.error = None
+        self.results_ready = threading.Condition(self.lock)
+        self.readers_left = pipeline.readers * len(self.batches)
+        self.threads = []
+        if not self.readers_left:
+            # Nothing to read, the hashers still need to be told
+            for i in range(pipeline.hashers):
+                self.work.put(None)
+
+    def chunk_device(self, chunk, devices):
+        """
+        The device of the first file with data in `chunk`.
+        """
+        piece_size = self.storage.piece_size
+        start, stop = chunk
+        length = (stop - 1 - start) * piece_size + self.storage.piece_length(stop - 1)
+        for file_index, file_offset, size in self.storage.segments(start * piece_size, length):
+            if devices[file_index] is not None:
+                return devices[file_index]
+        return None
+
+    def start(self):
+        for device in self.batches:
+            for i in range(self.pipeline.readers):
+                self.threads.append(threading.Thread(target=self.read_loop,
+                                                     args=(device,)))
+        for i in range(self.pipeline.hashers):
+            self.threads.append(threading.Thread(target=self.hash_loop))
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def stop(self):
+        self.stopped.set()
+        for t in self.threads:
+            t.join()
+
+    def result(self, seq):
+        """
+        Wait for the digests of chunk `seq`.
+
+        :raises: the first error raised by one of the threads
+        """
+        with self.lock:
+            while seq not in self.results and self.error is None:
+                self.results_ready.wait(POLL_INTERVAL)
+            if self.error is not None:
+                exc_info = self.error
+                if sys.version_info[0] >= 3:
+                    raise exc_info[1].with_traceback(exc_info[2])
+                raise exc_info[1]
+            return self.results.pop(seq)
+
+    def set_result(self, seq, result):
+        with self.lock:
+            self.results[seq] = result
+            self.results_ready.notify_all()
+
+    def set_error(self, exc_info):
+        with self.lock:
+            if self.error is None:
+                self.error = exc_info
+            self.results_ready.notify_all()
+
+    def get(self, queue):
+        while True:
+            if self.stopped.is_set():
+                raise PipelineStopped()
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                pass
+
+    def put(self, queue, item):
+        while True:
+            if self.stopped.is_set():
+                raise PipelineStopped()
+            try:
+                return queue.put(item, timeout=POLL_INTERVAL)
+            except Full:
+                pass
+
+    def read_loop(self, device):
+        piece_size = self.storage.piece_size
+        batches = self.batches[device]
+        try:
+            with PieceReader(self.storage, self.pipeline.use_mmap,
+                             self.pipeline.io_policy) as reader:
+                while True:
+                    with self.lock:
+                        if self.next_batch[device] >= len(batches):
+                            break
+                        batch = batches[self.next_batch[device]]
+                        self.next_batch[device] += 1
+                    for seq, (start, stop) in batch:
+                        buf = self.get(self.free)
+                        offset = start * piece_size
+                        length = (stop - 1 - start) * piece_size + \
+                            self.storage.piece_length(stop - 1)
+                        view = memoryview(buf)[:length]
+                        failed = None
+                        try:
+                            zero_runs = reader.read_into(offset, view,
+                                                         skip_zeros=True)
+                        except (IOError, OSError):
+                            if not self.pipeline.ignore_errors:
+                                raise
+                            failed, zero_runs = self.read_pieces(reader, start,
+                                                                 stop, view)
+                        self.put(self.work, (seq, start, stop, buf, failed,
+                                             zero_runs))
+        except PipelineStopped:
+            pass
+        except Exception:
+            self.set_error(sys.exc_info())
+        finally:
+            with self.lock:
+                self.readers_left -= 1
+                last = not self.readers_left
+            if last:
+                try:
+                    for i in range(self.pipeline.hashers):
+                        self.put(self.work, None)
+                except PipelineStopped:
+                    pass
+
+    def read_pieces(self, reader, start, stop, view):
+        """
+        Read the chunk a piece at a time after it failed to read as a whole,
+        to find out which pieces are unreadable.
+
+        :returns: the indexes of the pieces that could not be read and the
+        zero runs of the chunk
+        :rtype: 2-tuple (set, list)
+
+        """
+        piece_size = self.storage.piece_size
+        failed = set()
+        zero_runs = []
+        for index in range(start, stop):
+            pos = (index - start) * piece_size
+            try:
+                runs = reader.read_into(index * piece_size,
+                                        view[pos:pos + self.storage.piece_length(index)],
+                                        skip_zeros=True)
+            except (IOError, OSError):
+                failed.add(index)
+                continue
+            zero_runs.extend((s + pos, e + pos) for s, e in runs)
+        return (failed, zero_runs)
+
+    def hash_loop(self):
+        piece_size = self.storage.piece_size
+        try:
+            while True:
+                item = self.get(self.work)
+                if item is None:
+                    break
+                seq, start, stop, buf, failed, zero_runs = item
+                view = memoryview(buf)
+                digests = []
+                for index in range(start, stop):
+                    if failed and index in failed:
+                        digests.append(None)
+                        continue
+                    pos = (index - start) * piece_size
+                    length = self.storage.piece_length(index)
+                    runs = zero_runs and clip_runs(zero_runs, pos, pos + length)
+                    digests.append(hash_piece(view[pos:pos + length], runs))
+                del view
+                self.free.put(buf)
+                self.set_result(seq, digests)
+        except PipelineStopped:
+            pass
+        except Exception:
+            self.set_error(sys.exc_info())
@@ -0,0 +1,211 @@
+#
+# scanner.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import os
+import stat
+import time
+from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def _listdir(path):
+    """
+    Fallback for `scandir` returning (name, is_dir, is_symlink, stat) tuples,
+    this needs an lstat for every entry.
+    """
+    entries = []
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        st = os.lstat(full)
+        if stat.S_ISLNK(st.st_mode):
+            try:
+                st = os.stat(full)
+            except OSError:
+                entries.append((name, False, True, None))
+                continue
+            entries.append((name, stat.S_ISDIR(st.st_mode), True, st))
+        else:
+            entries.append((name, stat.S_ISDIR(st.st_mode), False, st))
+    return entries
+
+def _matches(patterns, name, relpath):
+    for pattern in patterns:
+        if fnmatch(name, pattern) or fnmatch(relpath, pattern):
+            return True
+    return False
+
+class DirectoryScanner(object):
+    """
+    Lists the files under a directory with a single stat call per file.
+
+    Entries come from `os.scandir`, which gets the file types from the
+    directory listing itself, so only the size and modification time of the
+    files need a stat.  Include and exclude patterns are matched before that,
+    so filtered out files cost nothing.  With `jobs` > 1 the directories of
+    each level of the tree are listed in parallel, which helps on network
+    filesystems where every call is a round trip.
+
+    Patterns are shell style and match either the name of an entry or its path
+    relative to the root, with "/" separators.  Excluded directories are not
+    descended into, include patterns only apply to files.
+
+    The files are returned sorted by path so the result does not depend on the
+    order of the directory listings.
+
+    ** Usage **
+
+    >>> scanner = DirectoryScanner("/tmp/data", exclude=["*.part"], jobs=4)
+    >>> files = scanner.scan()
+    >>> files[0]
+    (('dir', 'file'), 1024, 1255132800.0)
+    >>> scanner.stats()
+    {'files': 10, 'dirs': 3, 'excluded': 1, 'elapsed': 0.002}
+
+    """
+    def __init__(self, root, include=None, exclude=None, jobs=1):
+        """
+        :param root: the directory to scan
+        :type root: string
+        :param include: only files matching one of these patterns are listed
+        :type include: list of strings
+        :param exclude: entries matching one of these patterns are skipped
+        :type exclude: list of strings
+        :param jobs: the number of directories listed in parallel
+        :type jobs: int
+
+        """
+        self.root = root
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self.jobs = max(1, jobs or 1)
+        self.num_files = 0
+        self.num_dirs = 0
+        self.excluded = 0
+        self.elapsed = 0.0
+
+    def scan_dir(self, components):
+        """
+        List a single directory.
+
+        :param components: the path components of the directory below the root
+        :type components: tuple of strings
+        :returns: a 3-tuple (files, dirs, excluded) with files as (components,
+        size, mtime) tuples and dirs as the components of the subdirectories
+        :rtype: tuple
+
+        """
+        path = os.path.join(self.root, *components)
+        prefix = "".join(c + "/" for c in components)
+        files = []
+        dirs = []
+        excluded = 0
+
+        if scandir is not None:
+            it = scandir(path)
+            entries = ((e.name, e.is_dir(), e.is_symlink(), e) for e in it)
+        else:
+            it = None
+            entries = _listdir(path)
+
+        try:
+            for name, is_dir, is_symlink, entry in entries:
+                relpath = prefix + name
+                if self.exclude and _matches(self.exclude, name, relpath):
+                    excluded += 1
+                    continue
+                if is_dir:
+                    # Like os.walk, symlinks to directories are not followed
+                    if not is_symlink:
+                        dirs.append(components + (name,))
+                    continue
+                if self.include and not _matches(self.include, name, relpath):
+                    excluded += 1
+                    continue
+                st = entry.stat() if it is not None else entry
+                if st is None:
+                    raise OSError("%s is a broken symlink" %
+                                  os.path.join(path, name))
+                files.append((components + (name,), st.st_size, st.st_mtime))
+        finally:
+            if hasattr(it, "close"):
+                it.close()
+        return (files, dirs, excluded)
+
+    def scan(self):
+        """
+        Scan the directory tree.
+
+        :returns: the files sorted by path
+        :rtype: list of 3-tuples (components, size, mtime)
+
+        """
+        start = time.time()
+        files = []
+        self.num_dirs = 0
+        self.excluded = 0
+
+        pool = ThreadPool(self.jobs) if self.jobs > 1 else None
+        try:
+            level = [()]
+            while level:
+                self.num_dirs += len(level)
+                if pool:
+                    results = pool.map(self.scan_dir, level)
+                else:
+                    results = [self.scan_dir(d) for d in level]
+                level = []
+                for f, d, excluded in results:
+                    files.extend(f)
+                    level.extend(d)
+                    self.excluded += excluded
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        files.sort()
+        self.num_files = len(files)
+        self.elapsed = time.time() - start
+        return files
+
+    def stats(self):
+        """
+        The counts and timing of the last scan.
+
+        :returns: files listed, directories visited, entries filtered out and
+        the seconds the scan took
+        :rtype: dict
+
+        """
+        return {
+            "files": self.num_files,
+            "dirs": self.num_dirs,
+            "excluded": self.excluded,
+            "elapsed": self.elapsed,
+        }
@@ -0,0 +1,337 @@
+#
+# storage.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import mmap
+import os
+from array import array
+from bisect import bisect_right
+
+from .iopolicy import IOPolicy
+from .zeros import add_run, data_extents, is_sparse
+
+class FileStorage(object):
+    """
+    Maps the contiguous piece space of a torrent onto the files that back it.
+
+    The storage is described by an ordered sequence of `(path, length)`
+    entries, such as a list or `FileTable.storage_entries()`.  A `path` of None
+    marks a padding file, which is read back as zeros.
+
+    ** Usage **
+
+    >>> s = FileStorage([("/tmp/a", 10), (None, 6), ("/tmp/b", 20)], 16)
+    >>> s.num_pieces
+    3
+    >>> list(s.piece_segments(2))
+    [(2, 16, 4)]
+
+    """
+    def __init__(self, files, piece_size):
+        self.files = files
+        self.piece_size = piece_size
+
+        # The starting offset of every file in the piece space
+        self.offsets = array("Q")
+        offset = 0
+        for path, length in self.files:
+            self.offsets.append(offset)
+            offset += length
+
+        self.total_size = offset
+        self.num_pieces = (offset + piece_size - 1) // piece_size
+
+    def __getstate__(self):
+        return (self.files, self.piece_size)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def piece_length(self, index):
+        """
+        The length in bytes of the piece at `index`.  Only the last piece may
+        be shorter than the piece size.
+
+        """
+        return min(self.piece_size, self.total_size - index * self.piece_size)
+
+    def segments(self, offset, length):
+        """
+        Split a region of the piece space into the file regions covering it.
+
+        :param offset: the offset in the piece space
+        :type offset: int
+        :param length: the length of the region
+        :type length: int
+        :returns: an iterator of 3-tuples (file_index, file_offset, length)
+
+        """
+        index = bisect_right(self.offsets, offset) - 1
+        while length > 0 and index < len(self.files):
+            file_offset = offset - self.offsets[index]
+            chunk = min(length, self.files[index][1] - file_offset)
+            if chunk > 0:
+                yield (index, file_offset, chunk)
+                offset += chunk
+                length -= chunk
+            index += 1
+
+    def piece_segments(self, index):
+        """
+        The file regions covering the piece at `index`.
+
+        :returns: an iterator of 3-tuples (file_index, file_offset, length)
+
+        """
+        return self.segments(index * self.piece_size, self.piece_length(index))
+
+    def devices(self):
+        """
+        The device holding every file, padding and missing files being on no
+        device.
+
+        :returns: the st_dev of every file or None
+        :rtype: list
+
+        """
+        devices = []
+        for path, length in self.files:
+            try:
+                devices.append(None if path is None else os.stat(path).st_dev)
+            except OSError:
+                devices.append(None)
+        return devices
+
+    def piece_range(self, file_index):
+        """
+        The pieces that contain data from the file at `file_index`.
+
+        :returns: a 2-tuple (first, stop) suitable for range()
+
+        """
+        start = self.offsets[file_index]
+        length = self.files[file_index][1]
+        if not length:
+            first = start // self.piece_size
+            return (first, first)
+        return (start // self.piece_size,
+                (start + length - 1) // self.piece_size + 1)
+
+class PieceReader(object):
+    """
+    Assembles pieces of a `FileStorage` into a single preallocated buffer.
+
+    Data is read with readinto() directly into the buffer and handed out as a
+    memoryview, so no intermediate strings are created.  With `use_mmap` the
+    files are mapped instead and a piece lying within a single file is returned
+    as a view of the mapping without being copied at all.  Files are opened
+    through `io_policy`, see `IOPolicy`.
+
+    The holes of sparse files are found with SEEK_DATA and SEEK_HOLE and are
+    not read.  Callers able to hash zeros without reading them can ask
+    read_into() to leave the holes and padding out of the buffer altogether.
+
+    The returned view is only valid until the next read, so a reader should be
+    owned by a single worker.
+
+    ** Usage **
+
+    >>> with PieceReader(storage) as reader:
+    ...     digest = sha1(reader.read_piece(0)).digest()
+
+    """
+    def __init__(self, storage, use_mmap=False, io_policy=None):
+        self.storage = storage
+        self.use_mmap = use_mmap
+        self.io_policy = io_policy or IOPolicy()
+        self.buffer = bytearray(storage.piece_size)
+        self.view = memoryview(self.buffer)
+        self.__fd = None
+        self.__fd_index = None
+        self.__map = None
+        self.__zeros = None
+        self.__size = None
+        self.__extents = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Close any file held open by the reader.
+        """
+        if self.__map is not None:
+            try:
+                self.__map.close()
+            except BufferError:
+                # A caller still holds a view, the map is closed once the view
+                # goes away.
+                pass
+            self.__map = None
+        if self.__fd is not None:
+            self.__fd.close()
+            self.__fd = None
+        self.__fd_index = None
+        self.__extents = None
+
+    def __open(self, file_index):
+        if file_index == self.__fd_index:
+            return
+        self.close()
+        self.__fd = self.io_policy.open(self.storage.files[file_index][0])
+        self.__fd_index = file_index
+        if self.use_mmap and self.storage.files[file_index][1]:
+            self.__map = mmap.mmap(self.__fd.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            st = os.fstat(self.__fd.fileno())
+            self.__size = st.st_size
+            if is_sparse(st):
+                self.__extents = data_extents(self.__fd.fileno(), st.st_size)
+
+    def __zero_fill(self, view, zero_runs, pos):
+        """
+        Fill `view` with zeros, or record it in `zero_runs` at `pos` if the
+        caller hashes zeros itself.
+        """
+        if zero_runs is not None:
+            add_run(zero_runs, pos, pos + len(view))
+            return
+        if self.__zeros is None:
+            self.__zeros = memoryview(bytearray(self.storage.piece_size))
+        while len(view):
+            size = min(len(view), len(self.__zeros))
+            view[:size] = self.__zeros[:size]
+            view = view[size:]
+
+    def __fill(self, file_index, file_offset, view, zero_runs=None, pos=0):
+        """
+        Fill `view` with data from the file at `file_index`.  `pos` is where
+        `view` lies in the buffer `zero_runs` describes.
+        """
+        path, length = self.storage.files[file_index]
+        if path is None:
+            self.__zero_fill(view, zero_runs, pos)
+            return
+
+        self.__open(file_index)
+        if self.__map is not None:
+            if file_offset + len(view) > len(self.__map):
+                raise IOError("%s is shorter than expected" % path)
+            view[:] = memoryview(self.__map)[file_offset:file_offset + len(view)]
+            self.io_policy.stats.add(len(view))
+            return
+
+        if self.__extents is None:
+            self.__fd.readinto_at(view, file_offset)
+            return
+
+        end = file_offset + len(view)
+        if end > self.__size:
+            raise IOError("%s is shorter than expected" % path)
+        offset = file_offset
+        for start, stop in self.__extents:
+            if stop <= offset:
+                continue
+            if start >= end:
+                break
+            if start > offset:
+                self.__zero_fill(view[offset - file_offset:start - file_offset],
+                                 zero_runs, pos + offset - file_offset)
+                offset = start
+            stop = min(stop, end)
+            self.__fd.readinto_at(view[offset - file_offset:stop - file_offset],
+                                  offset)
+            offset = stop
+        if offset < end:
+            self.__zero_fill(view[offset - file_offset:], zero_runs,
+                             pos + offset - file_offset)
+
+    def read(self, offset, length):
+        """
+        Read a region of the piece space.
+
+        :param offset: the offset in the piece space
+        :type offset: int
+        :param length: the number of bytes, at most the piece size
+        :type length: int
+        :returns: a view of the data, valid until the next read
+        :rtype: memoryview
+
+        :raises IOError: if a file is missing or shorter than expected
+
+        """
+        segments = list(self.storage.segments(offset, length))
+        if self.use_mmap and len(segments) == 1 and \
+                self.storage.files[segments[0][0]][0] is not None:
+            # The region lies within one file, hand out the mapping itself
+            file_index, file_offset, length = segments[0]
+            self.__open(file_index)
+            if self.__map is not None and file_offset + length <= len(self.__map):
+                # Count the mapped region as a read, the pages are faulted in
+                # when it is hashed
+                self.io_policy.stats.add(length)
+                return memoryview(self.__map)[file_offset:file_offset + length]
+
+        self.read_into(offset, self.view[:length], segments)
+        return self.view[:length]
+
+    def read_into(self, offset, view, segments=None, skip_zeros=False):
+        """
+        Read a region of the piece space into a caller supplied buffer.
+
+        :param offset: the offset in the piece space
+        :type offset: int
+        :param view: the buffer to fill, the region is as long as the buffer
+        :type view: memoryview
+        :param skip_zeros: leave padding and holes out of the buffer
+        :type skip_zeros: bool
+        :returns: if `skip_zeros` is True, the sorted (start, stop) ranges of
+        `view` that were left out and are zeros, otherwise None
+        :rtype: list of 2-tuples
+
+        :raises IOError: if a file is missing or shorter than expected
+
+        """
+        if segments is None:
+            segments = self.storage.segments(offset, len(view))
+        zero_runs = [] if skip_zeros else None
+        pos = 0
+        for file_index, file_offset, length in segments:
+            self.__fill(file_index, file_offset, view[pos:pos + length],
+                        zero_runs, pos)
+            pos += length
+        return zero_runs
+
+    def read_piece(self, index):
+        """
+        Read the piece at `index`.
+
+        :returns: a view of the piece data, valid until the next read
+        :rtype: memoryview
+
+        :raises IOError: if a file is missing or shorter than expected
+
+        """
+        return self.read(index * self.storage.piece_size,
+                         self.storage.piece_length(index))
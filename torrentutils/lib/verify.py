@@ -0,0 +1,404 @@
+#
+# verify.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import math
+import os
+import random
+
+from .filetable import PieceList
+from .hasher import PieceHasher
+from .pipeline import QUEUE_DEPTH, BUFFER_MEMORY
+
+# File states reported by the verifier
+OK = "ok"
+CORRUPT = "corrupt"
+MISSING = "missing"
+TRUNCATED = "truncated"
+OVERSIZED = "oversized"
+
+def sample_size(confidence, tolerance):
+    """
+    The number of pieces to sample at random to find a corrupt piece with
+    probability `confidence` when at least a `tolerance` fraction of the
+    pieces are corrupt.
+
+    :param confidence: the probability of detection, between 0 and 1
+    :type confidence: float
+    :param tolerance: the fraction of corrupt pieces to detect, between 0
+    and 1
+    :type tolerance: float
+    :rtype: int
+
+    """
+    return int(math.ceil(math.log(1 - confidence) / math.log(1 - tolerance)))
+
+def file_ends(storage):
+    """
+    The first and last piece of every file, that a sample always checks.
+
+    :rtype: set of ints
+
+    """
+    ends = set()
+    for index, (path, length) in enumerate(storage.files):
+        if path is None or not length:
+            continue
+        first, stop = storage.piece_range(index)
+        ends.add(first)
+        ends.add(stop - 1)
+    return ends
+
+def sample_pieces(storage, count, seed=None):
+    """
+    Pick a stratified random sample of the pieces of `storage`.  The first and
+    last piece of every file are always included, so every file is checked
+    for truncation, the rest of the sample is one random piece from each of
+    equal strata of the piece space.  A piece picked twice is only checked
+    once, so the sample may be a little smaller than `count`.
+
+    :param count: the number of pieces to sample, at least the first and last
+    piece of every file are picked
+    :type count: int
+    :param seed: the seed of the random choice, the same seed picks the same
+    pieces
+    :type seed: int
+    :returns: the sampled pieces in piece order
+    :rtype: list of ints
+
+    """
+    num_pieces = storage.num_pieces
+    picked = file_ends(storage)
+    strata = min(num_pieces, count - len(picked))
+    rng = random.Random(seed)
+    for i in range(max(0, strata)):
+        start = i * num_pieces // strata
+        stop = (i + 1) * num_pieces // strata
+        picked.add(rng.randrange(start, stop))
+    return sorted(picked)
+
+def _log_choose(n, k):
+    return math.lgamma(n + 1) - math.lgamma(k + 1) - math.lgamma(n - k + 1)
+
+def _log_hypergeom_cdf(k, population, bad, n):
+    """
+    The log of P(X <= k) where X is the number of bad pieces in a sample of
+    `n` drawn without replacement from `population` pieces of which `bad` are
+    bad.
+    """
+    terms = [_log_choose(bad, i) + _log_choose(population - bad, n - i)
+             for i in range(max(0, n - population + bad), min(k, bad, n) + 1)]
+    if not terms:
+        return float("-inf")
+    top = max(terms)
+    return top + math.log(sum(math.exp(t - top) for t in terms)) - \
+        _log_choose(population, n)
+
+def max_corrupt(population, sampled, failed, confidence):
+    """
+    An upper bound on the number of corrupt pieces in a population given a
+    random sample drawn from it without replacement, the exact one sided
+    hypergeometric bound.  The stratified sample is assumed to behave as a
+    simple random sample.  When the whole population was sampled the bound
+    is the number of failures itself.
+
+    :param population: the number of pieces the sample was drawn from
+    :type population: int
+    :param sampled: the number of pieces sampled
+    :type sampled: int
+    :param failed: the number of sampled pieces that failed
+    :type failed: int
+    :param confidence: the confidence of the bound, between 0 and 1
+    :type confidence: float
+    :returns: the number of pieces that may be corrupt
+    :rtype: int
+
+    """
+    if sampled >= population:
+        return failed
+    target = math.log(1 - confidence)
+    # Any number of bad pieces that leaves the failures at least this likely
+    # is plausible, the probability falls as the bad pieces grow
+    low, high = failed, population - (sampled - failed)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if _log_hypergeom_cdf(failed, population, mid, sampled) > target:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+class FileResult(object):
+    """
+    The verification state of a single file.  `key` is the (device, inode,
+    size, mtime) of the file when it was checked, None if it is missing.
+    """
+    def __init__(self, index, path, length):
+        self.index = index
+        self.path = path
+        self.length = length
+        self.status = OK
+        self.bad_pieces = 0
+        self.key = None
+
+    def to_dict(self):
+        return {
+            "path": self.path,
+            "length": self.length,
+            "status": self.status,
+            "bad_pieces": self.bad_pieces,
+        }
+
+class VerifyResult(object):
+    """
+    The outcome of a verification run.  `piece_ok` holds a byte per piece set
+    to 1 if the piece matched its hash, `checked` a byte per piece set to 1 if
+    the piece was hashed or known to be good.  `reused` counts the pieces
+    known to be good from a previous check.  A sampled run sets `sample` to
+    the details of the sample.
+    """
+    def __init__(self, num_pieces):
+        self.num_pieces = num_pieces
+        self.piece_ok = bytearray(num_pieces)
+        self.checked = bytearray(num_pieces)
+        self.files = []
+        self.reused = 0
+        self.sample = None
+
+    def get_failed_pieces(self):
+        """
+        The indexes of the checked pieces that did not match.
+        """
+        return [i for i in range(self.num_pieces)
+                if self.checked[i] and not self.piece_ok[i]]
+
+    def get_num_checked(self):
+        """
+        The number of pieces that were hashed or reused.
+        """
+        return self.num_pieces - self.checked.count(0)
+
+    def get_ok(self):
+        """
+        True if every checked piece and every file checked out.
+        """
+        return self.checked == self.piece_ok and \
+            all(f.status == OK for f in self.files)
+
+    def summary(self):
+        """
+        A machine readable summary of the run.
+
+        :rtype: dict
+
+        """
+        failed = self.failed_pieces
+        summary = {
+            "ok": self.ok,
+            "num_pieces": self.num_pieces,
+            "pieces_checked": self.num_checked,
+            "pieces_passed": self.num_checked - len(failed),
+            "pieces_failed": len(failed),
+            "pieces_reused": self.reused,
+            "failed_pieces": failed,
+            "files": [f.to_dict() for f in self.files],
+        }
+        if self.sample is not None:
+            summary["sample"] = self.sample
+        return summary
+
+    failed_pieces = property(get_failed_pieces)
+    num_checked = property(get_num_checked)
+    ok = property(get_ok)
+
+class TorrentVerifier(object):
+    """
+    Verifies data on disk against the piece hashes of a torrent.  The data is
+    streamed through a `PieceHasher`, so only a byte per piece is kept no
+    matter the size of the payload.
+
+    Missing and truncated files do not abort the run, the pieces they cover are
+    simply reported as failed.
+
+    A quick check can hash a sample of the pieces instead, see
+    `sample_pieces`.  The sample is hashed in piece order so the reads stay
+    sequential.  Pieces known to be good from a previous check, see
+    `VerifyState`, can be skipped.
+
+    ** Usage **
+
+    >>> t = TorrentMetadata()
+    >>> t.load("/tmp/test.torrent")
+    >>> v = TorrentVerifier(t.get_storage("/tmp"), t.pieces, jobs=4)
+    >>> v.verify().ok
+    True
+
+    """
+    def __init__(self, storage, pieces, jobs=1, processes=False,
+                 use_mmap=False, queue_depth=QUEUE_DEPTH,
+                 buffer_memory=BUFFER_MEMORY, io_policy=None):
+        self.storage = storage
+        self.pieces = pieces
+        self.hasher = PieceHasher(storage, jobs, processes, use_mmap,
+                                  True, queue_depth, buffer_memory, io_policy)
+
+    def precheck(self):
+        """
+        Check that every file exists with the expected size.  This only uses
+        stat() so it is cheap to run before hashing.
+
+        :returns: the state of every non-padding file
+        :rtype: list of FileResult
+
+        """
+        results = []
+        for index, (path, length) in enumerate(self.storage.files):
+            if path is None:
+                continue
+            result = FileResult(index, path, length)
+            try:
+                st = os.stat(path)
+            except OSError:
+                result.status = MISSING
+            else:
+                size = st.st_size
+                result.key = (st.st_dev, st.st_ino, size, st.st_mtime)
+                if size < length:
+                    result.status = TRUNCATED
+                elif size > length:
+                    result.status = OVERSIZED
+            results.append(result)
+        return results
+
+    def verify(self, progress=None, pieces=None, files=None, known=None):
+        """
+        Hash the data and compare it against the piece hashes.
+
+        :param progress: a function to be called as pieces are checked
+        :type progress: function(num_completed, num_pieces)
+        :param pieces: only check these pieces, in piece order
+        :type pieces: list of ints
+        :param files: the result of `precheck`, if it was already run
+        :type files: list of FileResult
+        :param known: a byte per piece set to 1 if the piece is known to be
+        good and need not be hashed, these pieces are reported as good even if
+        they are not in `pieces`
+        :type known: bytearray
+        :returns: the result of the run
+        :rtype: VerifyResult
+
+        """
+        num_pieces = self.storage.num_pieces
+        result = VerifyResult(num_pieces)
+        result.files = self.precheck() if files is None else files
+
+        if known and any(known):
+            # Known pieces stay good whether or not they are in `pieces`, so a
+            # partial run does not forget them
+            result.piece_ok[:] = known
+            result.checked[:] = known
+            result.reused = num_pieces - known.count(0)
+        else:
+            known = None
+
+        if pieces is None and not known:
+            batches = self.hasher.batches()
+        else:
+            if pieces is None:
+                pieces = range(num_pieces)
+            # Runs of consecutive pieces are read as one batch
+            runs = []
+            for index in pieces:
+                if known and known[index]:
+                    continue
+                elif runs and runs[-1][1] == index:
+                    runs[-1][1] = index + 1
+                else:
+                    runs.append([index, index + 1])
+            batches = []
+            for start, stop in runs:
+                batches.extend(self.hasher.batches(start, stop))
+        total = sum(stop - start for start, stop in batches)
+
+        if progress:
+            progress(0, total)
+
+        expected = PieceList(self.pieces)
+        completed = 0
+        for start, digests in self.hasher.iter_batches(batches):
+            for index, digest in enumerate(digests, start):
+                result.checked[index] = 1
+                if digest == expected[index]:
+                    result.piece_ok[index] = 1
+            completed += len(digests)
+            if progress:
+                progress(completed, total)
+
+        for f in result.files:
+            first, stop = self.storage.piece_range(f.index)
+            f.bad_pieces = sum(result.checked[first:stop]) - \
+                sum(result.piece_ok[first:stop])
+            if f.status == OK and f.bad_pieces:
+                f.status = CORRUPT
+
+        return result
+
+    def verify_sample(self, count, seed=None, confidence=0.95, progress=None,
+                      files=None, known=None):
+        """
+        Hash a stratified random sample of the pieces, see `sample_pieces`.
+
+        The sample details are stored in the `sample` of the result, with the
+        fraction of the pieces that may be corrupt at the given `confidence`.
+        The bound only rests on the random part of the sample that was hashed:
+        the first and last pieces of the files and the pieces in `known` are
+        counted as they are, and the random pieces stand for the others.
+
+        :param count: the number of pieces to check
+        :type count: int
+        :param seed: the seed of the sample
+        :type seed: int
+        :param confidence: the confidence of the corruption bound
+        :type confidence: float
+        :returns: the result of the run, see `verify`
+        :rtype: VerifyResult
+
+        """
+        num_pieces = self.storage.num_pieces
+        pieces = sample_pieces(self.storage, count, seed)
+        result = self.verify(progress, pieces, files, known)
+
+        ends = file_ends(self.storage)
+        if known:
+            ends = set(i for i in ends if not known[i])
+        ends_failed = sum(1 for i in ends if not result.piece_ok[i])
+        drawn = [i for i in pieces if i not in ends and not (known and known[i])]
+        drawn_failed = sum(1 for i in drawn if not result.piece_ok[i])
+        population = num_pieces - result.reused - len(ends)
+        bad = max_corrupt(population, len(drawn), drawn_failed, confidence)
+        result.sample = {
+            "seed": seed,
+            "confidence": confidence,
+            "random_pieces": len(drawn),
+            "corruption_bound": float(bad + ends_failed) / num_pieces
+                                if num_pieces else 0.0,
+        }
+        return result
@@ -0,0 +1,177 @@
+#
+# verifystate.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import sqlite3
+import time
+
+from .verify import OK, CORRUPT
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS torrents (
+    info_hash TEXT PRIMARY KEY,
+    num_pieces INTEGER NOT NULL,
+    verified BLOB NOT NULL,
+    last_verified REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    info_hash TEXT NOT NULL,
+    file_index INTEGER NOT NULL,
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (info_hash, file_index)
+);
+"""
+
+# Files modified this recently are not remembered, a change within the
+# resolution of their mtime would go unnoticed
+MTIME_SLACK = 2
+
+def pack_bits(flags):
+    """
+    Pack a byte per piece into a bitfield, the first piece being the high bit
+    of the first byte.
+
+    :type flags: bytearray
+    :rtype: bytes
+
+    """
+    bits = bytearray((len(flags) + 7) // 8)
+    for i, flag in enumerate(flags):
+        if flag:
+            bits[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(bits)
+
+def unpack_bits(bits, count):
+    """
+    Unpack a bitfield made by pack_bits() into a byte per piece.
+
+    :rtype: bytearray
+
+    """
+    bits = bytearray(bits)
+    return bytearray((bits[i >> 3] >> (7 - (i & 7))) & 1 for i in range(count))
+
+class VerifyState(object):
+    """
+    A persistent record of the pieces of each torrent that passed
+    verification, with the identity of the files they were read from, so
+    repeat checks only hash the pieces whose files changed.
+
+    A file is unchanged if its (device, inode, size, mtime) is the same as
+    when it was last checked, as seen by `TorrentVerifier.precheck`.  Only the
+    pieces that passed are remembered, failed pieces are always hashed again.
+
+    ** Usage **
+
+    >>> state = VerifyState("/tmp/verify.db")
+    >>> files = verifier.precheck()
+    >>> known = state.lookup(t.info_hash, storage, files)
+    >>> result = verifier.verify(files=files, known=known)
+    >>> state.store(t.info_hash, storage, result)
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __known(self, info_hash, storage, files, statuses):
+        """
+        The stored pieces whose files have the same identity as in `files`
+        and one of `statuses`.
+        """
+        num_pieces = storage.num_pieces
+        row = self.db.execute(
+            "SELECT num_pieces, verified FROM torrents WHERE info_hash = ?",
+            (info_hash,)).fetchone()
+        if not row or row[0] != num_pieces:
+            return bytearray(num_pieces)
+        known = unpack_bits(row[1], num_pieces)
+
+        stored = dict((r[0], tuple(r[1:])) for r in self.db.execute(
+            "SELECT file_index, dev, ino, size, mtime FROM files "
+            "WHERE info_hash = ?", (info_hash,)))
+        for f in files:
+            if f.status in statuses and f.key is not None and \
+                    stored.get(f.index) == f.key:
+                continue
+            first, stop = storage.piece_range(f.index)
+            known[first:stop] = bytearray(stop - first)
+        return known
+
+    def lookup(self, info_hash, storage, files):
+        """
+        Find the pieces that passed the last check and whose files have not
+        changed since.
+
+        :param info_hash: the info-hash of the torrent
+        :type info_hash: string
+        :param storage: the storage about to be verified
+        :type storage: FileStorage
+        :param files: the result of the precheck of the storage
+        :type files: list of FileResult
+        :returns: a byte per piece set to 1 if the piece is known to be good
+        :rtype: bytearray
+
+        """
+        return self.__known(info_hash, storage, files, (OK,))
+
+    def store(self, info_hash, storage, result):
+        """
+        Remember the pieces that passed a check and the files they were read
+        from.  The pieces the check did not hash keep their previous state if
+        their files did not change, so a sampled check only adds to it.
+
+        :param info_hash: the info-hash of the torrent
+        :type info_hash: string
+        :param storage: the storage that was verified
+        :type storage: FileStorage
+        :param result: the result of the check
+        :type result: VerifyResult
+
+        """
+        now = time.time()
+        verified = bytearray(result.piece_ok)
+        previous = self.__known(info_hash, storage, result.files, (OK, CORRUPT))
+        for index in range(result.num_pieces):
+            if previous[index] and not result.checked[index]:
+                verified[index] = 1
+        self.db.execute("DELETE FROM files WHERE info_hash = ?", (info_hash,))
+        for f in result.files:
+            # The good pieces of a corrupt file are still worth keeping
+            if f.status not in (OK, CORRUPT) or f.key is None or \
+                    f.key[3] > now - MTIME_SLACK:
+                first, stop = storage.piece_range(f.index)
+                verified[first:stop] = bytearray(stop - first)
+                continue
+            self.db.execute("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                            (info_hash, f.index) + f.key)
+        self.db.execute(
+            "INSERT OR REPLACE INTO torrents VALUES (?, ?, ?, ?)",
+            (info_hash, result.num_pieces,
+             sqlite3.Binary(pack_bits(verified)), now))
+        self.db.commit()
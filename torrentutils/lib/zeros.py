@@ -0,0 +1,195 @@
+#
+# zeros.py
+#
+# Copyright (C) 2009 Andrew Resch <andrewresch@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA    02110-1301, USA.
+#
+
+import errno
+import os
+from bisect import bisect_right
+import threading
+from hashlib import sha1 as sha
+
+# The zeros hashed at once, shared by every caller
+ZERO_CHUNK = 1024 * 1024
+
+# The number of zero prefix hash states kept
+PREFIX_CACHE_SIZE = 64
+
+_zeros = memoryview(bytearray(ZERO_CHUNK))
+_lock = threading.Lock()
+_digests = {}
+_prefixes = {}
+
+def update_zeros(h, length, zeros=_zeros):
+    """
+    Feed `length` zero bytes to the hash object `h` without allocating them.
+    """
+    while length:
+        size = min(length, len(zeros))
+        h.update(zeros[:size])
+        length -= size
+    return h
+
+def zero_digest(length, hash=sha):
+    """
+    The digest of `length` zero bytes, computed once per length.
+
+    :param hash: the hash constructor, SHA1 by default
+    :type hash: function
+    :rtype: bytes
+
+    """
+    key = (hash, length)
+    digest = _digests.get(key)
+    if digest is None:
+        digest = update_zeros(hash(), length).digest()
+        with _lock:
+            _digests[key] = digest
+    return digest
+
+def zero_prefix(length):
+    """
+    A SHA1 hash object that has been fed `length` zero bytes, the states of
+    recent lengths are cached.
+
+    :rtype: hash object
+
+    """
+    h = _prefixes.get(length)
+    if h is None:
+        h = update_zeros(sha(), length)
+        with _lock:
+            if len(_prefixes) >= PREFIX_CACHE_SIZE:
+                _prefixes.clear()
+            _prefixes[length] = h
+    return h.copy()
+
+def hash_piece(view, zero_runs=None):
+    """
+    Hash a piece whose `zero_runs` are known to be zeros, the contents of
+    `view` in those runs are ignored.
+
+    :param view: the piece data
+    :type view: memoryview
+    :param zero_runs: sorted, non overlapping (start, stop) ranges of `view`
+    :type zero_runs: list of 2-tuples
+    :returns: the SHA1 digest
+    :rtype: bytes
+
+    """
+    if not zero_runs:
+        return sha(view).digest()
+    length = len(view)
+    start, stop = zero_runs[0]
+    if start == 0 and stop >= length:
+        return zero_digest(length)
+
+    if start == 0:
+        h = zero_prefix(stop)
+        pos = stop
+        zero_runs = zero_runs[1:]
+    else:
+        h = sha()
+        pos = 0
+    for start, stop in zero_runs:
+        if start > pos:
+            h.update(view[pos:start])
+        update_zeros(h, stop - start)
+        pos = stop
+    if pos < length:
+        h.update(view[pos:])
+    return h.digest()
+
+def add_run(runs, start, stop):
+    """
+    Append the zero run [start, stop) to `runs`, merging it with the last run
+    if they touch.
+    """
+    if runs and runs[-1][1] == start:
+        runs[-1] = (runs[-1][0], stop)
+    elif stop > start:
+        runs.append((start, stop))
+
+def clip_runs(runs, start, stop):
+    """
+    The parts of `runs` within [start, stop), relative to `start`.
+
+    :rtype: list of 2-tuples
+
+    """
+    clipped = []
+    for s, e in runs:
+        if e <= start:
+            continue
+        if s >= stop:
+            break
+        clipped.append((max(s, start) - start, min(e, stop) - start))
+    return clipped
+
+def data_extents(fd, size):
+    """
+    Find the regions of a file holding data with SEEK_DATA and SEEK_HOLE.
+
+    :param fd: an open file descriptor
+    :type fd: int
+    :param size: the size of the file
+    :type size: int
+    :returns: the (start, stop) data regions or None if the file system can not
+    tell holes apart
+    :rtype: list of 2-tuples
+
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        return None
+    extents = []
+    pos = 0
+    try:
+        while pos < size:
+            try:
+                start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # Only a hole is left
+                    break
+                raise
+            stop = os.lseek(fd, start, os.SEEK_HOLE)
+            extents.append((start, min(stop, size)))
+            pos = stop
+    except OSError:
+        return None
+    return extents
+
+def in_hole(extents, start, stop):
+    """
+    True if [start, stop) holds no data according to the sorted `extents`
+    returned by data_extents().
+    """
+    i = bisect_right(extents, (start, float("inf"))) - 1
+    if i >= 0 and extents[i][1] > start:
+        return False
+    return i + 1 >= len(extents) or extents[i + 1][0] >= stop
+
+def is_sparse(st):
+    """
+    True if the file of the stat result `st` has fewer blocks allocated than
+    its size needs.
+    """
+    blocks = getattr(st, "st_blocks", None)
+    return blocks is not None and blocks * 512 < st.st_size
@@ -22,12 +22,26 @@
 
 from __future__ import division
 
+import csv
+import json
+import os
+import random
 import sys
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 
 import pkg_resources
 
+from .lib import editor
+from .lib import hashcache
+from .lib import index
+from .lib import locate
+from .lib import iopolicy
 from .lib import metadata
+from .lib import pipeline
+from .lib import verify
+from .lib import verifystate
 
 version = pkg_resources.require("torrentutils")[0].version
 
@@ -65,6 +79,127 @@ def fsize(fsize_b):
     fsize_gb = fsize_mb / 1024.0
     return "%.1f GiB" % fsize_gb
 
+def progress(completed, num_pieces, label="Pieces"):
+    """
+    Prints a progress bar for a hashing run.  Nothing is printed when there is
+    nothing to do.
+
+    :param completed: the number of pieces done
+    :type completed: int
+    :param num_pieces: the total number of pieces
+    :type num_pieces: int
+    :param label: what is being counted
+    :type label: string
+
+    """
+    if not num_pieces:
+        return
+    ratio = completed / num_pieces
+    cols = 60
+    blocks = int(round((cols - 2) * ratio))
+    sys.stdout.write("Percent: %.2f%% %s: %s/%s  [" % (ratio*100, label, completed, num_pieces)\
+     + "#" * blocks + "~" * (cols - 2 - blocks) + "]\r")
+    if completed == num_pieces:
+        print("\n")
+
+def io_policy(parser, options):
+    """
+    Create the I/O policy selected by the --io and --readahead options.
+
+    :rtype: IOPolicy
+
+    """
+    try:
+        return iopolicy.IOPolicy(options.io, options.readahead * 1024 * 1024)
+    except ValueError as e:
+        parser.error(str(e))
+
+def torrent_progress(completed, num_torrents):
+    """
+    Prints a progress bar for loading torrents, see `progress`.
+    """
+    progress(completed, num_torrents, "Torrents")
+
+def print_io_stats(stats):
+    """
+    Prints the summary of an `IOStats`.
+    """
+    s = stats.summary()
+    line = "I/O: %s read in %s reads" % (fsize(s["bytes_read"]), s["reads"])
+    if s["bytes_dropped"]:
+        line += ", %s dropped from the page cache" % fsize(s["bytes_dropped"])
+    growth = s["page_cache_growth"]
+    if growth is not None:
+        line += ", page cache %s by %s" % ("grew" if growth >= 0 else "shrank",
+                                           fsize(abs(growth)))
+    print(line)
+
+# The fields torrentview can display, in the order they are displayed
+VIEW_FIELDS = [
+    "name",
+    "meta_version",
+    "info_hash",
+    "info_hash_v2",
+    "piece_size",
+    "comment",
+    "private",
+    "pad_files",
+    "trackers",
+    "webseeds",
+    "files"
+]
+
+def torrent_record(task):
+    """
+    Load a torrent and collect the fields to display.  The torrent is loaded
+    lazily so only the parts of it holding the fields are decoded, the file
+    list and pieces are skipped unless the files are asked for.
+
+    :param task: the torrent file and the fields to collect
+    :type task: 2-tuple (path, list of strings)
+    :returns: the path and fields of the torrent, or the path and an error
+    :rtype: dict
+
+    """
+    path, fields = task
+    record = {"path": path}
+    md = metadata.TorrentMetadata()
+    try:
+        md.load(path, lazy=True)
+        for field in fields:
+            value = getattr(md, field)
+            if field == "files":
+                value = [{"path": f, "length": size} for f, size in value]
+            record[field] = value
+    except (metadata.InvalidPath, metadata.InvalidBencoding) as e:
+        return {"path": path, "error": str(e)}
+    return record
+
+def print_record(record, fields, header=False):
+    """
+    Prints the fields of a torrent collected by `torrent_record` as text.
+    """
+    if header:
+        print("Torrent: %s" % record["path"])
+    for field in fields:
+        value = record[field]
+        if field == "trackers":
+            print("Trackers:")
+            for index, tier in enumerate(value):
+                print("  Tier %s:" % index)
+                for tracker in tier:
+                    print("    %s" % tracker)
+        elif field == "webseeds":
+            print("Webseeds:")
+            for webseed in value:
+                print("  %s" % webseed)
+        elif field == "files":
+            print("Files:")
+            for f in value:
+                print("  %s | %s" % (fsize(f["length"]), f["path"]))
+        else:
+            print("%s: %s" % (field.capitalize(), value))
+
 def torrent_make():
     usage = "%prog [options] source target"
 
@@ -104,6 +239,78 @@ def torrent_make():
         "-q", "--quiet", dest="quiet", action="store_true", default=False,
         help="Do not print out progress or any status."
     )
+    parser.add_option(
+        "-j", "--jobs", dest="jobs", action="store", type="int", default=1,
+        help="The number of workers hashing pieces in parallel."
+    )
+    parser.add_option(
+        "--processes", dest="processes", action="store_true", default=False,
+        help="Hash with worker processes instead of threads."
+    )
+    parser.add_option(
+        "--mmap", dest="use_mmap", action="store_true", default=False,
+        help="Map the data files into memory instead of reading them."
+    )
+    parser.add_option(
+        "--v2", dest="meta_version", action="store_const", const=2,
+        help="Create a BitTorrent v2 torrent with a SHA-256 merkle tree per "
+        "file. Files are hashed in parallel with -j."
+    )
+    parser.add_option(
+        "--hybrid", dest="hybrid", action="store_true", default=False,
+        help="Create a hybrid torrent with both v1 and v2 metadata, the data "
+        "is read once for both."
+    )
+    parser.add_option(
+        "--include", dest="include", action="append", type="string",
+        help="Only add the files matching this shell pattern, the pattern is "
+        "matched against the file name and its path within the source. Can "
+        "be given more than once."
+    )
+    parser.add_option(
+        "--exclude", dest="exclude", action="append", type="string",
+        help="Skip the files and folders matching this shell pattern. Can be "
+        "given more than once."
+    )
+    parser.add_option(
+        "--io", dest="io", action="store", type="choice",
+        choices=iopolicy.MODES, default=iopolicy.BUFFERED,
+        help="How to read the data: buffered, fadvise to drop the data from "
+        "the page cache once hashed, or direct to bypass the page cache with "
+        "O_DIRECT."
+    )
+    parser.add_option(
+        "--readahead", dest="readahead", action="store", type="int", default=0,
+        help="The read ahead window in MiB for the fadvise and direct modes."
+    )
+    parser.add_option(
+        "--queue-depth", dest="queue_depth", action="store", type="int",
+        default=pipeline.QUEUE_DEPTH,
+        help="The number of read chunks that may wait to be hashed."
+    )
+    parser.add_option(
+        "--buffer-memory", dest="buffer_memory", action="store", type="int",
+        default=pipeline.BUFFER_MEMORY // (1024 * 1024),
+        help="The memory used for read buffers in MiB."
+    )
+    parser.add_option(
+        "--checkpoint", dest="checkpoint", action="store", type="string",
+        help="Periodically record the completed pieces in this file so an "
+        "interrupted run can be resumed."
+    )
+    parser.add_option(
+        "--resume", dest="resume", action="store_true", default=False,
+        help="Resume from the checkpoint file, target.checkpoint by default."
+    )
+    parser.add_option(
+        "--cache", dest="cache", action="store", type="string",
+        help="A database of piece hashes to reuse for files that have not "
+        "changed since they were last hashed."
+    )
+    parser.add_option(
+        "--cache-size", dest="cache_size", action="store", type="int",
+        default=256, help="The maximum size of the cache in MiB."
+    )
 
     # Get the options and args from the OptionParser
     (options, args) = parser.parse_args()
@@ -113,25 +320,55 @@ def torrent_make():
         sys.exit(0)
 
     md = metadata.TorrentMetadata()
-    md.data_path = args[0]
+    md.set_data_path(args[0], options.include, options.exclude, options.jobs)
+    if md.scan_stats and not options.quiet:
+        print("Scanned %(files)s files in %(dirs)s folders in %(elapsed).2fs, "
+            "%(excluded)s excluded" % md.scan_stats)
+
+    try:
+        for option, value in options.__dict__.items():
+            if value and hasattr(md, option):
+                setattr(md, option, value)
+    except metadata.InvalidPieceSize as e:
+        parser.error(str(e))
+    if options.tracker:
+        md.trackers = [[t] for t in options.tracker]
+    if options.webseed:
+        md.webseeds = options.webseed
+
+    policy = io_policy(parser, options)
 
-    for option, value in options.__dict__.items():
-        if value and hasattr(md, option):
-            setattr(md, option, value)
+    checkpoint = options.checkpoint
+    if options.resume and not checkpoint:
+        checkpoint = args[1] + ".checkpoint"
 
-    def progress(completed, num_pieces):
-        ratio = completed / num_pieces
-        cols = 60
-        blocks = int(round((cols - 2) * ratio))
-        sys.stdout.write("Percent: %.2f%% Pieces: %s/%s  [" % (ratio*100, completed, num_pieces)\
-         + "#" * blocks + "~" * (cols - 2 - blocks) + "]\r")
-        if completed == num_pieces:
-            print("\n")
+    cache = None
+    if options.cache:
+        cache = hashcache.PieceHashCache(options.cache,
+            options.cache_size * 1024 * 1024)
 
-    md.save(args[1], None if options.quiet else progress)
+    try:
+        md.save(args[1], None if options.quiet else progress, options.jobs,
+            options.processes, options.use_mmap, checkpoint, options.resume,
+            cache, options.queue_depth, options.buffer_memory * 1024 * 1024,
+            policy)
+    except metadata.CheckpointMismatch as e:
+        sys.stderr.write("%s, refusing to resume.\n" % e)
+        sys.exit(1)
+    except metadata.InvalidPieceSize as e:
+        parser.error(str(e))
+
+    if not options.quiet:
+        print_io_stats(policy.stats)
+
+    if cache:
+        if not options.quiet:
+            print("Cache: %(hits)s hits, %(misses)s misses, %(pieces)s pieces "
+                "reused, %(evictions)s evicted" % cache.stats())
+        cache.close()
 
 def torrent_view():
-    usage = "%prog [options] source"
+    usage = "%prog [options] torrent|folder ..."
 
     # Setup the argument parser
     parser = OptionParser(usage=usage, version="%prog (torrentutils) " + version)
@@ -167,61 +404,561 @@ def torrent_view():
         "-i", "--info-hash", dest="info_hash", action="store_true", default=False,
         help="Display the info-hash."
     )
+    parser.add_option(
+        "--info-hash-v2", dest="info_hash_v2", action="store_true", default=False,
+        help="Display the v2 info-hash."
+    )
+    parser.add_option(
+        "--meta-version", dest="meta_version", action="store_true", default=False,
+        help="Display the metadata version."
+    )
     parser.add_option(
         "-f", "--files", dest="files", action="store_true", default=False,
         help="Display list of files."
     )
+    parser.add_option(
+        "--format", dest="format", action="store", type="choice",
+        choices=["text", "json", "csv"], default="text",
+        help="The output format: text, json for a JSON object per line or csv "
+        "with a header line. In csv, lists are JSON encoded."
+    )
+    parser.add_option(
+        "-j", "--jobs", dest="jobs", action="store", type="int", default=1,
+        help="The number of torrents loaded in parallel. Records are printed "
+        "in the order they are ready in the json and csv formats."
+    )
+    parser.add_option(
+        "--processes", dest="processes", action="store_true", default=False,
+        help="Load with worker processes instead of threads."
+    )
 
-     # Get the options and args from the OptionParser
+    # Get the options and args from the OptionParser
     (options, args) = parser.parse_args()
 
     if len(args) < 1:
         parser.print_help()
         sys.exit(0)
 
-    options = options.__dict__
+    fields = [f for f in VIEW_FIELDS if getattr(options, f)] or list(VIEW_FIELDS)
 
-    preferred_order = [
-        "name",
-        "info_hash",
-        "piece_size",
-        "comment",
-        "private",
-        "pad_files",
-        "trackers",
-        "webseeds",
-        "files"
-    ]
+    # Folders are searched for torrents
+    paths = []
+    for arg in args:
+        if os.path.isdir(arg):
+            paths.extend(editor.find_torrents(arg, options.jobs))
+        else:
+            paths.append(arg)
+    tasks = [(path, fields) for path in paths]
 
-    if not any(options.values()):
-        for key in options:
-            options[key] = True
+    pool = None
+    if options.jobs > 1 and len(tasks) > 1:
+        if options.processes:
+            pool = Pool(options.jobs)
+        else:
+            pool = ThreadPool(options.jobs)
+        if options.format == "text":
+            records = pool.imap(torrent_record, tasks, 16)
+        else:
+            records = pool.imap_unordered(torrent_record, tasks, 16)
+    else:
+        records = (torrent_record(task) for task in tasks)
 
-    for arg in args:
-        md = metadata.TorrentMetadata()
-        md.load(arg)
-
-        for option in preferred_order:
-            if options[option] and hasattr(md, option):
-                if option == "trackers":
-                    print("Trackers:")
-                    for index, tier in enumerate(md.trackers):
-                        print("  Tier %s:" % index)
-                        for tracker in tier:
-                            print("    %s" % tracker)
-                elif option == "webseeds":
-                    print("Webseeds:")
-                    for webseed in md.webseeds:
-                        print("  %s" % webseed)
-                elif option == "files":
-                    print("Files:")
-                    for filename, size in md.files:
-                        print("  %s | %s" % (fsize(size), filename))
-                else:
-                    print("%s: %s" % (option.capitalize(), getattr(md, option)))
+    writer = None
+    if options.format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["path"] + fields + ["error"])
+
+    failed = 0
+    try:
+        for record in records:
+            if "error" in record:
+                failed += 1
+                if options.format == "text":
+                    sys.stderr.write("%s\n" % record["error"])
+                    continue
+            if options.format == "json":
+                print(json.dumps(record))
+            elif options.format == "csv":
+                row = [record["path"]]
+                for field in fields:
+                    value = record.get(field, "")
+                    if isinstance(value, (list, dict)):
+                        value = json.dumps(value)
+                    row.append(value)
+                writer.writerow(row + [record.get("error", "")])
+            else:
+                print_record(record, fields, len(tasks) > 1)
+            sys.stdout.flush()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+    sys.exit(1 if failed else 0)
 
 def torrent_edit():
-    pass
+    usage = "%prog [options] torrent|folder [target]"
+
+    # Setup the argument parser
+    parser = OptionParser(usage=usage, version="%prog (torrentutils) " + version)
+    parser.add_option(
+        "-t", "--tracker", dest="tracker", action="append", type="string",
+        help="Replace the trackers, each in its own tier. To specify more than "
+        "one tracker just add as many -t options as necessary."
+    )
+    parser.add_option(
+        "--clear-trackers", dest="clear_trackers", action="store_true",
+        default=False, help="Remove the trackers."
+    )
+    parser.add_option(
+        "-w", "--webseeds", dest="webseed", action="append", type="string",
+        help="Replace the webseeds. To specify more than one webseed just add "
+        "as many -w options as necessary."
+    )
+    parser.add_option(
+        "--clear-webseeds", dest="clear_webseeds", action="store_true",
+        default=False, help="Remove the webseeds."
+    )
+    parser.add_option(
+        "-c", "--comment", dest="comment", action="store", type="string",
+        help="Replace the comment, an empty comment removes it."
+    )
+    parser.add_option(
+        "--update-data", dest="update_data", action="store", type="string",
+        metavar="DATA_DIR",
+        help="Rehash the torrent from the current contents of its data in "
+        "DATA_DIR.  Only the pieces holding files that changed size, were "
+        "modified after --since, were added or were moved are hashed, the "
+        "hashes of the other pieces are reused."
+    )
+    parser.add_option(
+        "--since", dest="since", action="store", type="float",
+        help="Rehash the files modified after this Unix time, by default the "
+        "time the torrent file was written."
+    )
+    parser.add_option(
+        "-q", "--quiet", dest="quiet", action="store_true", default=False,
+        help="Do not print out progress or any status."
+    )
+    parser.add_option(
+        "-j", "--jobs", dest="jobs", action="store", type="int", default=1,
+        help="The number of workers hashing pieces or editing torrents in "
+        "parallel."
+    )
+    parser.add_option(
+        "--processes", dest="processes", action="store_true", default=False,
+        help="Use worker processes instead of threads."
+    )
+    parser.add_option(
+        "--mmap", dest="use_mmap", action="store_true", default=False,
+        help="Map the data files into memory instead of reading them."
+    )
+    parser.add_option(
+        "--include", dest="include", action="append", type="string",
+        help="Only add the files matching this shell pattern. Can be given "
+        "more than once."
+    )
+    parser.add_option(
+        "--exclude", dest="exclude", action="append", type="string",
+        help="Skip the files and folders matching this shell pattern. Can be "
+        "given more than once."
+    )
+    parser.add_option(
+        "--io", dest="io", action="store", type="choice",
+        choices=iopolicy.MODES, default=iopolicy.BUFFERED,
+        help="How to read the data: buffered, fadvise to drop the data from "
+        "the page cache once hashed, or direct to bypass the page cache with "
+        "O_DIRECT."
+    )
+    parser.add_option(
+        "--readahead", dest="readahead", action="store", type="int", default=0,
+        help="The read ahead window in MiB for the fadvise and direct modes."
+    )
+
+    # Get the options and args from the OptionParser
+    (options, args) = parser.parse_args()
+
+    trackers = None
+    if options.tracker or options.clear_trackers:
+        trackers = [[t] for t in options.tracker or []]
+    webseeds = None
+    if options.webseed or options.clear_webseeds:
+        webseeds = options.webseed or []
+    edit = editor.TorrentEdit(trackers, options.comment, webseeds)
+
+    if len(args) < 1 or not (options.update_data or edit.changes()):
+        parser.print_help()
+        sys.exit(0)
+
+    if not options.update_data:
+        if os.path.isdir(args[0]):
+            paths = editor.find_torrents(args[0], options.jobs)
+            batch = editor.BatchEditor(edit, options.jobs, options.processes)
+            results = batch.iter_edit(paths, args[1] if len(args) > 1 else None,
+                                      args[0])
+        else:
+            results = [editor.BatchEditor(edit).edit((args[0],
+                args[1] if len(args) > 1 else None))]
+
+        counts = {"edited": 0, "unchanged": 0, "failed": 0}
+        for path, changed, error in results:
+            if error:
+                counts["failed"] += 1
+                sys.stderr.write("%s\n" % error)
+            elif changed:
+                counts["edited"] += 1
+            else:
+                counts["unchanged"] += 1
+        if not options.quiet:
+            print("Torrents: %(edited)s edited, %(unchanged)s unchanged, "
+                "%(failed)s failed" % counts)
+        sys.exit(1 if counts["failed"] else 0)
+
+    target = args[1] if len(args) > 1 else args[0]
+
+    md = metadata.TorrentMetadata()
+    md.load(args[0])
+    try:
+        stats = md.update_data(options.update_data, options.since,
+                               options.include, options.exclude, options.jobs)
+    except metadata.InvalidPath as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+    if not options.quiet:
+        print("Files: %(unchanged)s unchanged, %(changed)s changed, "
+            "%(added)s added, %(removed)s removed" % stats)
+
+    if trackers is not None:
+        md.trackers = trackers
+    if webseeds is not None:
+        md.webseeds = webseeds
+    if options.comment is not None:
+        md.comment = options.comment
+
+    policy = io_policy(parser, options)
+    try:
+        md.save(target, None if options.quiet else progress, options.jobs,
+            options.processes, options.use_mmap, io_policy=policy)
+    except metadata.InvalidPieceSize as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+
+    if not options.quiet:
+        print_io_stats(policy.stats)
 
 def torrent_verify():
-    pass
+    usage = "%prog [options] torrent [data_dir]"
+
+    # Setup the argument parser
+    parser = OptionParser(usage=usage, version="%prog (torrentutils) " + version)
+    parser.add_option(
+        "-j", "--jobs", dest="jobs", action="store", type="int", default=1,
+        help="The number of workers hashing pieces in parallel."
+    )
+    parser.add_option(
+        "--processes", dest="processes", action="store_true", default=False,
+        help="Hash with worker processes instead of threads."
+    )
+    parser.add_option(
+        "--mmap", dest="use_mmap", action="store_true", default=False,
+        help="Map the data files into memory instead of reading them."
+    )
+    parser.add_option(
+        "--io", dest="io", action="store", type="choice",
+        choices=iopolicy.MODES, default=iopolicy.BUFFERED,
+        help="How to read the data: buffered, fadvise to drop the data from "
+        "the page cache once hashed, or direct to bypass the page cache with "
+        "O_DIRECT."
+    )
+    parser.add_option(
+        "--readahead", dest="readahead", action="store", type="int", default=0,
+        help="The read ahead window in MiB for the fadvise and direct modes."
+    )
+    parser.add_option(
+        "--queue-depth", dest="queue_depth", action="store", type="int",
+        default=pipeline.QUEUE_DEPTH,
+        help="The number of read chunks that may wait to be hashed."
+    )
+    parser.add_option(
+        "--buffer-memory", dest="buffer_memory", action="store", type="int",
+        default=pipeline.BUFFER_MEMORY // (1024 * 1024),
+        help="The memory used for read buffers in MiB."
+    )
+    parser.add_option(
+        "-p", "--pieces", dest="pieces", action="store_true", default=False,
+        help="Display the index of every failed piece."
+    )
+    parser.add_option(
+        "--sample", dest="sample", action="store", type="int", default=0,
+        metavar="N",
+        help="Only check a random sample of N pieces, spread over the whole "
+        "torrent.  The first and last piece of every file are always checked."
+    )
+    parser.add_option(
+        "--confidence", dest="confidence", action="store", type="float",
+        metavar="P",
+        help="Only check enough random pieces to find corruption of more than "
+        "--tolerance of the pieces with probability P, e.g. 0.99.  Also the "
+        "confidence of the reported corruption bound, 0.95 by default."
+    )
+    parser.add_option(
+        "--tolerance", dest="tolerance", action="store", type="float",
+        default=0.001,
+        help="The fraction of corrupt pieces --confidence should detect."
+    )
+    parser.add_option(
+        "--seed", dest="seed", action="store", type="int",
+        help="The seed of the sample, a random one is picked and printed by "
+        "default.  The same seed checks the same pieces."
+    )
+    parser.add_option(
+        "--state", dest="state", action="store", type="string",
+        help="Remember the pieces that passed in this database, and skip the "
+        "pieces whose files did not change since on the next run."
+    )
+    parser.add_option(
+        "--full", dest="full", action="store_true", default=False,
+        help="With --state, hash every piece even if its files did not change."
+    )
+    parser.add_option(
+        "--locate", dest="locate", action="store", type="string",
+        metavar="ROOT",
+        help="Search ROOT for the files of the torrent by size and confirm "
+        "them by hashing their pieces, instead of verifying data_dir."
+    )
+    parser.add_option(
+        "--symlinks", dest="symlinks", action="store", type="string",
+        metavar="DIR",
+        help="With --locate, create a symlink in DIR for every file found, so "
+        "the torrent can be verified or seeded from DIR."
+    )
+    parser.add_option(
+        "--locate-pieces", dest="locate_pieces", action="store", type="int",
+        default=0,
+        help="With --locate, hash at most this many pieces of each candidate, "
+        "0 for all of them."
+    )
+    parser.add_option(
+        "--json", dest="json", action="store_true", default=False,
+        help="Print a JSON summary instead of the file list."
+    )
+    parser.add_option(
+        "-q", "--quiet", dest="quiet", action="store_true", default=False,
+        help="Do not print out progress or any status."
+    )
+
+    # Get the options and args from the OptionParser
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(0)
+
+    data_dir = args[1] if len(args) > 1 else "."
+
+    md = metadata.TorrentMetadata()
+    md.load(args[0])
+    if not md.pieces:
+        sys.stderr.write("%s has no v1 piece hashes, verifying v2 only torrents "
+            "is not supported.\n" % args[0])
+        sys.exit(2)
+
+    policy = io_policy(parser, options)
+
+    if options.locate:
+        locator = locate.DataLocator(md.get_storage(options.symlinks or data_dir),
+            md.pieces, options.locate, options.jobs, options.locate_pieces,
+            policy)
+        results = locator.locate(None if options.quiet or options.json else progress)
+        skipped = locator.link(results) if options.symlinks else []
+        for r, reason in skipped:
+            sys.stderr.write("Not linking %s: %s\n" % (r.path, reason))
+        if options.json:
+            print(json.dumps({
+                "info_hash": md.info_hash,
+                "files": [r.to_dict() for r in results],
+                "io": policy.stats.summary(),
+            }, indent=2))
+        elif not options.quiet:
+            for r in results:
+                print("%-11s %s%s" % (r.status.upper(), r.path,
+                    " -> %s" % r.source if r.source else ""))
+            print_io_stats(policy.stats)
+        sys.exit(1 if skipped or any(r.status == locate.NOT_FOUND
+                                     for r in results) else 0)
+
+    if options.confidence is not None and not 0 < options.confidence < 1:
+        parser.error("--confidence must be between 0 and 1")
+    if not 0 < options.tolerance < 1:
+        parser.error("--tolerance must be between 0 and 1")
+
+    storage = md.get_storage(data_dir)
+    verifier = verify.TorrentVerifier(storage, md.pieces,
+        options.jobs, options.processes, options.use_mmap, options.queue_depth,
+        options.buffer_memory * 1024 * 1024, policy)
+    show_progress = None if options.quiet or options.json else progress
+
+    # Report the missing and truncated files before hashing
+    files = verifier.precheck()
+    if show_progress:
+        for f in files:
+            if f.status != verify.OK:
+                print("%-9s %s" % (f.status.upper(), f.path))
+
+    state = None
+    known = None
+    if options.state:
+        state = verifystate.VerifyState(options.state)
+        if not options.full:
+            known = state.lookup(md.info_hash, storage, files)
+    if options.sample or options.confidence:
+        count = options.sample or verify.sample_size(options.confidence,
+                                                     options.tolerance)
+        seed = options.seed
+        if seed is None:
+            seed = random.randint(0, 2 ** 31 - 1)
+        result = verifier.verify_sample(count, seed, options.confidence or 0.95,
+                                        show_progress, files, known)
+    else:
+        result = verifier.verify(show_progress, files=files, known=known)
+
+    if state:
+        state.store(md.info_hash, storage, result)
+        state.close()
+
+    if options.json:
+        summary = result.summary()
+        summary["info_hash"] = md.info_hash
+        summary["io"] = policy.stats.summary()
+        print(json.dumps(summary, indent=2))
+    elif not options.quiet:
+        for f in result.files:
+            print("%-9s %s" % (f.status.upper(), f.path))
+        if options.pieces:
+            for index in result.failed_pieces:
+                print("Piece %s failed" % index)
+        print("Pieces: %s/%s passed" % (result.num_checked - len(result.failed_pieces),
+            result.num_checked))
+        if result.reused:
+            print("%s pieces of unchanged files were not hashed again" %
+                result.reused)
+        if result.sample:
+            print("Sampled %s of %s pieces with seed %s, at most %.4f%% of the "
+                "pieces are corrupt with %g%% confidence" % (result.num_checked,
+                result.num_pieces, result.sample["seed"],
+                result.sample["corruption_bound"] * 100,
+                result.sample["confidence"] * 100))
+        print_io_stats(policy.stats)
+
+    sys.exit(0 if result.ok else 1)
+
+def torrent_index():
+    usage = "%prog [options] database [folder ...]"
+
+    # Setup the argument parser
+    parser = OptionParser(usage=usage, version="%prog (torrentutils) " + version)
+    parser.add_option(
+        "--file", dest="file", action="store", type="string",
+        help="Find the torrents containing a file of this name or path, or "
+        "matching this shell pattern."
+    )
+    parser.add_option(
+        "--tracker", dest="tracker", action="store", type="string",
+        help="Find the torrents announcing to this tracker URL or host, or to "
+        "a URL matching this shell pattern."
+    )
+    parser.add_option(
+        "--info-hash", dest="info_hash", action="store", type="string",
+        help="Find the torrent with this v1 or v2 info-hash."
+    )
+    parser.add_option(
+        "--name", dest="name", action="store", type="string",
+        help="Find the torrents with this name or a name matching this shell "
+        "pattern."
+    )
+    parser.add_option(
+        "--shared", dest="shared", action="store", type="string",
+        metavar="TORRENT",
+        help="Find the torrents sharing pieces or files with this torrent, "
+        "which does not need to be in the index."
+    )
+    parser.add_option(
+        "--private", dest="private", action="store_true",
+        help="Only find private torrents."
+    )
+    parser.add_option(
+        "--public", dest="private", action="store_false",
+        help="Only find public torrents."
+    )
+    parser.add_option(
+        "--format", dest="format", action="store", type="choice",
+        choices=["text", "json"], default="text",
+        help="The output format of the query: text or json for a JSON object "
+        "per torrent."
+    )
+    parser.add_option(
+        "-j", "--jobs", dest="jobs", action="store", type="int", default=1,
+        help="The number of torrents loaded in parallel when refreshing."
+    )
+    parser.add_option(
+        "--processes", dest="processes", action="store_true", default=False,
+        help="Load with worker processes instead of threads."
+    )
+    parser.add_option(
+        "-q", "--quiet", dest="quiet", action="store_true", default=False,
+        help="Do not print out progress or any status."
+    )
+
+    # Get the options and args from the OptionParser
+    (options, args) = parser.parse_args()
+
+    if len(args) < 1:
+        parser.print_help()
+        sys.exit(0)
+
+    db = index.TorrentIndex(args[0])
+    try:
+        # Any folders given are refreshed first
+        for folder in args[1:]:
+            try:
+                stats = db.refresh(folder, options.jobs, options.processes,
+                                   None if options.quiet else torrent_progress)
+            except metadata.InvalidPath as e:
+                sys.stderr.write("%s\n" % e)
+                sys.exit(1)
+            if not options.quiet:
+                print("%s: " % folder + "%(added)s added, %(updated)s updated, "
+                    "%(removed)s removed, %(unchanged)s unchanged, %(failed)s "
+                    "failed" % stats)
+
+        if options.shared:
+            try:
+                shared = db.shared(options.shared)
+            except (metadata.InvalidPath, metadata.InvalidBencoding) as e:
+                sys.stderr.write("%s\n" % e)
+                sys.exit(1)
+            for torrent in shared:
+                if options.format == "json":
+                    print(json.dumps(torrent))
+                else:
+                    print("%s pieces, %s files, %s  %s" % (
+                        torrent["shared_pieces"], torrent["shared_files"],
+                        fsize(torrent["shared_bytes"]), torrent["path"]))
+            return
+
+        criteria = dict((key, getattr(options, key)) for key in
+                        ("file", "tracker", "info_hash", "name", "private"))
+        if all(value is None for value in criteria.values()):
+            if not options.quiet:
+                print("Index: %(torrents)s torrents, %(files)s files, "
+                    "%(trackers)s trackers, %(pieces)s piece digests" % db.stats())
+            return
+
+        for torrent in db.query(**criteria):
+            if options.format == "json":
+                print(json.dumps(torrent))
+            else:
+                print("%s  %s" % (torrent["info_hash"] or torrent["info_hash_v2"],
+                                  torrent["path"]))
+    finally:
+        db.close()